@@ -0,0 +1,442 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Asyncio control core
+-------------------------------------------------------------
+Description:
+
+Runs the traffic system of finalise_integrated_code.py as concurrent asyncio tasks
+instead of the single serial loop in `main()`:
+
+- one task per ultrasonic sensor, sampling it in a worker thread at the rate
+  `samplingPolicy` chooses for it and sending every sample to the junction,
+- one task handing the debounced PB1 presses queued by `button_callback()` to the junction,
+- a junction task storing the samples in `sensorSnapshot`, running `refresh_state()` and
+  `check_reset_4I3()` and deciding which subsystems start or stop, with the same rules as
+  `control_tick()`,
+- one task per subsystem (`subsystem1` to `subsystem4` and `sub3i2`) that runs it until
+  it finishes, sleeping until its own next deadline between calls,
+- a blink task toggling the flashing lights of `blinkEngine` at every toggle edge.
+
+Tasks communicate through asyncio queues. The sensor and button tasks put their inputs on
+the `inputsChanged` queue of the junction, and the junction puts the start time of a
+subsystem on the queue of its task. A slow or blocked sensor read only delays its own
+task, the button and the other subsystems keep running.
+
+The event loop keeps its time on `fic.clock`, so every sleep and timeout of the tasks
+follows the clock of the traffic system. On a `SimulatedClock` the loop jumps straight
+to the next timer and the board is read in the loop itself, so a run is deterministic.
+'''
+
+import asyncio
+import selectors
+
+import finalise_integrated_code as fic
+from virtual_clock import SimulatedClock
+
+buttonInterval = 0.05 # seconds between two checks of the queued PB1 presses
+junctionInterval = 0.3 # longest time between two junction updates without an input change
+
+subsystemNums = (1, 2, 3, 4, '3I2')
+
+PB1 = 'PB1' # source of the button messages on the inputsChanged queue
+
+class ClockSelector(selectors.DefaultSelector):
+
+    """
+    Selector of a `ClockEventLoop`. On a `SimulatedClock`, waiting for `timeout` seconds
+    advances the clock instead of blocking, and runs the scripted steps due meanwhile.
+    """
+
+    def select(self, timeout=None):
+        if not isinstance(fic.clock, SimulatedClock):
+            return super().select(timeout)
+        ready = super().select(0)
+        if len(ready) == 0 and timeout is not None and timeout > 0:
+            fic.clock.sleep(timeout)
+            ready = super().select(0)
+        return ready
+
+class ClockEventLoop(asyncio.SelectorEventLoop):
+
+    """
+    An event loop whose timers run on `fic.clock`, so `asyncio.sleep()` and every timeout
+    of the tasks wait on the clock of the traffic system.
+    """
+
+    def __init__(self):
+        super().__init__(ClockSelector())
+
+    def time(self):
+        return fic.clock.time()
+
+async def call_board(function, *args):
+
+    """
+    Runs a call that reads the board in a worker thread, so it only blocks its own task.
+    On a `SimulatedClock` it is run in the loop itself, the simulated board answers at once.
+
+    Parameters:
+    function (callable): The function to call.
+    args: The arguments of the call.
+
+    Returns:
+    The result of the call.
+    """
+
+    if isinstance(fic.clock, SimulatedClock):
+        return function(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, function, *args)
+
+async def next_message(messages, timeout):
+
+    """
+    Takes the next message from `messages`, waiting up to `timeout` seconds for it.
+
+    Parameters:
+    messages (asyncio.Queue): The queue to take the message from.
+    timeout (float): The longest time to wait in seconds.
+
+    Returns:
+    object: The message, or None on timeout.
+    """
+
+    if not messages.empty():
+        return messages.get_nowait()
+    # asyncio.wait() instead of wait_for(), which can swallow the cancellation of the task
+    # when the message arrives at the same moment
+    getter = asyncio.ensure_future(messages.get())
+    try:
+        await asyncio.wait((getter,), timeout=max(0, timeout))
+    finally:
+        if not getter.done():
+            getter.cancel()
+    if getter.done() and not getter.cancelled():
+        return getter.result()
+    return None
+
+async def sensor_task(sensorNum, inputsChanged):
+
+    """
+    Samples one ultrasonic sensor and puts every sample on the `inputsChanged` queue.
+    The sensor is sampled again after the interval `samplingPolicy` chooses for it.
+
+    Parameters:
+    sensorNum (int): The sensor (1, 2, or 3).
+    inputsChanged (asyncio.Queue): Takes a (sensorNum, distance) message per sample.
+
+    Returns:
+    None
+    """
+
+    while True:
+        distance = await call_board(fic.get_distance, fic.trigPins[sensorNum], sensorNum)
+        inputsChanged.put_nowait((sensorNum, distance))
+        await asyncio.sleep(fic.samplingPolicy.interval(sensorNum))
+
+async def button_task(inputsChanged):
+
+    """
+    Takes the PB1 presses queued by `button_callback()` and puts a (PB1, True) message on
+    the `inputsChanged` queue when there was one.
+
+    Parameters:
+    inputsChanged (asyncio.Queue): Takes a message per press.
+
+    Returns:
+    None
+    """
+
+    while True:
+        if await call_board(fic.latch_crossing_requests):
+            inputsChanged.put_nowait((PB1, True))
+        await asyncio.sleep(buttonInterval)
+
+def update_junction(buttonPressed, activated):
+
+    """
+    Updates the detection state and starts or stops subsystems, following the rules of `control_tick()`.
+
+    A subsystem is started by putting its start time on its queue, a running subsystem is
+    woken by putting None on it.
+
+    Parameters:
+    buttonPressed (bool): True if PB1 was pressed since the last update.
+    activated (dict): Maps every subsystem to the queue of its task.
+
+    Returns:
+    None
+    """
+
+    now = fic.clock.time()
+    fic.refresh_state()
+    fic.check_reset_4I3()
+
+    if fic.predictionCancelled and fic.runningSub1:
+        fic.runningSub1 = False
+        fic.firstTimeSub1 = False
+        fic.starting_sub1()
+
+    if not fic.runningSub1 and not fic.runningSub2 and not fic.runningSub3 and not fic.runningSub4:
+        fic.starting()
+
+    if fic.overheightVechicleAtUS1 and not fic.runningSub1:
+        fic.runningSub1 = True
+        activated[1].put_nowait(now)
+
+    if fic.overheightVechicleAtUS3 and not fic.runningSub3:
+        fic.runningSub3 = True
+        activated[3].put_nowait(now)
+
+    if fic.runningSub1 and fic.runningSub3 and fic.overheightVechicleExitedUS3 and not fic.overheightVechicleAtUS1:
+        fic.runningSub1 = False
+        fic.tone_off()
+        fic.starting_sub1()
+
+    if fic.overheightVechicleAtUS2:
+        if fic.us_detected(2) and not fic.runningSub4:
+            fic.runningSub4 = True
+            activated[4].put_nowait(now)
+        elif fic.runningSub4:
+            activated[4].put_nowait(None)
+
+    if buttonPressed:
+        if now - fic.timePrevious2 > fic.pedestrianLockout and fic.lastState2 == 0 and not fic.runningSub2:
+            fic.runningSub2 = True
+            activated[2].put_nowait(now)
+
+    if fic.running3I2:
+        activated['3I2'].put_nowait(None)
+
+async def junction_task(inputsChanged, activated):
+
+    """
+    Runs `update_junction()` whenever inputs arrive, and at least every `junctionInterval` seconds.
+
+    Every sensor sample waiting on the queue is stored in `sensorSnapshot` first, so the
+    detectors are updated once per sample, by `refresh_state()`.
+
+    Parameters:
+    inputsChanged (asyncio.Queue): Takes the messages of the sensor and button tasks.
+    activated (dict): Maps every subsystem to the queue of its task.
+
+    Returns:
+    None
+    """
+
+    message = None
+    while True:
+        buttonPressed = False
+        while message is not None:
+            source, value = message
+            if source == PB1:
+                buttonPressed = True
+            else:
+                fic.sensorSnapshot.store(source, value)
+            message = inputsChanged.get_nowait() if not inputsChanged.empty() else None
+        update_junction(buttonPressed, activated)
+        message = await next_message(inputsChanged, junctionInterval)
+
+def is_running(subsystemNum):
+
+    """
+    Returns True while the given subsystem is running.
+
+    Parameters:
+    subsystemNum (int or str): The subsystem (1, 2, 3, 4, or '3I2').
+
+    Returns:
+    bool: The subsystem's running flag.
+    """
+
+    return {
+        1: fic.runningSub1,
+        2: fic.runningSub2,
+        3: fic.runningSub3,
+        4: fic.runningSub4,
+        '3I2': fic.running3I2,
+    }[subsystemNum]
+
+def step_subsystem(subsystemNum, startTime, activated):
+
+    """
+    Runs one call of the given subsystem with its start time.
+
+    Parameters:
+    subsystemNum (int or str): The subsystem (1, 2, 3, 4, or '3I2').
+    startTime (float): When the subsystem was started.
+    activated (dict): Maps every subsystem to the queue of its task.
+
+    Returns:
+    None
+    """
+
+    if subsystemNum == 1:
+        fic.subsystem1(startTime)
+    elif subsystemNum == 2:
+        fic.subsystem2(startTime)
+    elif subsystemNum == 3:
+        wasRunning3I2 = fic.running3I2
+        fic.subsystem3(startTime)
+        # subsystem 3 starts subsystem 3 integrate 2 during its first phase, with its own start time
+        if fic.running3I2 and not wasRunning3I2:
+            activated['3I2'].put_nowait(startTime)
+    elif subsystemNum == 4:
+        # like control_tick(), subsystem 4 only runs while US2 detects the vehicle
+        if fic.overheightVechicleAtUS2:
+            fic.subsystem4(startTime)
+    elif subsystemNum == '3I2':
+        fic.sub3i2(startTime)
+
+async def subsystem_task(subsystemNum, activated):
+
+    """
+    Runs one subsystem from the moment it is started until it stops running.
+
+    The task waits for a start time on its queue. Between two calls it sleeps until the
+    subsystem's next deadline from `subsystem_deadline()`, or until the junction wakes it
+    with another message. Once no phase boundary is left, a subsystem still running waits
+    for a sensor (e.g. subsystem 3 for the vehicle to leave US3), so it is polled every
+    `junctionInterval` seconds until it stops.
+
+    Parameters:
+    subsystemNum (int or str): The subsystem (1, 2, 3, 4, or '3I2').
+    activated (dict): Maps every subsystem to the queue of its task.
+
+    Returns:
+    None
+    """
+
+    while True:
+        startTime = await activated[subsystemNum].get()
+        if startTime is None:
+            # woken after the run had already ended
+            continue
+        while is_running(subsystemNum):
+            step_subsystem(subsystemNum, startTime, activated)
+            now = fic.clock.time()
+            deadline = fic.subsystem_deadline(subsystemNum, now, startTime)
+            if deadline is None:
+                message = await next_message(activated[subsystemNum], junctionInterval)
+            else:
+                message = await next_message(activated[subsystemNum], deadline - now + fic.deadlineSlack)
+            if message is not None:
+                # started again by the junction
+                startTime = message
+
+async def blink_task():
+
+    """
+    Toggles the flashing lights at every edge of `blinkEngine`, independent of the subsystem tasks.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    while True:
+        fic.blinkEngine.update()
+        now = fic.clock.time()
+        nextToggle = fic.blinkEngine.next_toggle(now)
+        if nextToggle is None:
+            # nothing flashes, check again soon so a new flash keeps its rhythm
+            await asyncio.sleep(fic.blinkEngine.period / 4)
+        else:
+            await asyncio.sleep(nextToggle - now + fic.deadlineSlack)
+
+async def main_async(duration=None):
+
+    """
+    Starts all sensor, button, junction and subsystem tasks on the connected board.
+
+    Parameters:
+    duration (float): Seconds to run before cancelling all tasks, or None to run until interrupted.
+
+    Returns:
+    None
+    """
+
+    inputsChanged = asyncio.Queue()
+    activated = {subsystemNum: asyncio.Queue() for subsystemNum in subsystemNums}
+
+    # the sensor tasks own the sampling, a stale reading is never re-sampled inside a subsystem
+    fic.sensorSnapshot.sampleWhenStale = False
+
+    tasks = [asyncio.create_task(sensor_task(sensorNum, inputsChanged)) for sensorNum in fic.trigPins]
+    tasks.append(asyncio.create_task(button_task(inputsChanged)))
+    tasks.append(asyncio.create_task(junction_task(inputsChanged, activated)))
+    tasks += [asyncio.create_task(subsystem_task(subsystemNum, activated)) for subsystemNum in subsystemNums]
+    tasks.append(asyncio.create_task(blink_task()))
+
+    try:
+        if duration is None:
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.sleep(duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        fic.sensorSnapshot.sampleWhenStale = True
+
+def run_loop(duration=None):
+
+    """
+    Runs `main_async()` on a `ClockEventLoop` and closes the loop afterwards.
+
+    Parameters:
+    duration (float): Seconds to run, or None to run until interrupted.
+
+    Returns:
+    None
+    """
+
+    loop = ClockEventLoop()
+    try:
+        loop.run_until_complete(main_async(duration))
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+def run_async(startTime, newBoard=None, duration=None):
+
+    """
+    Asyncio counterpart of `main()`: resets the junction, runs all tasks and shuts down safely on interruption.
+
+    Parameters:
+    startTime (float): The system start time used for time-based logic and delays.
+    newBoard (object): Board to run on, e.g. a `SimulatedBoard`. If None, the board
+                       already connected with `connect_board()` is used.
+    duration (float): Seconds to run, or None to run until interrupted.
+
+    Returns:
+    None
+    """
+
+    try:
+        if newBoard is not None:
+            fic.connect_board(newBoard)
+
+        fic.running3I2 = False
+        fic.timePrevious2 = 0
+        fic.lastState2 = 0
+        fic.starting()
+        fic.clock.sleep(fic.readyDelay)
+
+        fic.log_event(fic.INFO, 'ready')
+
+        run_loop(duration)
+
+    except KeyboardInterrupt:
+        fic.ending()
+        fic.clock.sleep(0.5)
+        fic.board.shutdown()
+        fic.log_event(fic.INFO, 'shutdown')
+        fic.close_event_log()
+
+if __name__ == '__main__':
+    fic.connect_board()
+    run_async(fic.startTime)
@@ -0,0 +1,281 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Control loop benchmark suite
+-------------------------------------------------------------
+Description:
+
+Runs the control loop of finalise_integrated_code.py through scripted traffic scenarios
+on a `SimulatedBoard` and reports for every scenario:
+
+- ticks per second of CPU time spent in the loop,
+- Firmata messages per tick,
+- detection-to-red latency: the time from a sensor detecting a vehicle (or PB1 being
+  pressed) to the register of the reacting subsystem latching its stop pattern, negative
+  if the junction predicted the vehicle and reacted before it was detected,
+- CPU time of the whole scenario and the per-stage timings of `instrumentation`
+  (sensor reads, state refresh, register writes, ...).
+
+Scenarios run on a `SimulatedClock` instead of the wall clock, so a 45 second scenario takes
+a fraction of a second and every run makes the same decisions. The results are written as
+JSON, and a previous result file can be given as baseline to flag regressions:
+
+    python benchmark_control_loop.py --output results.json --baseline previous.json
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+import finalise_integrated_code as fic
+import instrumentation
+from event_log import EventLog, OFF
+import simulated_board
+from simulated_board import SimulatedBoard
+from virtual_clock import SimulatedClock
+
+class Scenario:
+
+    """
+    A scripted traffic scenario.
+
+    Parameters:
+    name (str): Name of the scenario in the results.
+    duration (float): Seconds the scenario runs.
+    steps (list of tuple): (seconds after the start, action(board)) pairs, e.g. setting a distance.
+    probe (tuple): (seconds after the start of the detection, reacted(board)) used to measure the
+                   detection-to-red latency, None if the scenario has no detection. The latency
+                   is negative if the junction reacted before the detection, e.g. to a prediction.
+    settings (dict): Globals of finalise_integrated_code.py set while the scenario runs,
+                     e.g. {'useVehicleTracking': True}.
+    """
+
+    def __init__(self, name, duration, steps, probe=None, settings=None):
+        self.name = name
+        self.duration = duration
+        self.steps = steps
+        self.probe = probe
+        self.settings = settings or {}
+
+def vehicle(sensorNum, distance):
+    """Returns a scenario step placing an object `distance` cm in front of a sensor."""
+    return lambda simBoard: simBoard.set_distance(fic.trigPins[sensorNum], distance)
+
+def clear(sensorNum):
+    """Returns a scenario step clearing a sensor."""
+    return vehicle(sensorNum, simulated_board.clearDistance)
+
+def press(simBoard):
+    simBoard.press_button()
+
+def release(simBoard):
+    simBoard.release_button()
+
+def tl1_stopping(simBoard):
+    # leaving the normal pattern of register 1 means TL1 and TL2 start stopping traffic
+    return simBoard.latched_byte(1) != fic.reg1Normal
+
+def tl3_red(simBoard):
+    return simBoard.latched_byte(2) & fic.redTL3Bit != 0
+
+def tl4_red(simBoard):
+    return simBoard.latched_byte(2) & fic.redTL4Bit != 0
+
+def button_spam_steps(duration, interval=0.1):
+    """Returns scenario steps pressing and releasing PB1 every `interval` seconds."""
+    steps = []
+    for index in range(int(duration / interval)):
+        steps.append((index * interval, press))
+        steps.append((index * interval + interval / 2, release))
+    return steps
+
+scenarios = [
+    Scenario('idle_junction', 60, []),
+    Scenario('overheight_us1_then_us3', 45, [
+        (1, vehicle(1, 5)),
+        (3, vehicle(3, 5)),
+        (4, clear(1)),
+        (10, clear(3)),
+    ], probe=(1, tl1_stopping)),
+    Scenario('us2_during_pedestrian_cycle', 40, [
+        (1, press),
+        (1.2, release),
+        (5, vehicle(2, 5)),
+        (15, clear(2)),
+    ], probe=(5, tl3_red)),
+    Scenario('pb1_button_spam', 40, button_spam_steps(40), probe=(0, tl4_red)),
+    # a vehicle closing in fast, its distance falls below detectionThreshold at 1.08 s (tracking needs NumPy)
+    Scenario('fast_vehicle_us1', 45, [
+        (1, vehicle(1, 19)),
+        (1.02, vehicle(1, 16)),
+        (1.04, vehicle(1, 13)),
+        (1.06, vehicle(1, 11)),
+        (1.08, vehicle(1, 6)),
+        (3, vehicle(3, 5)),
+        (4, clear(1)),
+        (10, clear(3)),
+    ], probe=(1.08, tl1_stopping), settings={'useVehicleTracking': True, 'predictiveTrigger': True}),
+]
+
+def run_scenario(scenario):
+
+    """
+    Runs one scenario on a fresh simulated board and measures it.
+
+    Parameters:
+    scenario (Scenario): The scenario to run.
+
+    Returns:
+    dict: The measurements of the scenario.
+    """
+
+    clock = SimulatedClock()
+    previousClock = fic.use_clock(clock)
+    previousEventLog = fic.eventLog
+    previousSettings = {name: getattr(fic, name) for name in scenario.settings}
+    for name, value in scenario.settings.items():
+        setattr(fic, name, value)
+    # events are still built and buffered, as on the junction, but never written
+    fic.eventLog = EventLog(None, consoleLevel=OFF)
+
+    try:
+        simBoard = SimulatedBoard(clock=clock)
+        start = clock.now
+        with contextlib.redirect_stdout(io.StringIO()):
+            fic.connect_board(simBoard)
+            fic.reset_junction(start)
+            fic.starting()
+            for offset, action in scenario.steps:
+                clock.schedule(start + offset, lambda action=action: action(simBoard))
+            metrics = instrumentation.enable(dumpPath=None)
+
+            latency = None
+            ticks = 0
+            messagesBefore = simBoard.messages()
+            cpuStart = time.process_time()
+            while clock.now < start + scenario.duration:
+                if fic.useStateMachines:
+                    fic.state_machine_step()
+                else:
+                    fic.control_tick()
+                ticks += 1
+                # the first tick the probe holds, a predicted detection can react before the measured one
+                if scenario.probe is not None and latency is None and scenario.probe[1](simBoard):
+                    latency = clock.now - (start + scenario.probe[0])
+                fic.wait_for_next_deadline()
+            cpuTime = time.process_time() - cpuStart
+    finally:
+        instrumentation.disable()
+        fic.eventLog.close()
+        fic.use_clock(previousClock)
+        fic.eventLog = previousEventLog
+        for name, value in previousSettings.items():
+            setattr(fic, name, value)
+
+    stages = metrics.snapshot()['stages']
+    return {
+        'ticks': ticks,
+        'ticksPerSecond': ticks / cpuTime if cpuTime > 0 else None,
+        'messagesPerTick': (simBoard.messages() - messagesBefore) / ticks,
+        'sonarReads': simBoard.sonarReads,
+        'detectionToRedLatency': latency,
+        'cpuTime': cpuTime,
+        'stages': {name: {key: stages[name][key] for key in ('count', 'mean', 'p95', 'max')} for name in stages},
+    }
+
+def run_benchmarks(selected=None, repeat=3):
+
+    """
+    Runs the scenarios and keeps the fastest of `repeat` runs of each, to reduce noise from the host.
+
+    Parameters:
+    selected (list of str): Names of the scenarios to run, None for all.
+    repeat (int): Number of runs per scenario.
+
+    Returns:
+    dict: The run configuration and the measurements of every scenario.
+    """
+
+    results = {}
+    for scenario in scenarios:
+        if selected is not None and scenario.name not in selected:
+            continue
+        runs = [run_scenario(scenario) for index in range(repeat)]
+        results[scenario.name] = min(runs, key=lambda run: run['cpuTime'])
+
+    return {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'useStateMachines': fic.useStateMachines,
+        'useFirmwareShiftOut': fic.useFirmwareShiftOut,
+        'scenarios': results,
+    }
+
+def find_regressions(results, baseline, tolerance=0.2):
+
+    """
+    Compares results with a baseline run.
+
+    A scenario regresses if its throughput dropped, or its messages per tick or latency grew,
+    by more than `tolerance` (a fraction of the size of the baseline value, as a latency can be negative).
+
+    Parameters:
+    results (dict): Output of `run_benchmarks()`.
+    baseline (dict): A previous output of `run_benchmarks()`.
+    tolerance (float): Allowed relative change.
+
+    Returns:
+    list of str: One line per regression, empty if there is none.
+    """
+
+    regressions = []
+    for name, result in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        for key, higherIsBetter in (('ticksPerSecond', True), ('messagesPerTick', False), ('detectionToRedLatency', False)):
+            new, old = result[key], previous[key]
+            if new is None or old is None or old == 0:
+                continue
+            change = (new - old) / abs(old)
+            if (higherIsBetter and change < -tolerance) or (not higherIsBetter and change > tolerance):
+                regressions.append(f"{name}: {key} {old:.4g} -> {new:.4g} ({change:+.0%})")
+    return regressions
+
+def print_results(results):
+    for name, result in results['scenarios'].items():
+        latency = result['detectionToRedLatency']
+        latencyText = '-' if latency is None else f"{1000 * latency:.0f} ms"
+        ticksPerSecond = result['ticksPerSecond']
+        ticksPerSecondText = '-' if ticksPerSecond is None else f"{ticksPerSecond:.0f}"
+        print(f"{name:30} {result['ticks']:5} ticks  {ticksPerSecondText:>8} ticks/s  "
+              f"{result['messagesPerTick']:6.2f} msg/tick  {result['sonarReads']:5} sonar reads  "
+              f"latency {latencyText:>8}  cpu {1000 * result['cpuTime']:.1f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.json', help='file the results are written to')
+    parser.add_argument('--baseline', help='previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative change before a regression is reported')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the fastest is kept')
+    parser.add_argument('--scenario', action='append', help='run only this scenario, may be repeated')
+    parser.add_argument('--legacy', action='store_true', help='benchmark control_tick() instead of the state machines')
+    parser.add_argument('--firmware', action='store_true', help='use the firmware shift-out SysEx path')
+    args = parser.parse_args()
+
+    fic.useStateMachines = not args.legacy
+    fic.useFirmwareShiftOut = args.firmware
+    results = run_benchmarks(args.scenario, args.repeat)
+    print_results(results)
+    with open(args.output, 'w') as resultFile:
+        json.dump(results, resultFile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = find_regressions(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
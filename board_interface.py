@@ -0,0 +1,64 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Board interface
+-------------------------------------------------------------
+Description:
+
+The subset of the pymata4 API used by finalise_integrated_code.py. A `pymata4.Pymata4`
+connection already provides every method below, so the real board is used as it is.
+`SimulatedBoard` in simulated_board.py implements the same interface without hardware.
+'''
+
+class Board:
+
+    """
+    Interface of the board passed to `connect_board()` and `main()`.
+
+    Method names and arguments follow pymata4, so a Pymata4 connection satisfies it.
+    Readings are returned pymata4 style as [value, timestamp] lists.
+    """
+
+    def set_pin_mode_digital_input(self, pinNumber, callback=None):
+        """Configures a digital input pin, optionally reporting changes to `callback`."""
+        raise NotImplementedError
+
+    def set_pin_mode_digital_output(self, pinNumber):
+        """Configures a digital output pin."""
+        raise NotImplementedError
+
+    def set_pin_mode_pwm_output(self, pinNumber):
+        """Configures a PWM output pin, used for the PA1 buzzer."""
+        raise NotImplementedError
+
+    def set_pin_mode_sonar(self, triggerPin, echoPin, callback=None, timeout=80000):
+        """Configures an ultrasonic sensor, optionally reporting distances to `callback`."""
+        raise NotImplementedError
+
+    def digital_write(self, pin, value):
+        """Sets a digital output pin to 0 or 1."""
+        raise NotImplementedError
+
+    def digital_read(self, pin):
+        """Returns [value, timestamp] of a digital input pin."""
+        raise NotImplementedError
+
+    def sonar_read(self, triggerPin):
+        """Returns [distance in cm, timestamp] of an ultrasonic sensor."""
+        raise NotImplementedError
+
+    def play_tone(self, pinNumber, frequency, duration):
+        """Plays a tone of `frequency` Hz for `duration` ms."""
+        raise NotImplementedError
+
+    def play_tone_off(self, pinNumber):
+        """Stops the tone on a pin."""
+        raise NotImplementedError
+
+    def shutdown(self):
+        """Releases the board."""
+        raise NotImplementedError
+
+    def _send_sysex(self, sysexCommand, sysexData=None):
+        """Sends a SysEx message, used by the optional firmware shift-out."""
+        raise NotImplementedError
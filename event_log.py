@@ -0,0 +1,176 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Structured event log
+-------------------------------------------------------------
+Description:
+
+A buffered log of typed events for the traffic system, replacing the lines it used to print
+every tick. Every event is one JSON line with its timestamp, level, event name and fields,
+e.g. {"t": 1000.5, "level": "INFO", "event": "subsystem_done", "subsystem": 1}.
+
+`EventLog.emit()` only appends the record to an in-memory buffer, so logging never blocks the
+control loop on the terminal or the disk. A writer thread takes the buffered records in batches,
+writes each batch with a single call, rotates the file once it grows past `maxBytes` and echoes
+the records at or above `consoleLevel` to the terminal. Records below both levels are dropped
+by `emit()` before anything is built.
+'''
+
+from collections import deque
+import json
+import os
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+levelNames = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+OFF = ERROR + 10 # as a level, turns the file or the console output off
+
+class EventLog:
+
+    """
+    Buffered JSON-lines event log with a background writer, rotation and levels.
+
+    Parameters:
+    path (str): File the events are written to, None to keep them in memory only.
+    level (int): Lowest level written to the file.
+    consoleLevel (int): Lowest level echoed to the terminal, `OFF` for none.
+    maxBytes (int): Size after which the file is rotated to path.1, path.2, ...
+    backups (int): Number of rotated files kept.
+    flushInterval (float): Longest time in seconds a record waits in the buffer.
+    batchSize (int): Number of buffered records that wakes the writer before `flushInterval`.
+    bufferSize (int): Records buffered at most, the oldest are dropped if the writer falls behind.
+    recentSize (int): Number of the latest records kept in `recent` for in-process inspection.
+    """
+
+    def __init__(self, path='events.jsonl', level=INFO, consoleLevel=INFO, maxBytes=1000000, backups=3,
+                 flushInterval=0.5, batchSize=256, bufferSize=10000, recentSize=200):
+        self.path = path
+        self.level = level
+        self.consoleLevel = consoleLevel
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self.pending = deque(maxlen=bufferSize)
+        self.recent = deque(maxlen=recentSize)
+        self.dropped = 0
+        self.written = 0
+        self.logFile = None
+        self.writer = None
+        self.stopping = False
+        self.wake = threading.Event()
+        self.writeLock = threading.Lock()
+
+    def enabled(self, level):
+        """Returns True if events of `level` are written to the file or echoed to the terminal."""
+        return level >= self.level or level >= self.consoleLevel
+
+    def emit(self, level, event, timestamp, **fields):
+
+        """
+        Buffers one event. Never waits for the terminal or the disk.
+
+        Parameters:
+        level (int): DEBUG, INFO, WARNING or ERROR.
+        event (str): Name of the event, e.g. "subsystem_start".
+        timestamp (float): When the event happened.
+        **fields: Values describing the event, e.g. subsystem=1 or distance=7.5.
+
+        Returns:
+        None
+        """
+
+        if level < self.level and level < self.consoleLevel:
+            return
+        record = {'t': timestamp, 'level': levelNames.get(level, level), 'event': event}
+        record.update(fields)
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append((level, record))
+        self.recent.append(record)
+        if len(self.pending) >= self.batchSize:
+            self.wake.set()
+
+    def start(self):
+        """Starts the writer thread, if not running yet."""
+        if self.writer is not None and self.writer.is_alive():
+            return
+        self.stopping = False
+        self.writer = threading.Thread(target=self.write_loop, name='event-log-writer', daemon=True)
+        self.writer.start()
+
+    def write_loop(self):
+        """Writes the buffered records every `flushInterval` seconds, or sooner when a batch is full."""
+        while not self.stopping:
+            self.wake.wait(self.flushInterval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+
+        """
+        Writes every buffered record now, on the calling thread.
+
+        Parameters:
+        None
+
+        Returns:
+        int: The number of records taken from the buffer.
+        """
+
+        with self.writeLock:
+            batch = []
+            while len(self.pending) > 0:
+                batch.append(self.pending.popleft())
+            if len(batch) == 0:
+                return 0
+
+            lines = [json.dumps(record, separators=(',', ':')) for level, record in batch if level >= self.level]
+            if self.path is not None and len(lines) > 0:
+                if self.logFile is None:
+                    self.logFile = open(self.path, 'a')
+                self.logFile.write('\n'.join(lines) + '\n')
+                self.logFile.flush()
+                self.written += len(lines)
+                if self.logFile.tell() >= self.maxBytes:
+                    self.rotate()
+
+            for level, record in batch:
+                if level >= self.consoleLevel:
+                    print(format_record(record))
+            return len(batch)
+
+    def rotate(self):
+        """Moves the current file to path.1, shifting older files up and deleting the oldest."""
+        self.logFile.close()
+        self.logFile = None
+        for index in range(self.backups, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index}")
+
+    def close(self):
+        """Stops the writer thread, writes what is still buffered and closes the file."""
+        self.stopping = True
+        self.wake.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        self.flush()
+        with self.writeLock:
+            if self.logFile is not None:
+                self.logFile.close()
+                self.logFile = None
+
+def format_record(record):
+    """Returns the terminal line of a record: its event name followed by its fields."""
+    fields = ' '.join(f"{name}={value}" for name, value in record.items() if name not in ('t', 'level', 'event'))
+    return f"[{record['level']}] {record['event']} {fields}".rstrip()
+
+def read_events(path):
+    """Reads the records of an event log file back, in order."""
+    with open(path) as logFile:
+        return [json.loads(line) for line in logFile if line.strip()]
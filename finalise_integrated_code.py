@@ -47,12 +47,24 @@ Subsystem 4 Tunnel Height Detection Subsystem which detects over height vehicles
 
 '''
 
-from pymata4 import pymata4
+from collections import deque
+import contextlib
+import threading
 import time
 
-board = pymata4.Pymata4()
+from event_log import EventLog, DEBUG, INFO, WARNING, ERROR
+from state_machine import StateMachine, Transition
+from virtual_clock import realClock
 
-time.sleep(2)
+# the board is connected by connect_board(), so importing this module never opens a serial port
+board = None
+
+# source of every timestamp, sleep and wake event of the system, see use_clock()
+clock = realClock
+
+arduinoWait = 4 # seconds pymata4 waits for the Arduino to reset after opening the serial port
+readyDelay = 0 # seconds the initial pattern is shown before "Ready", the original program waited 1 s
+startupTimes = {} # seconds spent in every startup stage, see report_startup()
 
 # set pin numbers
 
@@ -89,21 +101,55 @@ redPL1 = 4 #QD
 greenTL4 = 5 #QC
 yellowTL4  = 6 #QB
 redTL4 = 7 #QA
-stateShiftRegister2 = [0]*8
+
+# a register state is one byte, QH (shifted out first) being the most significant bit,
+# the masks redTL3Bit ... redTL4Bit of the bits above are built by build_derived_state()
+stateShiftRegister2 = 0 # steady state of shift register 2, changed with update_register2()
+
+# the patterns shown in every phase, written QH to QA like the sequences they replace
+allOff = 0b00000000
+reg1Normal = 0b01001000
+reg1Stopping = 0b01000101
+reg1Warning = 0b00100011
+reg1Flashing = 0b00010011 # QH flashes on top
+reg2Normal = 0b01001100
+reg3Normal = 0b00100000
+reg3Entry = 0b01000000
+reg3Merge = 0b10000000
+reg3Flashing = 0b00000000 # QH flashes on top
+
+# optional firmware shift-out: one SysEx message per write instead of 26 digital writes per register,
+# needs the handler in firmware/shift_out_sysex.h added to FirmataExpress on the Arduino
+useFirmwareShiftOut = False
+SHIFT_OUT_SYSEX = 0x0A
+OUTPUT_PINS_SYSEX = 0x0B # sets up all shift register pins in one message, handled in the same firmware file
+# shiftRegisterPins maps every register to its (data, clock, latch) pins, built by build_derived_state()
+
+# shadow copy of the pattern last latched on shift registers 1-3, None until first written
+latchedRegisters = {1: None, 2: None, 3: None}
+ledWritesIssued = 0
+ledWritesSuppressed = 0
+
+# shadow copy of the buzzer on PA1: the (frequency, duration) of the tone last sent, TONE_OFF once
+# silenced, None until first written; latchedToneEndsAt is when that tone stops by itself
+TONE_OFF = (0, 0)
+latchedTone = None
+latchedToneEndsAt = 0.0
+
+# patterns staged while a frame is open, latched together when the outermost frame closes (see led_frame())
+stagedRegisters = {}
+frameDepth = 0
 
 # initial state for all boolean flag
 firstTimeSub1 = False
 firstTimeSub2 = False
 firstTimeSub3 = False
 firstTimeSub4 = False
-startTime = time.time()
+startTime = clock.time()
 
 lastState = 0
 iteration = 0
-iteration1 = 0
 iteration2 = 0
-iteration3 = 0
-iteration4 = 0
 runningSub1 = False 
 runningSub2 = False
 runningSub3 = False 
@@ -118,733 +164,1219 @@ overheightVechicleExitedUS2 = False
 overheightVechicleExitedUS3 = False
 override4I3Active = False
 readyToReset4I3 = False
+objectDistanceUS1 = None
+objectDistanceUS2 = None
+objectDistanceUS3 = None
+
+# start times of the running subsystems and the control loop period
+startTime1 = 0
+startTime2 = 0
+startTime3 = 0
+startTime4 = 0
+startTime3I2 = 0
+running3I2 = False
+timePrevious2 = 0
+lastState2 = 0
+
+# deadline scheduler: phase boundaries in seconds after each subsystem's start time
+phaseBoundariesSub1 = (1, 2, 32)
+phaseBoundariesSub2 = (2, 4, 7, 9)
+phaseBoundariesSub3 = (2, 7)
+phaseBoundaries3I2 = (2, 7)
+pedestrianLockout = 30 # seconds before PB1 can start subsystem 2 again
+blinkPeriod = 0.6 # seconds for one on/off cycle of every flashing light
+idleWait = 1.0 # longest sleep when nothing is due, sensor and button events wake the loop earlier
+deadlineSlack = 0.001 # wake just after a boundary so strict comparisons like 2 < timeDiff hold
+wakeEvent = clock.event()
+
+# run the subsystems as table-driven state machines instead of control_tick()
+useStateMachines = True
+
+# set by instrumentation.enable(), None while instrumentation is disabled
+metrics = None
+
+# structured event log replacing the printed messages, started by connect_board()
+eventLogPath = 'events.jsonl' # None to keep the events in memory only
+eventLogLevel = INFO # lowest level written to eventLogPath, DEBUG adds the per-tick events
+consoleLevel = INFO # lowest level echoed to the terminal, OFF for none
+eventLog = None
+
+# set by trace_replay.start_recording(), every board connected while it is set is recorded
+traceRecorder = None
+
+detectionThreshold = 10 # 10cm, a vehicle closer than this is detected
+exitThreshold = 12 # cm, a detected vehicle further than this has left
+enterDwell = 0.1 # seconds a vehicle must stay within detectionThreshold before it is detected
+exitDwell = 0.5 # seconds a vehicle must stay beyond exitThreshold before it has left
+
+# streaming distance filter of every ultrasonic sensor, fed by pymata4 callbacks or by polling
+filterAlpha = 0.5 # weight of a new sample in the moving average
+outlierGate = 8 # cm a sample may differ from the filtered distance before it is treated as an outlier
+confirmTime = 0.1 # seconds an outlier must persist, without a contradicting report, to be accepted
+sonarLock = threading.Lock()
+
+# entries detected by sonar_callback() are latched until refresh_state() sees them
+sonarEnteredLatch = {1: False, 2: False, 3: False}
+
+# vehicle tracking across US1, US2 and US3 from the raw sensor samples, see vehicle_tracking.py (needs NumPy)
+useVehicleTracking = False # track every vehicle while a board is connected, off by default so NumPy stays optional
+predictiveTrigger = False # detect a vehicle at US1 as soon as the tracker predicts its arrival, without the dwell time
+predictionHorizon = 0.2 # seconds ahead an arrival at US1 is predicted
+minClosingRate = 20 # cm/s the US1 distance must fall at before an arrival is predicted
+sensorMountHeight = 30 # cm between the sensors and the road of the prototype
+scaleRatio = 20 # 20:1 (real : prototype) ratio
+sensorPositions = {1: 0, 2: 20, 3: 40} # cm of every sensor along the road of the prototype
+vehicleTracker = None # set by connect_board() if useVehicleTracking is set, fed every raw sample by track_sample()
+predictedEntryDeadline = None # a predicted detection at US1 is cancelled unless US1 measures the vehicle before this timestamp
+predictionCancelled = False # True after a refresh_state() that cancelled a predicted detection at US1
+
+# PB1 presses reported by button_callback(), debounced and queued until a tick handles them
+buttonDebounce = 0.02 # seconds after an accepted PB1 change during which further changes are contact bounce
+buttonLock = threading.Lock()
+buttonReporting = False # True once PB1 reports through its callback, until then it is polled
+buttonLevel = 0 # debounced PB1 state
+buttonChangedAt = None # timestamp of the last accepted PB1 change
+buttonReported = 0 # last PB1 state reported by button_callback(), accepted by settle_button() if it arrived as bounce
+crossingRequests = deque(maxlen=16) # timestamps of presses not yet handled by a tick
+crossingRequested = False # True during a tick that handles at least one press
+
+class DistanceFilter:
 
-# set pin modes
-board.set_pin_mode_digital_input(pb1)
-board.set_pin_mode_pwm_output(pb2)
+    """
+    Incremental filter of one ultrasonic sensor: an exponential moving average with outlier gating.
 
-board.set_pin_mode_sonar(us1Trig, us1Echo)
-board.set_pin_mode_sonar(us2Trig, us2Echo)
-board.set_pin_mode_sonar(us3Trig, us3Echo)
+    Every sample costs O(1) and the filtered distance is always available, so reading it
+    never needs a burst of sensor reads. A sample within `outlierGate` of the filtered distance
+    is averaged in. A sample further away, or an invalid (missing or non-positive) one, is held
+    as a candidate and only accepted once it is confirmed, either by the next sample agreeing
+    with it or by `confirmTime` passing without a contradicting sample. pymata4 only reports a
+    sonar when its distance changes, so a single spurious echo is followed by a report of the
+    true distance and never reaches `detectionThreshold`, while a vehicle that stays is accepted.
 
-board.set_pin_mode_digital_input(us1Echo)
-board.set_pin_mode_digital_input(us2Echo)
-board.set_pin_mode_digital_input(us3Echo)
+    Parameters:
+    alpha (float): Weight of a new sample in the moving average.
+    gate (float): Largest difference in cm between a sample and the filtered distance that is averaged in.
+    confirmTime (float): Seconds after which an unchallenged candidate is accepted.
+    """
 
-board.set_pin_mode_digital_output(serialPin1)
-board.set_pin_mode_digital_output(rclkPin1)
-board.set_pin_mode_digital_output(srclkPin1)
+    def __init__(self, alpha=0.5, gate=8, confirmTime=0.1):
+        self.alpha = alpha
+        self.gate = gate
+        self.confirmTime = confirmTime
+        self.reset()
+
+    def reset(self):
+        """Forgets every sample, e.g. when a new board is connected."""
+        self.estimate = None
+        self.candidate = None
+        self.candidateAt = None
+        self.samples = 0
+        self.rejected = 0
+        self.reporting = False
+
+    def agrees(self, first, second):
+        """Returns True if two samples are the same distance within the gate, two invalid samples agree."""
+        if first is None or second is None:
+            return first is None and second is None
+        return abs(first - second) <= self.gate
+
+    def add(self, distance, timestamp):
+
+        """
+        Feeds one sample to the filter.
+
+        Parameters:
+        distance (float): The measured distance in cm, None or non-positive if the sensor gave no echo.
+        timestamp (float): When the sample was measured.
+
+        Returns:
+        float or None: The filtered distance after the sample.
+        """
+
+        if distance is not None and distance <= 0:
+            distance = None
+        self.samples += 1
 
-board.set_pin_mode_digital_output(serialPin2)
-board.set_pin_mode_digital_output(rclkPin2)
-board.set_pin_mode_digital_output(srclkPin2)
+        if self.samples == 1 or self.agrees(distance, self.estimate):
+            if distance is None or self.estimate is None:
+                self.estimate = distance
+            else:
+                self.estimate += self.alpha * (distance - self.estimate)
+            self.candidate = None
+            self.candidateAt = None
+        elif self.candidateAt is not None and self.agrees(distance, self.candidate):
+            # a second sample confirms the jump, e.g. a vehicle arriving
+            self.estimate = distance
+            self.candidate = None
+            self.candidateAt = None
+        else:
+            self.rejected += 1
+            self.candidate = distance
+            self.candidateAt = timestamp
+        return self.estimate
 
-board.set_pin_mode_digital_output(serialPin3)
-board.set_pin_mode_digital_output(rclkPin3)
-board.set_pin_mode_digital_output(srclkPin3)
+    def confirm_deadline(self):
+        """Returns when the pending candidate will be accepted, or None if there is none."""
+        if self.candidateAt is None:
+            return None
+        return self.candidateAt + self.confirmTime
 
-board.digital_write(serialPin1, 0)
-board.digital_write(rclkPin1, 0)
-board.digital_write(srclkPin1, 0)
+    def value(self, now):
+        """Returns the filtered distance at `now`, accepting a candidate that persisted for `confirmTime`."""
+        if self.candidateAt is not None and now - self.candidateAt >= self.confirmTime:
+            self.estimate = self.candidate
+            self.candidate = None
+            self.candidateAt = None
+        return self.estimate
 
-board.digital_write(serialPin2, 0)
-board.digital_write(rclkPin2, 0)
-board.digital_write(srclkPin2, 0)
+# distanceFilters, one DistanceFilter per sensor, are built by build_derived_state()
 
-board.digital_write(serialPin3, 0)
-board.digital_write(rclkPin3, 0)
-board.digital_write(srclkPin3, 0)
+class VehicleDetector:
 
-detectionThreshold = 10 # 10cm 
+    """
+    Turns the filtered distance of one ultrasonic sensor into a stable "vehicle detected" state.
 
-def main(startTime):
+    A vehicle is detected once its distance stays below `enterThreshold` for `enterDwell`
+    seconds. It has left once the distance stays above `exitThreshold` (or the sensor gives
+    no echo) for `exitDwell` seconds. Between the two thresholds the state does not change,
+    so a distance hovering around the threshold no longer flips the detection every tick.
+    Every change of state is reported once as an "entered" or "exited" edge.
 
+    Parameters:
+    enterThreshold (float): Distance in cm below which a vehicle starts to be detected.
+    exitThreshold (float): Distance in cm above which a detected vehicle starts to leave.
+    enterDwell (float): Seconds the distance must stay below `enterThreshold`.
+    exitDwell (float): Seconds the distance must stay above `exitThreshold`.
     """
-    Main function to control the vehicle height detection and traffic management system.
 
-    This function initializes system states and enters an infinite loop where it:
-    - Monitors ultrasonic sensors for vehicle height detection.
-    - Activates corresponding subsystems based on sensor input.
-    - Manages override logic and reset conditions.
-    - Handles subsystem-specific triggers and state transitions.
-    - Supports interruption by keyboard to shut down hardware safely.
+    def __init__(self, enterThreshold=10, exitThreshold=12, enterDwell=0.1, exitDwell=0.5):
+        self.enterThreshold = enterThreshold
+        self.exitThreshold = exitThreshold
+        self.enterDwell = enterDwell
+        self.exitDwell = exitDwell
+        self.reset()
 
-    Parameters:
-    startTime (float): The system start time used for time-based logic and delays.
+    def reset(self):
+        """Returns to "nothing detected" and forgets a pending change."""
+        self.detected = False
+        self.pendingSince = None
+        self.edges = 0
 
-    Returns:
-    None
-    """
+    def update(self, distance, now):
 
-    try:
-        global runningSub1, overheightVechicleAtUS1, overheightVechicleExitedUS1 
-        global runningSub2, timePrevious2, lastState2, running3I2, startTime3I2
-        global runningSub3, overheightVechicleAtUS3, overheightVechicleExitedUS3 
-        global runningSub4, overheightVechicleAtUS2, overheightVechicleExitedUS2, override4I3Active
-        global firstTimeSub1, firstTimeSub2, firstTimeSub3, firstTimeSub4
-        
-        running3I2 = False
-        timePrevious2 = 0
-        lastState2 = 0
-        starting()
-        time.sleep(1)
+        """
+        Feeds the current filtered distance to the detector.
 
-        print("Ready")
+        Parameters:
+        distance (float): The filtered distance in cm, None if the sensor gives no echo.
+        now (float): The timestamp of the distance.
 
-        while True: 
-            refresh_state()
-            check_reset_4I3()
-            time.sleep(0.3)
-
-            objectDistanceUS1 = get_distance(us1Trig, 1)
-            objectDistanceUS2 = get_distance(us2Trig, 2)
-            objectDistanceUS3 = get_distance(us3Trig, 3)
-
-            if not runningSub1 and  not runningSub2 and not runningSub3 and not runningSub4:
-                print("Call initial")
-                starting()
-            
-            if overheightVechicleAtUS1 or runningSub1 == True:
-                if not runningSub1:
-                    runningSub1 = True
-                    startTime1 = time.time()
-
-                subsystem1(startTime1)  
-
-                refresh_state()
-                    
-                if overheightVechicleAtUS3 or runningSub3 == True:
-                    if not runningSub3:
-                        runningSub3 = True 
-                        startTime3 = time.time()
-                  
-                    subsystem1(startTime1)
-                    subsystem3(startTime3)
-
-                    refresh_state()
-
-                    if overheightVechicleExitedUS3 and runningSub1 == True and not overheightVechicleAtUS1:
-                        runningSub1 = False 
-                        board.play_tone_off(pb2)
-                        starting_sub1()
-                        
-                refresh_state()
-
-            if overheightVechicleAtUS2:                       
-                objectdistance = get_distance(us2Trig,2)
-                if (objectdistance is not None and objectdistance <= detectionThreshold) or runningSub4 == True:
-                    if not runningSub4:
-                        runningSub4 = True
-                        startTime4 = time.time()
-                    subsystem4(startTime4)
-
-            if overheightVechicleAtUS3 or runningSub3 == True:
-                if not runningSub3:
-                    runningSub3 = True 
-                    startTime3 = time.time()
-                subsystem3(startTime3)
-
-            if (read_push_button() == True and time.time() - timePrevious2> 30 and lastState2 == 0) or runningSub2 == True: 
-                if not runningSub2:
-                    runningSub2 = True
-                    startTime2 = time.time()
-                    iteration = 0
-                subsystem2(startTime2)
-            
-            if running3I2 == True:
-                sub3i2(startTime3I2)
+        Returns:
+        str or None: "entered" or "exited" if the detection changed, otherwise None.
+        """
 
-    except KeyboardInterrupt:
-        ending() 
-        time.sleep(0.5)
-        board.shutdown()
-        print("Shutting down system.")
+        if self.detected:
+            wantsChange = distance is None or distance > self.exitThreshold
+            dwell = self.exitDwell
+        else:
+            wantsChange = distance is not None and distance < self.enterThreshold
+            dwell = self.enterDwell
+
+        if not wantsChange:
+            self.pendingSince = None
+            return None
+        if self.pendingSince is None:
+            self.pendingSince = now
+        if now - self.pendingSince < dwell:
+            return None
+
+        self.detected = not self.detected
+        self.pendingSince = None
+        self.edges += 1
+        return 'entered' if self.detected else 'exited'
+
+    def confirm_entry(self):
+        """Detects a vehicle now without waiting for the dwell time, e.g. when its arrival was predicted. Returns "entered", or None if already detected."""
+        if self.detected:
+            return None
+        self.detected = True
+        self.pendingSince = None
+        self.edges += 1
+        return 'entered'
+
+    def cancel_entry(self):
+        """Forgets a detection that was confirmed by `confirm_entry()` but never measured, without counting an edge."""
+        self.detected = False
+        self.pendingSince = None
+
+    def dwell_deadline(self):
+        """Returns when a pending change completes its dwell time, or None if no change is pending."""
+        if self.pendingSince is None:
+            return None
+        return self.pendingSince + (self.exitDwell if self.detected else self.enterDwell)
+
+# vehicleDetectors, one VehicleDetector per sensor, are built by build_derived_state()
+
+# adaptive sampling rate of the ultrasonic sensors, see SamplingPolicy
+idleSampleInterval = 1.0 # seconds between two samples of US1 while the junction is quiet
+standbySampleInterval = 2.0 # seconds between two samples of US2 and US3 while the tunnel is empty
+fastSampleInterval = 0.1 # seconds between two samples of a sensor that is watched closely
+approachMargin = 10 # cm beyond detectionThreshold in which a closing distance is watched closely
+
+class SamplingPolicy:
+
+    """
+    Decides how often every ultrasonic sensor is sampled, from the activity of the junction.
+
+    - A quiet junction mostly watches its entrance: US1 is sampled every `idleInterval`
+      seconds, US2 and US3 only every `standbyInterval` seconds, which still starts
+      subsystems 3 and 4 for a vehicle they see on their own.
+    - US1 is sampled every `fastInterval` seconds while subsystem 1 runs. US2 and US3 are
+      sampled that fast while subsystem 1 or 3 runs, as the vehicle is then in the tunnel,
+      and US2 also while subsystem 4 runs.
+    - Any sensor is sampled every `fastInterval` seconds while its distance closes in on
+      `detectionThreshold` (within `margin` cm), or while its filter or detector has a
+      change pending.
+
+    A sensor reporting through `sonar_callback()` is read for free, so it is also read as soon
+    as its filter has a new report. The intervals then only bound how old its reading gets.
+
+    Parameters:
+    idleInterval (float): Seconds between two samples of US1 on a quiet junction.
+    standbyInterval (float): Seconds between two samples of US2 and US3 while the tunnel is empty.
+    fastInterval (float): Seconds between two samples of a sensor that is watched closely.
+    margin (float): Distance in cm beyond `detectionThreshold` in which a closing distance is watched closely.
+    """
 
-def led_display(seq, regNum):
+    def __init__(self, idleInterval=1.0, standbyInterval=2.0, fastInterval=0.1, margin=10):
+        self.idleInterval = idleInterval
+        self.standbyInterval = standbyInterval
+        self.fastInterval = fastInterval
+        self.margin = margin
+        self.reset()
+
+    def reset(self):
+        """Forgets the trend of every sensor, e.g. when a new board is connected."""
+        self.lastDistance = {1: None, 2: None, 3: None}
+        self.closing = {1: False, 2: False, 3: False}
+        self.samplesSeen = {1: 0, 2: 0, 3: 0}
+
+    def observe(self, sensorNum, distance):
+        """Takes note of a new reading of `sensorNum`, updating whether it closes in on `detectionThreshold`."""
+        previous = self.lastDistance[sensorNum]
+        if distance is None or distance >= detectionThreshold + self.margin:
+            self.closing[sensorNum] = False
+        elif previous is None or distance < previous:
+            self.closing[sensorNum] = True
+        elif distance > previous:
+            self.closing[sensorNum] = False
+        self.lastDistance[sensorNum] = distance
+        self.samplesSeen[sensorNum] = distanceFilters[sensorNum].samples
+
+    def watching(self, sensorNum):
+        """Returns True if `sensorNum` closes in on `detectionThreshold` or has a detection or filter change pending."""
+        detector = vehicleDetectors[sensorNum]
+        return (self.closing[sensorNum] or detector.detected or detector.pendingSince is not None or
+                distanceFilters[sensorNum].candidateAt is not None)
+
+    def interval(self, sensorNum):
+
+        """
+        Returns the current sampling interval of a sensor.
+
+        Parameters:
+        sensorNum (int): The sensor (1, 2, or 3).
+
+        Returns:
+        float: Seconds between two samples of the sensor.
+        """
+
+        if self.watching(sensorNum):
+            return self.fastInterval
+        if sensorNum == 1:
+            return self.fastInterval if runningSub1 else self.idleInterval
+        if runningSub1 or runningSub3 or (sensorNum == 2 and runningSub4):
+            return self.fastInterval
+        return self.standbyInterval
+
+    def due(self, sensorNum, sampledAt, now):
+
+        """
+        Returns True if a sensor last sampled at `sampledAt` must be sampled again at `now`.
+
+        Parameters:
+        sensorNum (int): The sensor (1, 2, or 3).
+        sampledAt (float): When the sensor was last sampled, None if never.
+        now (float): The current timestamp.
+
+        Returns:
+        bool: True if the sensor is due.
+        """
+
+        if sampledAt is None:
+            return True
+        distanceFilter = distanceFilters[sensorNum]
+        confirmDeadline = distanceFilter.confirm_deadline()
+        if confirmDeadline is not None and now >= confirmDeadline:
+            return True
+        if distanceFilter.reporting and distanceFilter.samples != self.samplesSeen[sensorNum]:
+            return True
+        return now - sampledAt >= self.interval(sensorNum)
+
+# samplingPolicy is built by build_derived_state()
+
+def sonar_callback(data):
 
     """
-    Displays a binary sequence on a specified shift register for LED output.
+    Receives a sonar report from pymata4 and feeds it to the sensor's `DistanceFilter`.
+
+    The sensor's `VehicleDetector` is updated as soon as the report arrives, so detection latency
+    is bounded by the sonar report period rather than by the main loop. A jump in distance
+    counts once the filter confirms it, see `DistanceFilter`, or as soon as `vehicleTracker`
+    predicts the arrival of a vehicle at US1 (see `track_sample()`). A new detection is latched
+    until `refresh_state()` consumes it, so short detections are never lost, and every detection
+    edge wakes the control loop through `wakeEvent`.
 
-    This function writes a sequence of binary values to one of three shift registers
-    (1, 2, or 3), each connected to an LED array. It uses serial communication to 
-    shift data into the register and latch the output.
+    FirmataExpress pings the sensors itself, one at a time in turn, once per sonar scan
+    interval, so the echo of one sensor never reaches another and the pings need no
+    spacing here. Reading a sensor with `sonar_read()` returns its last report and pings nothing.
 
     Parameters:
-    seq (list of int): A list of 0s and 1s representing the binary sequence to display.
-    regNum (int): The register number (1, 2, or 3) that selects which LED shift register to control.
+    data (list): pymata4 sonar report [pin type, trigger pin, distance in cm, timestamp].
 
     Returns:
     None
     """
 
-    if regNum == 1:
-        for index in range(len(seq)):
-            board.digital_write(serialPin1, seq[index]) 
-            board.digital_write(srclkPin1, 1)
-            board.digital_write(srclkPin1, 0)
-        board.digital_write(rclkPin1, 1)
-        board.digital_write(rclkPin1, 0)
-    elif regNum == 2:
-        for index in range(len(seq)):
-            board.digital_write(serialPin2, seq[index]) 
-            board.digital_write(srclkPin2, 1)
-            board.digital_write(srclkPin2, 0)
-        board.digital_write(rclkPin2, 1)
-        board.digital_write(rclkPin2, 0)
-    elif regNum == 3:
-        for index in range(len(seq)):
-            board.digital_write(serialPin3, seq[index]) 
-            board.digital_write(srclkPin3, 1)
-            board.digital_write(srclkPin3, 0)
-        board.digital_write(rclkPin3, 1)
-        board.digital_write(rclkPin3, 0)
-    else:
-        print("Invalid shift register number.")
+    sensorNum = sensorNums[data[1]]
+    with sonarLock:
+        distanceFilter = distanceFilters[sensorNum]
+        distanceFilter.reporting = True
+        distanceFilter.add(data[2], data[3])
+        distance = distanceFilter.value(clock.time())
+        edge = vehicleDetectors[sensorNum].update(distance, data[3])
+        edge = track_sample(sensorNum, data[2], data[3]) or edge
+        if edge == 'entered':
+            sonarEnteredLatch[sensorNum] = True
+
+    if edge is not None:
+        wakeEvent.set()
 
-def get_distance(trigPin, trigPinNum, samples=7):
+def track_sample(sensorNum, distance, timestamp):
 
     """
-    Measures distance using an ultrasonic sensor with multiple samples for accuracy.
+    Feeds a raw sample to `vehicleTracker` and detects a vehicle at US1 as soon as its arrival is predicted.
 
-    This function reads distance data from one of three ultrasonic sensors based on
-    the trigger pin number. It performs multiple readings and returns the average
-    of valid measurements to reduce noise and increase reliability.
+    With `predictiveTrigger` set, a vehicle predicted by `VehicleTracker.predict_arrival()` is
+    detected by the US1 detector right away instead of after `enterDwell`, so TL1 and TL2 turn
+    red earlier for a fast vehicle. Unless US1 measures the vehicle below `detectionThreshold`
+    within `predictionHorizon` seconds, `check_predicted_entry()` cancels the detection again.
+    Must be called with `sonarLock` held.
 
     Parameters:
-    trigPin (int): The trigger pin for the ultrasonic sensor (not directly used in logic).
-    trigPinNum (int): Identifier for selecting the sensor (1, 2, or 3).
-    samples (int): Number of samples to take for averaging (default is 7).
+    sensorNum (int): The sensor (1, 2, or 3).
+    distance (float): The raw distance in cm, None or non-positive if the sensor gave no echo.
+    timestamp (float): When the sample was measured.
 
     Returns:
-    float or None: The averaged distance reading if at least 3 valid samples are available;
-                   otherwise, returns None.
+    str or None: "entered" if the prediction detected a vehicle at US1, otherwise None.
     """
 
-    readings = []
-    for item in range(samples):
-        if trigPinNum == 1:
-            distance = board.sonar_read(us1Trig)[0]
-        elif trigPinNum == 2:
-            distance = board.sonar_read(us2Trig)[0]
-        elif trigPinNum == 3:
-            distance = board.sonar_read(us3Trig)[0]
-        else:
-            distance = None
-        if distance is not None and distance > 0:
-            readings.append(distance)
-    if len(readings) >= 3:
-        return sum(readings)/len(readings)
-    else:
+    global predictedEntryDeadline
+
+    if vehicleTracker is None:
+        return None
+    vehicleTracker.add_sample(sensorNum, distance, timestamp)
+    if not predictiveTrigger or sensorNum != 1 or vehicleDetectors[1].detected:
         return None
 
-def starting():
+    arrival = vehicleTracker.predict_arrival(timestamp)
+    if arrival is None:
+        return None
+    closingRate = vehicleTracker.closing_rate(timestamp)
+    log_event(INFO, 'vehicle_predicted', sensor=1, distance=distance, arrival=round(arrival, 3),
+              closingRate=None if closingRate is None else round(closingRate, 1))
+    edge = vehicleDetectors[1].confirm_entry()
+    if edge == 'entered':
+        predictedEntryDeadline = timestamp + predictionHorizon
+    return edge
+
+def check_predicted_entry(now):
 
     """
-    Initializes the system state and resets all subsystem indicators.
+    Cancels a predicted detection at US1 if the vehicle was not measured within `predictionHorizon`.
 
-    This function performs the following tasks:
-    - Turns off the tone for subsystem 1.
-    - Displays initial LED patterns for all three shift registers, representing subsystems 1 to 4.
-    - Resets all iteration counters and first-time flags for the subsystems.
+    A prediction is confirmed as soon as `vehicleTracker` sees a raw US1 sample below
+    `detectionThreshold`. Otherwise the US1 detector forgets the vehicle once
+    `predictedEntryDeadline` has passed, so a vehicle that slowed down or turned away
+    does not hold subsystem 1. Must be called with `sonarLock` held.
 
     Parameters:
-    None
+    now (float): The current timestamp.
 
     Returns:
-    None
+    bool: True if the predicted detection was cancelled.
     """
-        
-    global iteration1, iteration2, iteration3, iteration4
-    #sub 1
-    board.play_tone_off(pb2)
-    led_display([0,1,0,0,1,0,0,0],1)
-    #sub 2 & 4
-    led_display([0,1,0,0,1,1,0,0],2)
-    #sub 3
-    led_display([0,0,1,0,0,0,0,0],3)
-    iteration1 = 0
-    iteration2 = 0
-    iteration3 = 0
-    iteration4 = 0
-    firstTimeSub1 = False
-    firstTimeSub2 = False
-    firstTimeSub3 = False
-    firstTimeSub4 = False
 
-def ending():
+    global predictedEntryDeadline
+
+    if predictedEntryDeadline is None:
+        return False
+    if vehicleTracker is None or vehicleTracker.present[1] or not vehicleDetectors[1].detected:
+        predictedEntryDeadline = None
+        return False
+    if now < predictedEntryDeadline:
+        return False
+    predictedEntryDeadline = None
+    vehicleDetectors[1].cancel_entry()
+    return True
+
+def vehicle_height(sensorNum, distance):
 
     """
-    Shuts down all subsystems by clearing LED displays and stopping sound.
+    Returns the real height in metres of the vehicle under a sensor.
 
-    This function performs the following shutdown actions:
-    - Turns off any sound playing through the speaker 
-    - Clears all LED outputs on shift registers 1, 2, and 3 by sending zeroed patterns.
+    The tracked height profile is used when `vehicleTracker` has one, otherwise the height is
+    computed from the given distance.
 
     Parameters:
-    None
+    sensorNum (int): The sensor (1, 2, or 3).
+    distance (float): The distance of the vehicle in cm, None if unknown.
 
     Returns:
-    None
+    float or None: The height, None if neither the tracker nor the distance gives one.
     """
 
-    board.play_tone_off(pb2)
-    led_display([0,0,0,0,0,0,0,0],1) 
-    led_display([0,0,0,0,0,0,0,0],2) 
-    led_display([0,0,0,0,0,0,0,0],3) 
+    if vehicleTracker is not None:
+        with sonarLock:
+            height = vehicleTracker.current_height(sensorNum, clock.time())
+        if height is not None:
+            return height
+    if distance is None:
+        return None
+    return (sensorMountHeight - distance)*scaleRatio / 100
 
-def read_push_button():
+def start_vehicle_tracking():
+    """Starts tracking vehicles with a new `vehicle_tracking.VehicleTracker`, forgetting any previous track."""
+    global vehicleTracker
+    import vehicle_tracking
+    vehicleTracker = vehicle_tracking.VehicleTracker(
+        detectionThreshold, exitThreshold, detectionThreshold + approachMargin, sensorMountHeight, scaleRatio,
+        sensorPositions, horizon=predictionHorizon, minClosingRate=minClosingRate, tolerance=outlierGate)
+
+def button_callback(data):
 
     """
-    Reads the state of a digital push button.
+    Receives a PB1 change from pymata4, debounces it and queues every press as a crossing request.
 
-    This function checks the digital state of the push button connected to pin PB1.
-    If the button is pressed (HIGH signal), it returns True. Otherwise, it returns False.
+    A change within `buttonDebounce` seconds of the last accepted change is contact bounce
+    and not accepted yet. If PB1 still reports that state when the debounce window ends,
+    `settle_button()` accepts it then, so the release of a short tap is never lost. An accepted press is queued in `crossingRequests` with its timestamp, so it
+    is never missed however long the control loop is busy, and wakes the control loop
+    so it is handled straight away. An accepted release re-arms the pedestrian crossing
+    (`lastState2`), which stays disarmed while PB1 is still held when subsystem 2 ends.
 
     Parameters:
+    data (list): pymata4 digital report [pin type, pin, value, timestamp].
+
+    Returns:
     None
+    """
+
+    global buttonReporting, buttonReported
+
+    value, timestamp = data[2], data[3]
+    with buttonLock:
+        buttonReporting = True
+        buttonReported = value
+        if not accept_button_level(value, timestamp):
+            return
+
+    wakeEvent.set()
+
+def accept_button_level(value, timestamp):
+
+    """
+    Accepts a PB1 state as the debounced state unless it is contact bounce. Must be called with `buttonLock` held.
+
+    Parameters:
+    value (int): The PB1 state, 1 while held.
+    timestamp (float): When PB1 changed to `value`.
 
     Returns:
-    bool: True if the button is pressed, False otherwise.
+    bool: True if the state was accepted as a change.
     """
 
-    stateA = board.digital_read(pb1)[0]
-    
-    if stateA == 1:
-        return True
-    else:
+    global buttonLevel, buttonChangedAt, lastState2
+
+    if value == buttonLevel:
         return False
+    if buttonChangedAt is not None and timestamp < buttonChangedAt + buttonDebounce:
+        return False
+    buttonLevel = value
+    buttonChangedAt = timestamp
+    if value == 1:
+        crossingRequests.append(timestamp)
+    else:
+        lastState2 = 0
+    return True
 
-def read_all_us():
+def button_settle_deadline():
+    """Returns when the debounce window hiding the last reported PB1 state ends, or None if no state is hidden."""
+    if not buttonReporting or buttonReported == buttonLevel or buttonChangedAt is None:
+        return None
+    return buttonChangedAt + buttonDebounce
+
+def settle_button(now):
+    """Accepts the last reported PB1 state once the debounce window that hid it has ended. Must be called with `buttonLock` held."""
+    settleAt = button_settle_deadline()
+    if settleAt is not None and now >= settleAt:
+        accept_button_level(buttonReported, settleAt)
+
+def latch_crossing_requests():
 
     """
-    Reads distance measurements from all ultrasonic sensors and updates global variables.
+    Takes the PB1 presses queued since the last tick, once at the start of every tick.
 
-    This function calls `get_distance()` for each of the three ultrasonic sensors
-    (US1, US2, and US3), and stores the measured distances in corresponding global variables.
+    Every `read_push_button()` call of the tick then sees the same answer, like every
+    subsystem sees the same `sensorSnapshot`. Until PB1 reports through `button_callback()`,
+    the button is polled instead.
 
     Parameters:
     None
 
     Returns:
-    None
+    bool: True if PB1 was pressed since the last tick.
     """
 
-    global objectDistanceUS1, objectDistanceUS2, objectDistanceUS3
-    
-    objectDistanceUS1 = get_distance(us1Trig, 1)
-    objectDistanceUS2 = get_distance(us2Trig, 2)
-    objectDistanceUS3 = get_distance(us3Trig, 3)
+    global crossingRequested
 
-def refresh_state():
+    with buttonLock:
+        if buttonReporting:
+            settle_button(clock.time())
+            crossingRequested = len(crossingRequests) > 0
+            crossingRequests.clear()
+            return crossingRequested
 
-    """
-    Updates the overheight vehicle detection state for all ultrasonic sensors.
+    crossingRequested = board.digital_read(pb1)[0] == 1
+    return crossingRequested
 
-    This function performs the following:
-    - Reads the latest distances from US1, US2, and US3.
-    - Updates flags indicating whether an overheight vehicle is currently detected at each sensor.
-    - Determines whether a vehicle has exited the detection zone since the last update.
-    - Sets additional system flags such as `override4I3Active` and `readyToReset4I3` for controlling subsystem logic.
+def button_level():
+
+    """
+    Returns the debounced PB1 state, read from the board while PB1 does not report through its callback.
 
     Parameters:
     None
 
     Returns:
-    None
+    int: 1 while PB1 is held, otherwise 0.
     """
 
-    global objectDistanceUS1, objectDistanceUS2, objectDistanceUS3
-    global overheightVechicleAtUS1, overheightVechicleAtUS2, overheightVechicleAtUS3
-    global overheightVechicleExitedUS1, overheightVechicleExitedUS2, overheightVechicleExitedUS3, override4I3Active, readyToReset4I3
+    with buttonLock:
+        if buttonReporting:
+            settle_button(clock.time())
+            return buttonLevel
+    return board.digital_read(pb1)[0]
 
-    objectDistanceUS1 = get_distance(us1Trig, 1)
-    objectDistanceUS2 = get_distance(us2Trig, 2)
-    objectDistanceUS3 = get_distance(us3Trig, 3)
+# trigPins, echoPins and sensorNums map the sensors to their pins and back, built by build_derived_state()
 
-    # Track current status
-    wasUS1 = overheightVechicleAtUS1
-    wasUS2 = overheightVechicleAtUS2
-    wasUS3 = overheightVechicleAtUS3
+class SensorSnapshot:
 
-    # Update "At" flags
-    overheightVechicleAtUS1 = objectDistanceUS1 is not None and objectDistanceUS1 < detectionThreshold
-    overheightVechicleAtUS2 = objectDistanceUS2 is not None and objectDistanceUS2 < detectionThreshold
-    overheightVechicleAtUS3 = objectDistanceUS3 is not None and objectDistanceUS3 < detectionThreshold
+    """
+    Holds one filtered distance reading per ultrasonic sensor for the current control tick.
 
-    # If it was there, but now it isn't → mark as exited
-    if wasUS1 and not overheightVechicleAtUS1:
-        overheightVechicleExitedUS1 = True
-        overheightVechicleAtUS1 = False
-    else:
-        overheightVechicleExitedUS1 = False
+    Every subsystem reads distances from the snapshot instead of calling `get_distance()`
+    directly, so every sensor is read at most once per tick.
 
-    if wasUS2 and not overheightVechicleAtUS2:
-        overheightVechicleExitedUS2 = True
-        overheightVechicleAtUS2 = False
-    else:
-        overheightVechicleExitedUS2 = False
+    Staleness and invalidation rules:
+    - `refresh()` is called once at the start of every tick and re-samples the sensors that are due.
+    - A reading is stale if it was invalidated or if `samplingPolicy` says its sensor is due,
+      so every sensor is sampled at the rate the activity of the junction calls for.
+    - Reading a stale value re-samples that sensor only (e.g. after a long blocking call),
+      unless `sampleWhenStale` is False because the readings are stored by dedicated sensor tasks.
+    """
 
-    if wasUS3 and not overheightVechicleAtUS3:
-        overheightVechicleExitedUS3 = True
-        overheightVechicleAtUS3 = False
-        readyToReset4I3 = True
-    else:
-        overheightVechicleExitedUS3 = False
+    def __init__(self):
+        self.sampleWhenStale = True
+        self.tick = 0
+        self.samplesTaken = 0
+        self.samplesSkipped = 0
+        self.distances = {1: None, 2: None, 3: None}
+        self.sampledAt = {1: None, 2: None, 3: None}
+
+    def refresh(self):
+        """Starts a new tick by re-sampling every sensor that is due."""
+        self.tick += 1
+        for sensorNum in self.distances:
+            if not self.sample_if_due(sensorNum):
+                self.samplesSkipped += 1
+
+    def invalidate(self, sensorNum=None):
+        """Marks one sensor (or all sensors if `sensorNum` is None) as stale."""
+        if sensorNum is None:
+            for num in self.sampledAt:
+                self.sampledAt[num] = None
+        else:
+            self.sampledAt[sensorNum] = None
+
+    def is_stale(self, sensorNum):
+        """Returns True if the reading of `sensorNum` must be sampled again."""
+        return samplingPolicy.due(sensorNum, self.sampledAt[sensorNum], clock.time())
+
+    def next_sample(self, now):
+        """Returns when the next polled sensor is due, None if every sensor reports through its callback."""
+        deadlines = []
+        for sensorNum, sampledAt in self.sampledAt.items():
+            if distanceFilters[sensorNum].reporting:
+                continue
+            due = now if sampledAt is None else sampledAt + samplingPolicy.interval(sensorNum)
+            deadlines.append(due)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def sample_if_due(self, sensorNum):
+        """Samples `sensorNum` if it is stale. Returns True if it was sampled."""
+        if not self.is_stale(sensorNum):
+            return False
+        self.sample(sensorNum)
+        return True
 
-    # If US2 detects anything at all → activate override
-    if overheightVechicleAtUS2:
-        override4I3Active = True
+    def sample(self, sensorNum):
+        """Samples `sensorNum` once with `get_distance()` and stores the result."""
+        self.store(sensorNum, get_distance(trigPins[sensorNum], sensorNum))
+        return self.distances[sensorNum]
 
-def sub3i2(startTime):
+    def store(self, sensorNum, distance):
+        """Stores a reading sampled elsewhere, e.g. by a sensor task of async_runtime.py."""
+        self.distances[sensorNum] = distance
+        self.sampledAt[sensorNum] = clock.time()
+        self.samplesTaken += 1
+        samplingPolicy.observe(sensorNum, distance)
+
+    def distance(self, sensorNum):
+        """Returns the reading of `sensorNum` for this tick, re-sampling it only if stale and `sampleWhenStale` is set."""
+        if self.sampleWhenStale:
+            self.sample_if_due(sensorNum)
+        return self.distances[sensorNum]
+
+# sensorSnapshot is built by build_derived_state()
+
+class BlinkEngine:
 
     """
-    Controls the LED states and timing logic for subsystem 3 integrate subsystem 2 based on elapsed time and button press.
+    Flashes LEDs at a fixed wall-clock rate, independent of how often the control loop runs.
 
-    This function:
-    - Tracks elapsed time since `startTime` to manage LED color transitions on shift register 2.
-    - Changes LEDs according to a time schedule: yellow before 2 seconds, red between 2 and 7 seconds, then green after 7 seconds.
-    - Monitors a push button press to immediately switch the LED pattern to green and turn off red.
-    - Manages the running state flag `running3I2` and updates the subsystem start time.
+    Subsystems set the steady state of a register with `led_display()` and mark the bits that
+    flash with `set_blinking()`. At every toggle edge, `update()` recomposes all registers with
+    a flashing bit and latches them in one `write_registers()` call. Steady bits are left untouched,
+    and all flashing lights share one phase, so they toggle together.
 
     Parameters:
-    startTime (float): The timestamp when subsystem 3 integrate subsystem 2 started, used for elapsed time calculation.
+    period (float): Seconds for one on/off cycle.
+    """
 
-    Returns:
+    def __init__(self, period=0.6):
+        self.period = period
+        self.epoch = clock.time()
+        self.steady = {1: 0, 2: 0, 3: 0}
+        self.blinking = {1: 0, 2: 0, 3: 0} # mask of the flashing bits of every register
+        self.lastPhase = None
+        self.toggles = 0
+
+    def is_blinking(self):
+        """Returns True if any bit of any register is flashing."""
+        return any(self.blinking.values())
+
+    def set_blinking(self, regNum, bitIndex, blinking):
+        """Starts or stops flashing one bit, effective from the next `led_display()` or `update()`."""
+        if blinking and not self.is_blinking():
+            # a flash always starts with the light on
+            self.epoch = clock.time()
+            self.lastPhase = None
+        if blinking:
+            self.blinking[regNum] |= 0x80 >> bitIndex
+        else:
+            self.blinking[regNum] &= ~(0x80 >> bitIndex)
+
+    def clear(self):
+        """Stops flashing every bit, effective from the next `led_display()`."""
+        for regNum in self.blinking:
+            self.blinking[regNum] = 0
+
+    def phase_on(self, now):
+        """Returns True during the on half of the blink cycle."""
+        return int((now - self.epoch) / (self.period / 2)) % 2 == 0
+
+    def next_toggle(self, now):
+        """Returns the timestamp of the next toggle edge, or None if nothing is flashing."""
+        if not self.is_blinking():
+            return None
+        halfPeriod = self.period / 2
+        return self.epoch + (int((now - self.epoch) / halfPeriod) + 1) * halfPeriod
+
+    def compose(self, regNum, now):
+        """Returns the steady pattern of a register with its flashing bits set to the current phase."""
+        if self.phase_on(now):
+            return self.steady[regNum] | self.blinking[regNum]
+        return self.steady[regNum] & ~self.blinking[regNum]
+
+    def update(self, now=None):
+        """Latches every register with a flashing bit if a toggle edge has passed since the last update."""
+        if now is None:
+            now = clock.time()
+        if not self.is_blinking():
+            self.lastPhase = None
+            return
+        phase = self.phase_on(now)
+        if phase == self.lastPhase:
+            return
+        self.lastPhase = phase
+        self.toggles += 1
+        write_registers({regNum: self.compose(regNum, now) for regNum, bits in self.blinking.items() if bits})
+
+# blinkEngine is built by build_derived_state()
+
+def open_event_log():
+
+    """
+    Starts the event log from `eventLogPath`, `eventLogLevel` and `consoleLevel`, if not started yet.
+
+    Parameters:
     None
+
+    Returns:
+    EventLog: The running event log.
     """
 
-    global running3I2, startTime3I2
-    timeDiff = time.time() - startTime
-    print("check_pb")
+    global eventLog
+    if eventLog is None:
+        eventLog = EventLog(eventLogPath, eventLogLevel, consoleLevel)
+    eventLog.start()
+    return eventLog
 
-    if running3I2 == False: 
-        startTime3I2 = startTime
-        running3I2 = True
-        stateShiftRegister2[redPL1] = 1
+def close_event_log():
+    """Writes the buffered events and stops the event log."""
+    global eventLog
+    if eventLog is not None:
+        eventLog.close()
+        eventLog = None
 
-    if read_push_button() == True:
-        print("detetcted")
-        stateShiftRegister2[greenPL1] = 1
-        stateShiftRegister2[redPL1] = 0
-        led_display(stateShiftRegister2,2)
-    if timeDiff < 2:
-        stateShiftRegister2[yellowTL4] = 1
-        stateShiftRegister2[greenTL4] = 0
-        led_display(stateShiftRegister2,2)
-    elif timeDiff < 7:
-        stateShiftRegister2[yellowTL4] = 0
-        stateShiftRegister2[redTL4] = 1
-        stateShiftRegister2[redPL1] = 0
-        led_display(stateShiftRegister2,2)
-    else:
-        print("done3i2")
-        stateShiftRegister2[greenTL4] = 1
-        stateShiftRegister2[redTL4] = 0
-        stateShiftRegister2[greenPL1] = 0
-        stateShiftRegister2[redPL1] = 1
-        led_display(stateShiftRegister2,2)
-        running3I2 = False
+def log_event(level, event, **fields):
+    """Records a typed event stamped with the current time, see `event_log.EventLog.emit()`. Does nothing before the log is started."""
+    if eventLog is not None and eventLog.enabled(level):
+        eventLog.emit(level, event, clock.time(), **fields)
 
-def subsystem1(startTime):
+def setup_pins():
 
     """
-    Controls the behavior of subsystem 1, handling LED patterns and buzzer tones for overheight vehicle detection.
-
-    The function manages a sequence of LED displays and buzzer sounds based on the elapsed time since `startTime`.
-    It includes an initial measurement of vehicle height, warning signals with increasing urgency,
-    and a blinking LED pattern with corresponding buzzer frequencies.
+    Sets the pin modes of all push buttons, ultrasonic sensors and shift registers
+    on the connected board and clears the shift register control pins.
 
-    The function respects an override flag to pause its execution and resets state variables when the subsystem ends.
+    Pin modes are set in one pass over the pin tables. The echo pins are not set as
+    digital inputs, the sonar configuration already owns them and digital reporting on
+    them would only add a report for every echo. The data pins are not cleared either,
+    their level only matters when the clock rises. With `useFirmwareShiftOut` set, the
+    firmware also handles `OUTPUT_PINS_SYSEX`, so all nine shift register pins are set up
+    in one SysEx message instead of one message per pin (see `firmware_output_pins()`).
 
     Parameters:
-    startTime (float): Timestamp marking when subsystem 1 started, used to calculate elapsed time.
+    None
 
     Returns:
-    None
+    int: The number of Firmata messages sent.
     """
 
-    global runningSub1, iteration1, override4I3Active, firstTimeSub1
+    messages = 0
 
-    if override4I3Active:
-        return
-    
-    if firstTimeSub1 == False:
-        firstTimeSub1 = True
-        objectDistanceUS1 = get_distance(us1Trig, 1) 
-        vechicleHeightMetre = (30 - objectDistanceUS1)*20 / 100 # 20:1 (real : prototype) ratio
-        print("Overheight vechicle still detected. Frequency increase to 2500 Hz")
-        print(f"Height of OVERHEIGHT VECHICLE in metre: {vechicleHeightMetre} m")
+    board.set_pin_mode_digital_input(pb1, button_callback)
+    board.set_pin_mode_pwm_output(pb2)
+    messages += 2
 
-    print("Start S1")
-    timeDiff = time.time() - startTime
+    for sensorNum, trigPin in trigPins.items():
+        board.set_pin_mode_sonar(trigPin, echoPins[sensorNum], sonar_callback)
+        messages += 1
 
-    if timeDiff < 1:
-        board.play_tone_off(pb2)
-        seq1 = [0,1,0,0,0,1,0,1]
-        led_display(seq1, 1)
+    if useFirmwareShiftOut:
+        firmware_output_pins([pin for pins in shiftRegisterPins.values() for pin in pins])
+        return messages + 1
 
-    elif 1 <= timeDiff < 2:
-        seq2 = [0,0,1,0,0,0,1,1]
-        led_display(seq2,1)
-        board.play_tone(pb2, 3000, 1000) # passize buzzer sounds at 3000Hz
+    for pins in shiftRegisterPins.values():
+        for pin in pins:
+            board.set_pin_mode_digital_output(pin)
+            messages += 1
 
-    elif 2 <= timeDiff < 32: 
-        board.play_tone(pb2, 3000, 30000)
-        seqFlashOn = [1,0,0,1,0,0,1,1]
-        seqFlashOff = [0,0,0,1,0,0,1,1]
-        iteration1 +=1
-        if iteration1 % 2 == 1:
-            led_display(seqFlashOn,1)
-        else:
-            led_display(seqFlashOff,1)
+    for dataPin, clockPin, latchPin in shiftRegisterPins.values():
+        board.digital_write(clockPin, 0)
+        board.digital_write(latchPin, 0)
+        messages += 2
 
-    elif timeDiff >= 32:
-        objectDistanceUS1 = get_distance(us1Trig, 1) 
-
-        if objectDistanceUS1 < detectionThreshold:
-            board.play_tone(pb2, 5000, 120000000000000000) # passive buzzer sounds at 5000Hz
-        seqFlashOn = [1,0,0,1,0,0,1,1]
-        seqFlashOff = [0,0,0,1,0,0,1,1]
-        iteration1 +=1
-        if iteration1 % 2 == 1:
-            led_display(seqFlashOn,1)
-        else:
-            led_display(seqFlashOff,1)
-        if us3CameAndLeft == True and objectDistanceUS1 < detectionThreshold:
-            print("S1 done")
-            board.play_tone_off(pb2)
-            led_display([0,1,0,0,1,0,0,0],1)
-            runningSub1 = False 
-            iteration1 = 0
-            firstTimeSub1 = False
+    return messages
 
-def starting_sub1():
+def firmware_output_pins(pins):
 
     """
-    Reset subsystem 1 indicators by turning off the buzzer and setting the LED pattern.
-
-    This function stops any buzzer sound on PA1 and updates the LEDs of shift register 1
-    to the initial pattern [0,1,0,0,1,0,0,0], indicating the subsystem reset state.
+    Sends one SysEx message that makes every pin in `pins` a digital output driven low.
 
     Parameters:
-    None
+    pins (list of int): The pins to set up.
 
     Returns:
     None
     """
- 
-    board.play_tone_off(pb2)
-    led_display([0,1,0,0,1,0,0,0],1)
 
-def subsystem2(startTime):
+    board._send_sysex(OUTPUT_PINS_SYSEX, list(pins))
 
-    """
-    Manage the behavior and LED signaling of subsystem 2 based on elapsed time since start.
+def reset_button():
 
-    This function controls the timing and LED states for subsystem 2:
-    - On the first call, it registers the button press.
-    - Between 0-2 seconds: subsystem runs without LED changes.
-    - Between 2-4 seconds: sets yellow traffic light on TL4 and green on TL3; red pedestrian light on PL1.
-    - Between 4-7 seconds: switches TL4 light from yellow to red; pedestrian light PL1 changes to green.
-    - Between 7-9 seconds: blinks red pedestrian light PL1.
-    - After 9 seconds: resets the lights to red on PL1, green on TL4, turns off red on TL4, marks subsystem as stopped, and resets counters.
+    """
+    Forgets the debounced PB1 state and every queued press, e.g. when a new board is connected.
 
     Parameters:
-    startTime (float): The start time timestamp of the subsystem operation.
+    None
 
     Returns:
     None
     """
 
-    global iteration, timePrevious2, runningSub2, lastState2, firstTimeSub2
-    print("Start S2")
-    timeDiff = time.time() - startTime
-
-    if firstTimeSub2 == False:
-        firstTimeSub2 = True
-        print("Button pressed")
-
-    if timeDiff < 2:
-        runningSub2 = True
-        
-    elif 2 < timeDiff < 4:
-        runningSub2 = True
-        stateShiftRegister2[greenTL4] = 0 
-        stateShiftRegister2[yellowTL4] = 1
-        stateShiftRegister2[greenTL3] = 1
-        stateShiftRegister2[redPL1] = 1
-        led_display(stateShiftRegister2,2)
-    elif 4 < timeDiff < 7:
-        runningSub2 = True
-        stateShiftRegister2[yellowTL4] = 0 
-        stateShiftRegister2[redTL4] = 1
-        stateShiftRegister2[redPL1] = 0
-        stateShiftRegister2[greenPL1] = 1
-        led_display(stateShiftRegister2,2)
+    global buttonReporting, buttonLevel, buttonChangedAt, buttonReported, crossingRequested
 
-    if 7 < timeDiff < 9:
-        stateShiftRegister2[greenPL1] = 0
-        iteration+=1
-        if iteration%2 == 1:
-            stateShiftRegister2[redPL1] = 1
-        else:
-            stateShiftRegister2[redPL1] = 0
+    with buttonLock:
+        buttonReporting = False
+        buttonLevel = 0
+        buttonChangedAt = None
+        buttonReported = 0
+        crossingRequests.clear()
+        crossingRequested = False
 
-        led_display(stateShiftRegister2,2)
-        
-        print(f"This is iteration {iteration}")
-    if timeDiff > 9:
-        print("enter 9")
-        stateShiftRegister2[redPL1] = 1
-        stateShiftRegister2[redTL4] = 0
-        stateShiftRegister2[greenTL4] = 1
-        led_display(stateShiftRegister2,2)
-        stateA = board.digital_read(pb1)[0]
-        lastState2 = stateA
-        timePrevious2 = time.time()
-        runningSub2 = False
-        print("S2 done")
-        iteration  = 0
-        firstTimeSub2 = False
-        
-def subsystem3(startTime):
+def use_clock(newClock):
 
     """
-    Control the behavior and LED signaling of subsystem 3 based on elapsed time.
-
-    This function manages subsystem 3 in phases according to time since startTime:
-    - For the first 2 seconds:
-      * Resets the 'us3CameAndLeft' flag.
-      * Calls sub3i2 to handle button press logic.
-      * Displays a specific LED pattern on shift register 3.
-    - Between 2 and 7 seconds:
-      * Displays a different LED pattern.
-      * Measures distance with ultrasonic sensor 3.
-      * If distance exceeds detection threshold, sets 'us3CameAndLeft' to True.
-    - After 7 seconds:
-      * Measures distance again.
-      * If an object is detected within threshold, flashes green LEDs alternately.
-      * If no object detected, displays a steady LED pattern,
-        marks subsystem 3 as done, resets iteration counter and sets 'us3CameAndLeft' to True.
+    Runs the whole system on `newClock`, e.g. a `virtual_clock.SimulatedClock` to run scenarios
+    without waiting. The wake event of the control loop is replaced by one of the new clock.
 
     Parameters:
-    startTime (float): The timestamp marking the start of subsystem 3 operation.
+    newClock (object): The clock, see virtual_clock.py.
 
     Returns:
-    None
+    object: The previous clock, to restore it with `use_clock()`.
     """
 
-    global runningSub3, iteration3, override4I3Active, us3CameAndLeft 
-    
-    print("Start S3")
-    timeDiff = time.time() - startTime 
+    global clock, wakeEvent
+    previousClock = clock
+    clock = newClock
+    wakeEvent = newClock.event()
+    return previousClock
 
-    if timeDiff < 2:
-        us3CameAndLeft = False
-        sub3i2(startTime)
-        seq1 = [0,1,0,0,0,0,0,0]
-        led_display(seq1, 3)
+def connect_board(newBoard=None):
 
-    elif 2 < timeDiff < 7:
-        seq2 = [1,0,0,0,0,0,0,0]
-        led_display(seq2, 3)
+    """
+    Connects the board used by the whole system and sets up its pins.
+    The time spent opening the board and setting up the pins is recorded in `startupTimes`.
 
-        objectDistanceUS3 = get_distance(us3Trig, 3)
+    Parameters:
+    newBoard (object): An already constructed board implementing `board_interface.Board`,
+                       e.g. a `SimulatedBoard` from simulated_board.py.
+                       If None, a Pymata4 connection to the Arduino is opened.
 
-        if objectDistanceUS3 > detectionThreshold:
-            us3CameAndLeft = True
+    Returns:
+    object: The connected board.
+    """
 
-    elif timeDiff > 7:
-        objectDistanceUS3 = get_distance(us3Trig, 3)
+    global board, predictedEntryDeadline, vehicleTracker
+
+    open_event_log()
+    connectStart = time.perf_counter()
+    if newBoard is None:
+        # pymata4 only returns once the firmware answered, so no extra settling sleep is needed
+        from pymata4 import pymata4
+        newBoard = pymata4.Pymata4(arduino_wait=arduinoWait)
+    if traceRecorder is not None:
+        newBoard = traceRecorder.wrap(newBoard)
+    pinSetupStart = time.perf_counter()
+
+    board = newBoard
+    reset_led_shadow()
+    reset_tone_shadow()
+    for distanceFilter in distanceFilters.values():
+        distanceFilter.reset()
+    for detector in vehicleDetectors.values():
+        detector.reset()
+    samplingPolicy.reset()
+    sensorSnapshot.invalidate()
+    predictedEntryDeadline = None
+    vehicleTracker = None
+    if useVehicleTracking:
+        start_vehicle_tracking()
+    reset_button()
+    startupTimes['pinSetupMessages'] = setup_pins()
+
+    startupTimes['boardOpen'] = pinSetupStart - connectStart
+    startupTimes['pinSetup'] = time.perf_counter() - pinSetupStart
+    return board
+
+def main(startTime, newBoard=None, maxTicks=None):
 
-        if objectDistanceUS3 < detectionThreshold:
-            flashGreenSeq1 = [1,0,0,0,0,0,0,0] 
-            flashGreenSeq2 = [0,0,0,0,0,0,0,0]
+    """
+    Main function to control the vehicle height detection and traffic management system.
 
-            iteration3 +=1
-            if iteration3 % 2 == 1:
-                led_display(flashGreenSeq1,3)
-            else:
-                led_display(flashGreenSeq2,3)
-        else:
-            led_display([0,0,1,0,0,0,0,0],3)
-            print("S3 done")
-            runningSub3 = False
-            iteration3 = 0
-            us3CameAndLeft = True
+    This function initializes system states and enters an infinite loop where it:
+    - Monitors ultrasonic sensors for vehicle height detection.
+    - Activates corresponding subsystems based on sensor input.
+    - Manages override logic and reset conditions.
+    - Handles subsystem-specific triggers and state transitions.
+    - Supports interruption by keyboard to shut down hardware safely.
 
-def subsystem4(startTime):
+    Parameters:
+    startTime (float): The system start time used for time-based logic and delays.
+    newBoard (object): Board to run on, e.g. a `SimulatedBoard`. If None, the board
+                       already connected with `connect_board()` is used.
+    maxTicks (int): Number of control ticks to run before returning, or None to run until interrupted.
 
+    With `useStateMachines` set, every tick is handled by the table-driven state machines
+    (`state_machine_step()`), otherwise by the original control loop (`control_tick()`).
+
+    Returns:
+    None
     """
-    Manage subsystem 4 behavior and LED signaling based on ultrasonic sensor 2 detection.
 
-    This function performs the following steps:
-    - Stops runningSub2 and resets its iteration and timer.
-    - Prints status messages indicating subsystem start and US2 detection.
-    - Sets specific LEDs on shift register 2 to represent the current state.
-    - Reads the distance from ultrasonic sensor 2 (US2).
-    - If an object is detected within the threshold distance:
-      * Updates LED states on shift register 2 to indicate detection.
-      * Blinks a warning LED (redWL2) on and off alternately using iteration count.
-      * Continuously refreshes the object distance reading.
+    try:
+        global board, running3I2, timePrevious2, lastState2
+
+        if newBoard is not None:
+            connect_board(newBoard)
+        
+        running3I2 = False
+        timePrevious2 = 0
+        lastState2 = 0
+        initialPatternStart = time.perf_counter()
+        reset_state_machines()
+        starting()
+        startupTimes['initialPattern'] = time.perf_counter() - initialPatternStart
+        clock.sleep(readyDelay)
+
+        startupTimes['bootToReady'] = clock.time() - startTime
+        log_event(INFO, 'ready')
+        report_startup()
+
+        tick = 0
+        while maxTicks is None or tick < maxTicks: 
+            if useStateMachines:
+                state_machine_step()
+            else:
+                control_tick()
+            tick += 1
+            wait_for_next_deadline()
+
+    except KeyboardInterrupt:
+        ending() 
+        clock.sleep(0.5)
+        board.shutdown()
+        board = None
+        log_event(INFO, 'shutdown')
+        close_event_log()
+
+def report_startup():
+
+    """
+    Logs how long each startup stage took, from `startupTimes`.
 
     Parameters:
-    startTime (float): The timestamp marking the start of subsystem 4 operation.
+    None
 
     Returns:
     None
     """
-        
-    global runningSub2, timePrevious2, iteration4, iteration, runningSub4, override4I3Active 
 
-    print("Start s4")
+    stages = {name: round(startupTimes[name], 3) for name in ('boardOpen', 'pinSetup', 'initialPattern', 'bootToReady') if name in startupTimes}
+    if 'pinSetupMessages' in startupTimes:
+        stages['pinSetupMessages'] = startupTimes['pinSetupMessages']
+    log_event(INFO, 'startup', **stages)
 
-    runningSub2 = False
-    iteration = 0
-    timePrevious2 = time.time()
-
-    timeDiff = time.time() - startTime
-
-    print("US2 detected") 
-    stateShiftRegister2[redTL3] = 1
-    stateShiftRegister2[greenTL3] = 0
-    stateShiftRegister2[redPL1] = 1
-    stateShiftRegister2[greenPL1] = 0
-    led_display(stateShiftRegister2,2)
-
-    objectdistance = get_distance(us2Trig, 2)
-    if not (objectdistance is None or objectdistance > detectionThreshold):
-        print('US2 detected')
-        stateShiftRegister2[redTL4] = 1
-        stateShiftRegister2[yellowTL4] = 0
-        stateShiftRegister2[greenTL4] = 0
-
-        iteration4 +=1
-        if iteration4 % 2 == 1:
-            stateShiftRegister2[redWL2] = 1
-            led_display(stateShiftRegister2,2) 
-        else:
-            stateShiftRegister2[redWL2] = 0
-            led_display(stateShiftRegister2, 2)  
-        objectdistance = get_distance(us2Trig, 2)
-        
-def check_reset_4I3():
+class TrafficController:
 
     """
-    Check conditions and reset the subsystem 4 integrate subsystem 3 system to normal state if criteria are met.
+    Owns the connection to the board and runs the traffic system on it.
 
-    This function monitors the ultrasonic sensors and internal flags to determine if the
-    system should reset from an override or alert state back to normal operation.
-    The reset happens only if:
-    - readyToReset4I3 is True,
-    - no overheight vehicles are detected by any ultrasonic sensors (distances above threshold or None),
-    - and the flag us3CameAndLeft indicates the vehicle has left the last sensor.
+    Nothing is opened when the controller is constructed. `connect()` opens the board
+    (or takes the given one) and sets up its pins, `run()` runs the control loop and
+    `close()` turns every light off and releases the board. The controller can also be
+    used as a context manager, which closes it on exit.
 
-    Upon reset:
-    - Subsystem 1 LEDs are reset to their normal state.
-    - Shift register 2 LEDs controlling various traffic lights are set to normal.
-    - Subsystem 3's traffic light is set to red.
-    - Override and running flags are cleared.
+    The flags, timers and state machines of the traffic system are the globals of this
+    module, so only one controller can be connected at a time. Several junctions are run
+    with `multi_junction.Junction`, which gives every junction its own copy of this module.
+    The controller keeps its board, when it connected (`startedAt`) and its `startupTimes`.
+
+    Parameters:
+    newBoard (object): Board to run on, e.g. a `SimulatedBoard`. If None, a Pymata4
+                       connection to the Arduino is opened by `connect()`.
+    """
+
+    active = None # the controller connected to the traffic system of this module, None if none is
+
+    def __init__(self, newBoard=None):
+        self.newBoard = newBoard
+        self.board = None
+        self.startedAt = None
+        self.startupTimes = {}
+
+    def connect(self):
+        """Connects the board and sets up its pins, if not connected yet. Returns the board."""
+        if self.board is None:
+            if TrafficController.active is not None and TrafficController.active is not self:
+                raise RuntimeError("Another TrafficController is already connected, close it first")
+            self.startedAt = clock.time()
+            startupTimes.clear()
+            self.board = connect_board(self.newBoard)
+            TrafficController.active = self
+            self.startupTimes = dict(startupTimes)
+        return self.board
+
+    def run(self, maxTicks=None):
+        """Connects if needed and runs the control loop, see `main()`. Boot-to-Ready is measured from `connect()`."""
+        self.connect()
+        try:
+            main(self.startedAt, maxTicks=maxTicks)
+        finally:
+            self.startupTimes = dict(startupTimes)
+
+    def close(self):
+        """Turns every light and the buzzer off, releases the board and writes the buffered events."""
+        global board
+        # main() already shut the board down if it was interrupted
+        if self.board is not None and board is self.board:
+            ending()
+            self.board.shutdown()
+            board = None
+        self.board = None
+        if TrafficController.active is self:
+            TrafficController.active = None
+        close_event_log()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+def upcoming_deadlines(startTime, boundaries, now):
+
+    """
+    Returns the phase boundaries of one subsystem that are still ahead of `now`.
+
+    Parameters:
+    startTime (float): The timestamp when the subsystem started.
+    boundaries (tuple of float): The phase boundaries in seconds after `startTime`.
+    now (float): The current timestamp.
+
+    Returns:
+    list of float: The timestamps of the boundaries not yet reached.
+    """
+
+    return [startTime + boundary for boundary in boundaries if startTime + boundary > now]
+
+def subsystem_deadline(subsystemNum, now, startTime=None):
+
+    """
+    Computes when one running subsystem next has to run.
+
+    The deadline is the subsystem's next phase boundary. Flashing lights are toggled
+    by `blinkEngine`, so blinking does not make a subsystem run more often.
+
+    Parameters:
+    subsystemNum (int or str): The subsystem (1, 2, 3, 4, or '3I2' for subsystem 3 integrate 2).
+    now (float): The current timestamp.
+    startTime (float): When the subsystem started, None to use its start time in the control loop.
+
+    Returns:
+    float or None: The timestamp of the next deadline, or None if the subsystem is not running.
+    """
+
+    deadlines = []
+    if startTime is None:
+        startTime = {1: startTime1, 2: startTime2, 3: startTime3, 4: startTime4, '3I2': startTime3I2}[subsystemNum]
+
+    if subsystemNum == 1 and runningSub1:
+        deadlines += upcoming_deadlines(startTime, phaseBoundariesSub1, now)
+    elif subsystemNum == 2 and runningSub2:
+        deadlines += upcoming_deadlines(startTime, phaseBoundariesSub2, now)
+    elif subsystemNum == 3 and runningSub3:
+        deadlines += upcoming_deadlines(startTime, phaseBoundariesSub3, now)
+    elif subsystemNum == '3I2' and running3I2:
+        deadlines += upcoming_deadlines(startTime, phaseBoundaries3I2, now)
+        # sub3i2 ends on the first call after its last boundary
+        if len(deadlines) == 0:
+            deadlines.append(now)
+
+    if len(deadlines) == 0:
+        return None
+    return min(deadlines)
+
+def next_deadline(now):
+
+    """
+    Computes when the control loop next has to run.
+
+    The deadline is the earliest of:
+    - the next timed transition of every state machine (see `StateMachine.next_timer()`),
+      or with the original control loop the next phase boundary of every running subsystem
+      (see `subsystem_deadline()`),
+    - the next toggle of the flashing lights (see `BlinkEngine.next_toggle()`),
+    - the end of the pedestrian lockout, after which PB1 can start subsystem 2 again,
+    - the end of the PB1 debounce window, if a reported PB1 change waits for it (see `settle_button()`),
+    - the moment a sensor's `DistanceFilter` accepts a persisting jump in distance,
+    - the moment a sensor's `VehicleDetector` completes the dwell time of a pending change,
+    - the moment a predicted detection at US1 is cancelled if unconfirmed (see `check_predicted_entry()`),
+    - the next sample of a polled sensor, at the rate chosen by `samplingPolicy`,
+    - `idleWait` after now, when nothing else is due.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    float: The timestamp of the next deadline.
+    """
+
+    deadlines = [now + idleWait]
+    if useStateMachines:
+        for machine in stateMachines.values():
+            deadline = machine.next_timer(now)
+            if deadline is not None:
+                deadlines.append(deadline)
+    else:
+        for subsystemNum in (1, 2, 3, 4, '3I2'):
+            deadline = subsystem_deadline(subsystemNum, now)
+            if deadline is not None:
+                deadlines.append(deadline)
+    nextToggle = blinkEngine.next_toggle(now)
+    if nextToggle is not None:
+        deadlines.append(nextToggle)
+    deadlines += upcoming_deadlines(timePrevious2, (pedestrianLockout,), now)
+    buttonSettle = button_settle_deadline()
+    if buttonSettle is not None:
+        deadlines.append(buttonSettle)
+    for distanceFilter in distanceFilters.values():
+        confirmDeadline = distanceFilter.confirm_deadline()
+        if confirmDeadline is not None:
+            deadlines.append(confirmDeadline)
+    for detector in vehicleDetectors.values():
+        dwellDeadline = detector.dwell_deadline()
+        if dwellDeadline is not None:
+            deadlines.append(dwellDeadline)
+    if predictedEntryDeadline is not None:
+        deadlines.append(predictedEntryDeadline)
+    nextSample = sensorSnapshot.next_sample(now)
+    if nextSample is not None:
+        deadlines.append(nextSample)
+    return min(deadlines)
+
+def wait_for_next_deadline():
+
+    """
+    Sleeps until the next deadline of the control loop, or until a sensor or button event wakes it.
+    With instrumentation enabled, how late the loop woke after its deadline is recorded.
 
     Parameters:
     None
@@ -853,41 +1385,1677 @@ def check_reset_4I3():
     None
     """
 
-    global override4I3Active, runningSub1, runningSub3, runningSub4
-    global stateShiftRegister2, readyToReset4I3
+    now = clock.time()
+    deadline = next_deadline(now)
+    timeout = max(0, deadline - now + deadlineSlack)
+    woken = wakeEvent.wait(timeout)
+    wakeEvent.clear()
 
-    objectDistanceUS1 = get_distance(us1Trig, 1)
-    objectDistanceUS2 = get_distance(us2Trig, 2)
-    objectDistanceUS3 = get_distance(us3Trig, 3)
-    
-    print('=======================================')
+    if metrics is not None and not woken:
+        metrics.record_lateness('scheduler', clock.time() - deadline)
 
-    if (
-        readyToReset4I3 and
-        (objectDistanceUS1 is None or objectDistanceUS1 > detectionThreshold) and
-        (objectDistanceUS2 is None or objectDistanceUS2 > detectionThreshold) and 
-        us3CameAndLeft
-    ):
-        print("4.I3: Resetting system to normal state")
+def control_tick():
+
+    """
+    Runs one pass of the control loop.
 
-        led_display([0,1,0,0,1,0,0,0], 1)
+    This function samples the sensors once, updates the detection state, checks the
+    4.I3 reset and then runs every subsystem that is triggered or still running.
+    It is the original flag-based control loop, used by `main()` when `useStateMachines` is False.
 
-        stateShiftRegister2[redTL3] = 0  
-        stateShiftRegister2[greenTL3] = 1  
-        stateShiftRegister2[redWL2] = 0
-        stateShiftRegister2[greenTL4] = 1  
-        stateShiftRegister2[yellowTL4] = 0 
-        stateShiftRegister2[redTL4] = 0 
-        led_display(stateShiftRegister2, 2)
+    Parameters:
+    None
 
+    Returns:
+    None
+    """
 
-        led_display([1,0,0,0,0,0,0,0], 3)  
+    global runningSub1, overheightVechicleAtUS1, overheightVechicleExitedUS1 
+    global runningSub2, timePrevious2, lastState2, running3I2, startTime3I2
+    global runningSub3, overheightVechicleAtUS3, overheightVechicleExitedUS3 
+    global runningSub4, overheightVechicleAtUS2, overheightVechicleExitedUS2, override4I3Active
+    global firstTimeSub1, firstTimeSub2, firstTimeSub3, firstTimeSub4
+    global startTime1, startTime2, startTime3, startTime4
 
-        override4I3Active = False
+    # sample every sensor once and take PB1 presses once, all subsystems read this tick's snapshot
+    sensorSnapshot.refresh()
+    latch_crossing_requests()
+    refresh_state()
+    check_reset_4I3()
+
+    if predictionCancelled and runningSub1:
         runningSub1 = False
-        runningSub3 = False
-        runningSub4 = False 
-        readyToReset4I3 = False
+        firstTimeSub1 = False
+        starting_sub1()
+
+    if not runningSub1 and  not runningSub2 and not runningSub3 and not runningSub4:
+        log_event(DEBUG, 'normal_pattern')
+        starting()
+
+    if overheightVechicleAtUS1 or runningSub1 == True:
+        if not runningSub1:
+            runningSub1 = True
+            startTime1 = clock.time()
+
+        subsystem1(startTime1)  
+
+        refresh_state()
+
+        if overheightVechicleAtUS3 or runningSub3 == True:
+            if not runningSub3:
+                runningSub3 = True 
+                startTime3 = clock.time()
+
+            subsystem1(startTime1)
+            subsystem3(startTime3)
+
+            refresh_state()
+
+            if overheightVechicleExitedUS3 and runningSub1 == True and not overheightVechicleAtUS1:
+                runningSub1 = False 
+                tone_off()
+                starting_sub1()
+
+        refresh_state()
+
+    if overheightVechicleAtUS2:                       
+        if us_detected(2) or runningSub4 == True:
+            if not runningSub4:
+                runningSub4 = True
+                startTime4 = clock.time()
+            subsystem4(startTime4)
+
+    if overheightVechicleAtUS3 or runningSub3 == True:
+        if not runningSub3:
+            runningSub3 = True 
+            startTime3 = clock.time()
+        subsystem3(startTime3)
+
+    if (read_push_button() == True and clock.time() - timePrevious2 > pedestrianLockout and lastState2 == 0) or runningSub2 == True: 
+        if not runningSub2:
+            runningSub2 = True
+            startTime2 = clock.time()
+            iteration = 0
+        subsystem2(startTime2)
+
+    if running3I2 == True:
+        sub3i2(startTime3I2)
+
+    blinkEngine.update()
+
+def led_display(pattern, regNum):
+
+    """
+    Displays a pattern on a specified shift register for LED output.
+
+    This function writes a pattern to one of three shift registers (1, 2, or 3), each
+    connected to an LED array. It uses serial communication to shift data into the
+    register and latch the output.
+
+    The pattern is the steady state of the register. Bits marked as blinking with
+    `blinkEngine.set_blinking()` are replaced by the current blink phase, so the
+    subsystems never toggle lights themselves.
+
+    Parameters:
+    pattern (int): The pattern as a byte, QH being the most significant bit, e.g. `reg1Normal`.
+                   A list of 0s and 1s, QH first, is accepted too.
+    regNum (int): The register number (1, 2, or 3) that selects which LED shift register to control.
+
+    Returns:
+    None
+    """
+
+    if regNum not in latchedRegisters:
+        log_event(ERROR, 'invalid_register', register=regNum)
+        return
+
+    if not isinstance(pattern, int):
+        pattern = seq_to_byte(pattern)
+    blinkEngine.steady[regNum] = pattern
+    write_registers({regNum: blinkEngine.compose(regNum, clock.time())})
+
+def update_register2(setBits=0, clearBits=0):
+
+    """
+    Sets and clears bits of the steady state of shift register 2, without latching it.
+
+    Parameters:
+    setBits (int): Mask of the lights to turn on, e.g. `redTL4Bit | greenPL1Bit`.
+    clearBits (int): Mask of the lights to turn off.
+
+    Returns:
+    int: The new state, also kept in `stateShiftRegister2`.
+    """
+
+    global stateShiftRegister2
+    stateShiftRegister2 = (stateShiftRegister2 & ~clearBits) | setBits
+    return stateShiftRegister2
+
+def write_registers(patterns):
+
+    """
+    Latches patterns on one or more shift registers.
+
+    The last latched pattern of each register is kept in `latchedRegisters`. Writing the
+    same pattern again is skipped, so serial traffic only happens when a light changes.
+    `ledWritesIssued` and `ledWritesSuppressed` count both outcomes.
+
+    If `useFirmwareShiftOut` is set, all changed registers are sent in a single SysEx message
+    and the Arduino clocks out the bits itself (see `firmware_shift_out()`). Otherwise every
+    changed register is clocked out with `shift_out()` first, and the latches are pulsed
+    together afterwards, so the registers change their outputs at the same moment.
+
+    While a frame is open (see `led_frame()`), the patterns are only staged and are written
+    when the frame closes.
+
+    Parameters:
+    patterns (dict): Maps the register number (1, 2, or 3) to the pattern byte to latch on it.
+
+    Returns:
+    None
+    """
+
+    global ledWritesIssued, ledWritesSuppressed
+
+    if frameDepth > 0:
+        stagedRegisters.update(patterns)
+        return
+
+    changed = {}
+    for regNum, pattern in patterns.items():
+        if latchedRegisters[regNum] == pattern:
+            ledWritesSuppressed += 1
+            continue
+        latchedRegisters[regNum] = pattern
+        ledWritesIssued += 1
+        changed[regNum] = pattern
+
+    if len(changed) == 0:
+        return
+
+    if useFirmwareShiftOut:
+        firmware_shift_out(changed)
+    else:
+        for regNum, pattern in changed.items():
+            shift_out(pattern, regNum, latch=False)
+        latchPins = [shiftRegisterPins[regNum][2] for regNum in changed]
+        for latchPin in latchPins:
+            board.digital_write(latchPin, 1)
+        for latchPin in latchPins:
+            board.digital_write(latchPin, 0)
+
+@contextlib.contextmanager
+def led_frame():
+
+    """
+    Groups the register writes of a block into one frame, so the lights change together.
+
+    Inside the block, `led_display()` and `write_registers()` only stage the patterns. When the
+    outermost frame closes, every staged register is latched with one `write_registers()` call:
+    a single SysEx message with the firmware, or all registers clocked out before one round
+    of latch pulses when bit-banging. A register set twice in a frame is only written once,
+    with its last pattern, so the junction never shows a mixed state in between. Frames nest.
+
+    Usage:
+        with led_frame():
+            led_display(reg1Normal, 1)
+            led_display(reg2Normal, 2)
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    global frameDepth
+
+    frameDepth += 1
+    try:
+        yield
+    finally:
+        frameDepth -= 1
+        if frameDepth == 0 and len(stagedRegisters) > 0:
+            patterns = dict(stagedRegisters)
+            stagedRegisters.clear()
+            write_registers(patterns)
+
+# bit masks in shift-out order, QH first
+shiftOrder = (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01)
+
+def shift_out(pattern, regNum, latch=True):
+
+    """
+    Bit-bangs a pattern into one shift register and optionally latches it.
+
+    Every bit takes 2 digital writes for the clock pulse, plus 1 for the data pin when the bit
+    differs from the previous one, as the data pin keeps its level. The latch takes 2 more.
+
+    Parameters:
+    pattern (int): The pattern byte, QH being the most significant bit and shifted out first.
+    regNum (int): The register number (1, 2, or 3) that selects which LED shift register to control.
+    latch (bool): Pulse the latch pin afterwards. False leaves the latch to the caller, e.g. to
+                  latch several registers together.
+
+    Returns:
+    None
+    """
+
+    dataPin, clockPin, latchPin = shiftRegisterPins[regNum]
+    dataLevel = None
+    for mask in shiftOrder:
+        bit = 1 if pattern & mask else 0
+        if bit != dataLevel:
+            board.digital_write(dataPin, bit)
+            dataLevel = bit
+        board.digital_write(clockPin, 1)
+        board.digital_write(clockPin, 0)
+    if latch:
+        board.digital_write(latchPin, 1)
+        board.digital_write(latchPin, 0)
+
+def seq_to_byte(seq):
+
+    """
+    Packs an 8-element LED sequence into a pattern byte, the first element (QH) being the most significant bit.
+
+    Parameters:
+    seq (list of int): A list of 0s and 1s representing the binary sequence to display.
+
+    Returns:
+    int: The sequence as a byte between 0 and 255.
+    """
+
+    value = 0
+    for bit in seq:
+        value = (value << 1) | (1 if bit else 0)
+    return value
+
+def firmware_shift_out(patterns):
+
+    """
+    Sends one SysEx "shiftOut" message that updates one or more shift registers at once.
+
+    For every register the message carries its data, clock and latch pins followed by the byte
+    split into two 7-bit values, as SysEx data bytes must stay below 128. The firmware shifts out
+    every byte MSB first and then pulses the latch pins, matching `shift_out()`'s bit order.
+
+    Parameters:
+    patterns (dict): Maps the register number (1, 2, or 3) to the pattern byte to latch on it.
+
+    Returns:
+    None
+    """
+
+    data = []
+    for regNum, value in patterns.items():
+        data.extend(shiftRegisterPins[regNum])
+        data.extend([value & 0x7F, value >> 7])
+    board._send_sysex(SHIFT_OUT_SYSEX, data)
+
+def reset_led_shadow():
+
+    """
+    Forgets the shadow state of all shift registers so the next write
+    of each register is sent out, e.g. after the board has been reset.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    for regNum in latchedRegisters:
+        latchedRegisters[regNum] = None
+
+def reset_tone_shadow():
+
+    """
+    Forgets the shadow state of the buzzer so the next tone or silence is sent out.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    global latchedTone
+    latchedTone = None
+
+def tone_on(frequency, duration):
+
+    """
+    Sounds the buzzer on PA1 (pb2), unless it is already playing this tone.
+
+    Like `write_registers()`, the tone last sent is kept in `latchedTone`, so asking for
+    the same tone on every tick only sends it once. A tone that has run for its whole
+    duration has stopped on the board, so asking for it again sends it again.
+
+    Parameters:
+    frequency (int): The tone frequency in Hz.
+    duration (int): How long the tone plays, in milliseconds.
+
+    Returns:
+    None
+    """
+
+    global latchedTone, latchedToneEndsAt
+    now = clock.time()
+    if latchedTone == (frequency, duration) and now < latchedToneEndsAt:
+        return
+    board.play_tone(pb2, frequency, duration)
+    latchedTone = (frequency, duration)
+    latchedToneEndsAt = now + duration / 1000
+
+def tone_off():
+
+    """
+    Silences the buzzer on PA1 (pb2), unless it is silent already.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    global latchedTone
+    if latchedTone == TONE_OFF:
+        return
+    if latchedTone is None or clock.time() < latchedToneEndsAt:
+        board.play_tone_off(pb2)
+    latchedTone = TONE_OFF
+
+def get_distance(trigPin, trigPinNum):
+
+    """
+    Returns the filtered distance of an ultrasonic sensor from its `DistanceFilter`.
+
+    Once the sensor delivers reports through `sonar_callback()`, the filter is fed by those
+    reports and this function only reads it. Before the first report arrives, this function
+    polls `sonar_read()` once per call and feeds the reading to the filter, so the filter
+    keeps its state across ticks instead of averaging a fresh burst of samples every call.
+    The board is read without holding `sonarLock`, so `sonar_callback()` never waits on a
+    board round trip; the lock only guards the filter and `vehicleTracker`.
+
+    Parameters:
+    trigPin (int): The trigger pin for the ultrasonic sensor.
+    trigPinNum (int): Identifier for selecting the sensor (1, 2, or 3).
+
+    Returns:
+    float or None: The filtered distance, or None if the sensor gives no valid echo.
+    """
+
+    distanceFilter = distanceFilters.get(trigPinNum)
+    if distanceFilter is None:
+        return None
+
+    if not distanceFilter.reporting:
+        distance, timestamp = board.sonar_read(trigPin)
+        with sonarLock:
+            distanceFilter.add(distance, timestamp)
+            track_sample(trigPinNum, distance, timestamp)
+
+    with sonarLock:
+        return distanceFilter.value(clock.time())
+
+def starting():
+
+    """
+    Initializes the system state and resets all subsystem indicators.
+
+    This function performs the following tasks:
+    - Turns off the tone for subsystem 1.
+    - Displays initial LED patterns for all three shift registers, representing subsystems 1 to 4, in one frame.
+    - Stops all flashing lights and resets the iteration counters and first-time flags for the subsystems.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+        
+    global iteration2
+    blinkEngine.clear()
+    #sub 1
+    tone_off()
+    with led_frame():
+        led_display(reg1Normal, 1)
+        #sub 2 & 4
+        led_display(reg2Normal, 2)
+        #sub 3
+        led_display(reg3Normal, 3)
+    iteration2 = 0
+    firstTimeSub1 = False
+    firstTimeSub2 = False
+    firstTimeSub3 = False
+    firstTimeSub4 = False
+
+def ending():
+
+    """
+    Shuts down all subsystems by clearing LED displays and stopping sound.
+
+    This function performs the following shutdown actions:
+    - Turns off any sound playing through the speaker 
+    - Stops all flashing lights.
+    - Clears all LED outputs on shift registers 1, 2, and 3 by sending zeroed patterns in one frame.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    tone_off()
+    blinkEngine.clear()
+    with led_frame():
+        led_display(allOff, 1)
+        led_display(allOff, 2)
+        led_display(allOff, 3)
+
+def read_push_button():
+
+    """
+    Reads the state of a digital push button.
+
+    This function returns whether push button PB1 was pressed since the previous tick,
+    as latched by `latch_crossing_requests()` at the start of the current tick.
+
+    Parameters:
+    None
+
+    Returns:
+    bool: True if the button is pressed, False otherwise.
+    """
+
+    return crossingRequested
+
+def read_all_us():
+
+    """
+    Reads distance measurements from all ultrasonic sensors and updates global variables.
+
+    This function reads the current tick's `sensorSnapshot` for each of the three ultrasonic sensors
+    (US1, US2, and US3), and stores the measured distances in corresponding global variables.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    global objectDistanceUS1, objectDistanceUS2, objectDistanceUS3
+    
+    objectDistanceUS1 = sensorSnapshot.distance(1)
+    objectDistanceUS2 = sensorSnapshot.distance(2)
+    objectDistanceUS3 = sensorSnapshot.distance(3)
+
+def refresh_state():
+
+    """
+    Updates the overheight vehicle detection state for all ultrasonic sensors.
+
+    This function performs the following:
+    - Reads the distances of US1, US2, and US3 from the current tick's `sensorSnapshot`.
+    - Feeds the distances to the `VehicleDetector` of each sensor and updates flags indicating
+      whether an overheight vehicle is currently detected, with hysteresis and dwell times.
+      Detections reported by `sonar_callback()` since the last update are included, so a vehicle
+      passing between two updates is still seen.
+    - Determines whether a vehicle has exited the detection zone since the last update.
+    - Cancels a predicted detection at US1 that was not confirmed in time (see `check_predicted_entry()`)
+      and sets `predictionCancelled`, so the control loop releases subsystem 1.
+    - Logs every vehicle track `vehicleTracker` closed since the last update.
+    - Sets additional system flags such as `override4I3Active` and `readyToReset4I3` for controlling subsystem logic.
+
+    Parameters:
+    None
+
+    Returns:
+    bool: True if a filtered distance, a detection or an exit changed since the last update.
+    """
+
+    global objectDistanceUS1, objectDistanceUS2, objectDistanceUS3
+    global overheightVechicleAtUS1, overheightVechicleAtUS2, overheightVechicleAtUS3
+    global overheightVechicleExitedUS1, overheightVechicleExitedUS2, overheightVechicleExitedUS3, override4I3Active, readyToReset4I3
+    global predictionCancelled
+
+    previousDistances = (objectDistanceUS1, objectDistanceUS2, objectDistanceUS3)
+    objectDistanceUS1 = sensorSnapshot.distance(1)
+    objectDistanceUS2 = sensorSnapshot.distance(2)
+    objectDistanceUS3 = sensorSnapshot.distance(3)
+
+    # Track current status
+    wasUS1 = overheightVechicleAtUS1
+    wasUS2 = overheightVechicleAtUS2
+    wasUS3 = overheightVechicleAtUS3
+    wasDetected = [detector.detected for detector in vehicleDetectors.values()]
+    wasExited = (overheightVechicleExitedUS1, overheightVechicleExitedUS2, overheightVechicleExitedUS3)
+
+    # Update the detectors and consume the detections latched by the sonar callback since the last update
+    now = clock.time()
+    with sonarLock:
+        predictionCancelled = check_predicted_entry(now)
+        vehicleDetectors[1].update(objectDistanceUS1, now)
+        vehicleDetectors[2].update(objectDistanceUS2, now)
+        vehicleDetectors[3].update(objectDistanceUS3, now)
+        enteredUS1, enteredUS2, enteredUS3 = sonarEnteredLatch[1], sonarEnteredLatch[2], sonarEnteredLatch[3]
+        for sensorNum in sonarEnteredLatch:
+            sonarEnteredLatch[sensorNum] = False
+        closedTracks = vehicleTracker.take_closed(now) if vehicleTracker is not None else []
+
+    if predictionCancelled:
+        log_event(WARNING, 'prediction_cancelled', sensor=1, distance=objectDistanceUS1)
+    for track in closedTracks:
+        log_event(INFO, 'vehicle_track', **track.summary(sensorPositions, scaleRatio))
+
+    # Update "At" flags, a vehicle that came and went since the last update is still seen once
+    overheightVechicleAtUS1 = vehicleDetectors[1].detected or enteredUS1
+    overheightVechicleAtUS2 = vehicleDetectors[2].detected or enteredUS2
+    overheightVechicleAtUS3 = vehicleDetectors[3].detected or enteredUS3
+
+    for sensorNum, wasAt, isAt, distance in ((1, wasUS1, overheightVechicleAtUS1, objectDistanceUS1),
+                                             (2, wasUS2, overheightVechicleAtUS2, objectDistanceUS2),
+                                             (3, wasUS3, overheightVechicleAtUS3, objectDistanceUS3)):
+        if isAt != wasAt:
+            log_event(INFO, 'vehicle_detected' if isAt else 'vehicle_left', sensor=sensorNum, distance=distance)
+
+    # If it was there, but now it isn't → mark as exited
+    if wasUS1 and not overheightVechicleAtUS1:
+        overheightVechicleExitedUS1 = True
+        overheightVechicleAtUS1 = False
+    else:
+        overheightVechicleExitedUS1 = False
+
+    if wasUS2 and not overheightVechicleAtUS2:
+        overheightVechicleExitedUS2 = True
+        overheightVechicleAtUS2 = False
+    else:
+        overheightVechicleExitedUS2 = False
+
+    if wasUS3 and not overheightVechicleAtUS3:
+        overheightVechicleExitedUS3 = True
+        overheightVechicleAtUS3 = False
+        readyToReset4I3 = True
+    else:
+        overheightVechicleExitedUS3 = False
+
+    # If US2 detects anything at all → activate override
+    if overheightVechicleAtUS2:
+        override4I3Active = True
+
+    return ((objectDistanceUS1, objectDistanceUS2, objectDistanceUS3) != previousDistances
+            or (overheightVechicleAtUS1, overheightVechicleAtUS2, overheightVechicleAtUS3) != (wasUS1, wasUS2, wasUS3)
+            or (overheightVechicleExitedUS1, overheightVechicleExitedUS2, overheightVechicleExitedUS3) != wasExited
+            or [detector.detected for detector in vehicleDetectors.values()] != wasDetected
+            or predictionCancelled)
+
+def us_detected(sensorNum):
+
+    """
+    Returns True while the `VehicleDetector` of an ultrasonic sensor detects a vehicle.
+
+    Parameters:
+    sensorNum (int): Identifier for selecting the sensor (1, 2, or 3).
+
+    Returns:
+    bool: True if a vehicle is detected, with the hysteresis and dwell times of the detector.
+    """
+
+    return vehicleDetectors[sensorNum].detected
+
+def sub3i2(startTime):
+
+    """
+    Controls the LED states and timing logic for subsystem 3 integrate subsystem 2 based on elapsed time and button press.
+
+    This function:
+    - Tracks elapsed time since `startTime` to manage LED color transitions on shift register 2.
+    - Changes LEDs according to a time schedule: yellow before 2 seconds, red between 2 and 7 seconds, then green after 7 seconds.
+    - Monitors a push button press to immediately switch the LED pattern to green and turn off red.
+    - Manages the running state flag `running3I2` and updates the subsystem start time.
+
+    Parameters:
+    startTime (float): The timestamp when subsystem 3 integrate subsystem 2 started, used for elapsed time calculation.
+
+    Returns:
+    None
+    """
+
+    global running3I2, startTime3I2
+    timeDiff = clock.time() - startTime
+    log_event(DEBUG, 'subsystem_tick', subsystem='sub3i2', elapsed=timeDiff)
+
+    if running3I2 == False: 
+        startTime3I2 = startTime
+        running3I2 = True
+        update_register2(setBits=redPL1Bit)
+
+    if read_push_button() == True:
+        log_event(INFO, 'crossing_request', subsystem='sub3i2')
+        update_register2(setBits=greenPL1Bit, clearBits=redPL1Bit)
+        led_display(stateShiftRegister2, 2)
+    if timeDiff < 2:
+        update_register2(setBits=yellowTL4Bit, clearBits=greenTL4Bit)
+        led_display(stateShiftRegister2, 2)
+    elif timeDiff < 7:
+        update_register2(setBits=redTL4Bit, clearBits=yellowTL4Bit | redPL1Bit)
+        led_display(stateShiftRegister2, 2)
+    else:
+        log_event(INFO, 'subsystem_done', subsystem='sub3i2')
+        update_register2(setBits=greenTL4Bit | redPL1Bit, clearBits=redTL4Bit | greenPL1Bit)
+        led_display(stateShiftRegister2, 2)
+        running3I2 = False
+
+def subsystem1(startTime):
+
+    """
+    Controls the behavior of subsystem 1, handling LED patterns and buzzer tones for overheight vehicle detection.
+
+    The function manages a sequence of LED displays and buzzer sounds based on the elapsed time since `startTime`.
+    It includes an initial measurement of vehicle height (see `vehicle_height()`), warning signals with increasing urgency,
+    and a blinking LED pattern with corresponding buzzer frequencies.
+
+    The function respects an override flag to pause its execution and resets state variables when the subsystem ends.
+
+    Parameters:
+    startTime (float): Timestamp marking when subsystem 1 started, used to calculate elapsed time.
+
+    Returns:
+    None
+    """
+
+    global runningSub1, override4I3Active, firstTimeSub1
+
+    if override4I3Active:
+        return
+    
+    if firstTimeSub1 == False:
+        firstTimeSub1 = True
+        objectDistanceUS1 = sensorSnapshot.distance(1)
+        vechicleHeightMetre = vehicle_height(1, objectDistanceUS1)
+        log_event(WARNING, 'overheight_vehicle', sensor=1, distance=objectDistanceUS1, heightMetre=vechicleHeightMetre, buzzerHz=2500)
+
+    timeDiff = clock.time() - startTime
+    log_event(DEBUG, 'subsystem_tick', subsystem='sub1', elapsed=timeDiff)
+
+    if timeDiff < 1:
+        tone_off()
+        led_display(reg1Stopping, 1)
+
+    elif 1 <= timeDiff < 2:
+        led_display(reg1Warning, 1)
+        tone_on(3000, 1000) # passize buzzer sounds at 3000Hz
+
+    elif 2 <= timeDiff < 32: 
+        tone_on(3000, 30000)
+        blinkEngine.set_blinking(1, 0, True) # QH flashes
+        led_display(reg1Flashing, 1)
+
+    elif timeDiff >= 32:
+        if us_detected(1):
+            tone_on(5000, 120000000000000000) # passive buzzer sounds at 5000Hz
+        blinkEngine.set_blinking(1, 0, True) # QH flashes
+        led_display(reg1Flashing, 1)
+        if us3CameAndLeft == True and us_detected(1):
+            log_event(INFO, 'subsystem_done', subsystem='sub1')
+            tone_off()
+            blinkEngine.set_blinking(1, 0, False)
+            led_display(reg1Normal, 1)
+            runningSub1 = False 
+            firstTimeSub1 = False
+
+def starting_sub1():
+
+    """
+    Reset subsystem 1 indicators by turning off the buzzer and setting the LED pattern.
+
+    This function stops any buzzer sound on PA1, stops the flashing light of subsystem 1
+    and updates the LEDs of shift register 1 to the initial pattern `reg1Normal`,
+    indicating the subsystem reset state.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+ 
+    tone_off()
+    blinkEngine.set_blinking(1, 0, False)
+    led_display(reg1Normal, 1)
+
+def subsystem2(startTime):
+
+    """
+    Manage the behavior and LED signaling of subsystem 2 based on elapsed time since start.
+
+    This function controls the timing and LED states for subsystem 2:
+    - On the first call, it registers the button press.
+    - Between 0-2 seconds: subsystem runs without LED changes.
+    - Between 2-4 seconds: sets yellow traffic light on TL4 and green on TL3; red pedestrian light on PL1.
+    - Between 4-7 seconds: switches TL4 light from yellow to red; pedestrian light PL1 changes to green.
+    - Between 7-9 seconds: blinks red pedestrian light PL1.
+    - After 9 seconds: resets the lights to red on PL1, green on TL4, turns off red on TL4, marks subsystem as stopped, and resets counters.
+
+    Parameters:
+    startTime (float): The start time timestamp of the subsystem operation.
+
+    Returns:
+    None
+    """
+
+    global iteration, timePrevious2, runningSub2, lastState2, firstTimeSub2
+    timeDiff = clock.time() - startTime
+    log_event(DEBUG, 'subsystem_tick', subsystem='sub2', elapsed=timeDiff)
+
+    if firstTimeSub2 == False:
+        firstTimeSub2 = True
+        log_event(INFO, 'subsystem_start', subsystem='sub2', cause='PB1')
+
+    if timeDiff < 2:
+        runningSub2 = True
+        
+    elif 2 < timeDiff < 4:
+        runningSub2 = True
+        update_register2(setBits=yellowTL4Bit | greenTL3Bit | redPL1Bit, clearBits=greenTL4Bit)
+        led_display(stateShiftRegister2, 2)
+    elif 4 < timeDiff < 7:
+        runningSub2 = True
+        update_register2(setBits=redTL4Bit | greenPL1Bit, clearBits=yellowTL4Bit | redPL1Bit)
+        led_display(stateShiftRegister2, 2)
+
+    if 7 < timeDiff < 9:
+        update_register2(setBits=redPL1Bit, clearBits=greenPL1Bit)
+        blinkEngine.set_blinking(2, redPL1, True)
+        iteration+=1
+
+        led_display(stateShiftRegister2, 2)
+        
+        log_event(DEBUG, 'pedestrian_flashing', iteration=iteration)
+    if timeDiff > 9:
+        log_event(DEBUG, 'subsystem_phase', subsystem='sub2', phase='restore')
+        blinkEngine.set_blinking(2, redPL1, False)
+        update_register2(setBits=redPL1Bit | greenTL4Bit, clearBits=redTL4Bit)
+        led_display(stateShiftRegister2, 2)
+        lastState2 = button_level()
+        timePrevious2 = clock.time()
+        runningSub2 = False
+        log_event(INFO, 'subsystem_done', subsystem='sub2')
+        iteration  = 0
+        firstTimeSub2 = False
+        
+def subsystem3(startTime):
+
+    """
+    Control the behavior and LED signaling of subsystem 3 based on elapsed time.
+
+    This function manages subsystem 3 in phases according to time since startTime:
+    - For the first 2 seconds:
+      * Resets the 'us3CameAndLeft' flag.
+      * Calls sub3i2 to handle button press logic.
+      * Displays a specific LED pattern on shift register 3.
+    - Between 2 and 7 seconds:
+      * Displays a different LED pattern.
+      * If US3 no longer detects the vehicle (see `us_detected()`), sets 'us3CameAndLeft' to True.
+    - After 7 seconds:
+      * If US3 still detects the vehicle, flashes the green LED through `blinkEngine`.
+      * If no object detected, stops the flashing, displays a steady LED pattern,
+        marks subsystem 3 as done and sets 'us3CameAndLeft' to True.
+
+    Parameters:
+    startTime (float): The timestamp marking the start of subsystem 3 operation.
+
+    Returns:
+    None
+    """
+
+    global runningSub3, override4I3Active, us3CameAndLeft 
+    
+    timeDiff = clock.time() - startTime 
+    log_event(DEBUG, 'subsystem_tick', subsystem='sub3', elapsed=timeDiff)
+
+    if timeDiff < 2:
+        us3CameAndLeft = False
+        sub3i2(startTime)
+        led_display(reg3Entry, 3)
+
+    elif 2 < timeDiff < 7:
+        led_display(reg3Merge, 3)
+
+        if not us_detected(3):
+            us3CameAndLeft = True
+
+    elif timeDiff > 7:
+        if us_detected(3):
+            blinkEngine.set_blinking(3, 0, True) # QH flashes green
+            led_display(reg3Flashing, 3)
+        else:
+            blinkEngine.set_blinking(3, 0, False)
+            led_display(reg3Normal, 3)
+            log_event(INFO, 'subsystem_done', subsystem='sub3')
+            runningSub3 = False
+            us3CameAndLeft = True
+
+def subsystem4(startTime):
+
+    """
+    Manage subsystem 4 behavior and LED signaling based on ultrasonic sensor 2 detection.
+
+    This function performs the following steps:
+    - Stops runningSub2, its flashing pedestrian light, and resets its iteration and timer.
+    - Prints status messages indicating subsystem start and US2 detection.
+    - Sets specific LEDs on shift register 2 to represent the current state.
+    - If US2 still detects the vehicle (see `us_detected()`):
+      * Updates LED states on shift register 2 to indicate detection.
+      * Flashes the warning LED (redWL2) through `blinkEngine`.
+
+    Parameters:
+    startTime (float): The timestamp marking the start of subsystem 4 operation.
+
+    Returns:
+    None
+    """
+        
+    global runningSub2, timePrevious2, iteration, runningSub4, override4I3Active 
+
+    runningSub2 = False
+    blinkEngine.set_blinking(2, redPL1, False)
+    iteration = 0
+    timePrevious2 = clock.time()
+
+    timeDiff = clock.time() - startTime
+    log_event(DEBUG, 'subsystem_tick', subsystem='sub4', elapsed=timeDiff)
+
+    update_register2(setBits=redTL3Bit | redPL1Bit, clearBits=greenTL3Bit | greenPL1Bit)
+    led_display(stateShiftRegister2, 2)
+
+    if us_detected(2):
+        log_event(DEBUG, 'vehicle_present', sensor=2, distance=objectDistanceUS2)
+        update_register2(setBits=redTL4Bit | redWL2Bit, clearBits=yellowTL4Bit | greenTL4Bit)
+        blinkEngine.set_blinking(2, redWL2, True)
+        led_display(stateShiftRegister2, 2) 
+        
+def check_reset_4I3():
+
+    """
+    Check conditions and reset the subsystem 4 integrate subsystem 3 system to normal state if criteria are met.
+
+    This function monitors the ultrasonic sensors and internal flags to determine if the
+    system should reset from an override or alert state back to normal operation.
+    The reset happens only if:
+    - readyToReset4I3 is True,
+    - no overheight vehicles are detected by US1 and US2 (see `us_detected()`),
+    - and the flag us3CameAndLeft indicates the vehicle has left the last sensor.
+
+    Upon reset:
+    - Flashing lights of subsystems 1, 3 and 4 are stopped.
+    - Subsystem 1 LEDs are reset to their normal state.
+    - Shift register 2 LEDs controlling various traffic lights are set to normal.
+    - Subsystem 3's traffic light is set to red.
+    - The three registers are latched in one frame.
+    - Override and running flags are cleared.
+
+    Parameters:
+    None
+
+    Returns:
+    bool: True if the system was reset, False otherwise.
+    """
+
+    global override4I3Active, runningSub1, runningSub3, runningSub4
+    global readyToReset4I3
+
+    log_event(DEBUG, 'reset_4i3_check', ready=readyToReset4I3, us3CameAndLeft=us3CameAndLeft)
+
+    if (
+        readyToReset4I3 and
+        not us_detected(1) and
+        not us_detected(2) and
+        us3CameAndLeft
+    ):
+        log_event(INFO, 'reset_4i3')
+
+        blinkEngine.set_blinking(1, 0, False)
+        blinkEngine.set_blinking(2, redWL2, False)
+        blinkEngine.set_blinking(3, 0, False)
+
+        update_register2(setBits=greenTL3Bit | greenTL4Bit, clearBits=redTL3Bit | redWL2Bit | yellowTL4Bit | redTL4Bit)
+        with led_frame():
+            led_display(reg1Normal, 1)
+            led_display(stateShiftRegister2, 2)
+            led_display(reg3Merge, 3)
+
+        override4I3Active = False
+        runningSub1 = False
+        runningSub3 = False
+        runningSub4 = False 
+        readyToReset4I3 = False
+        return True
+
+    return False
+
+# ---------------------------------------------------------------------------
+# Table-driven state machines
+# ---------------------------------------------------------------------------
+# Subsystems 1-4 and 3.I2 as state machines (see state_machine.py). Each phase of a subsystem
+# is a state entered by a timed transition, and the lights and tones of a phase are set once
+# by the entry action of its state. Input-driven transitions use the "input" event, which is
+# raised whenever the sensors or PB1 change or another machine changes state, and internal
+# events raised by other machines.
+
+# events raised by entry actions for the other machines, handled in the same step
+pendingEvents = set()
+
+def sub1_start(now):
+
+    """
+    Logs the overheight vehicle at US1 with its height when subsystem 1 starts.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    objectDistanceUS1 = sensorSnapshot.distance(1)
+    vechicleHeightMetre = vehicle_height(1, objectDistanceUS1)
+    log_event(WARNING, 'overheight_vehicle', sensor=1, distance=objectDistanceUS1, heightMetre=vechicleHeightMetre, buzzerHz=2500)
+
+def sub1_enter_stopping(now):
+
+    """
+    Entry action of sub1 'stopping': silences PA1 and shows `reg1Stopping`.
+    Does nothing while subsystem 4 overrides the junction (`override4I3Active`).
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    if override4I3Active:
+        return
+    tone_off()
+    led_display(reg1Stopping, 1)
+
+def sub1_enter_warning(now):
+
+    """
+    Entry action of sub1 'warning': shows `reg1Warning` and sounds PA1 at 3000 Hz.
+    Does nothing while subsystem 4 overrides the junction (`override4I3Active`).
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    if override4I3Active:
+        return
+    led_display(reg1Warning, 1)
+    tone_on(3000, 1000) # passize buzzer sounds at 3000Hz
+
+def sub1_enter_flashing(now):
+
+    """
+    Entry action of sub1 'flashing': sounds PA1 at 3000 Hz and flashes QH of register 1.
+    Does nothing while subsystem 4 overrides the junction (`override4I3Active`).
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    if override4I3Active:
+        return
+    tone_on(3000, 30000)
+    blinkEngine.set_blinking(1, 0, True) # QH flashes
+    led_display(reg1Flashing, 1)
+
+def sub1_alarm(now):
+
+    """
+    Entry action of sub1 'alarm', run again on every "input" event while in it.
+    Sounds PA1 at 5000 Hz while US1 still detects the vehicle and keeps QH of register 1 flashing.
+    Does nothing while subsystem 4 overrides the junction (`override4I3Active`).
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    if override4I3Active:
+        return
+    if us_detected(1):
+        tone_on(5000, 120000000000000000) # passive buzzer sounds at 5000Hz
+    blinkEngine.set_blinking(1, 0, True)
+    led_display(reg1Flashing, 1)
+
+def sub1_done(now):
+
+    """
+    Ends subsystem 1 once the vehicle at US3 has left: silences PA1 and restores `reg1Normal`.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    log_event(INFO, 'subsystem_done', subsystem='sub1')
+    tone_off()
+    blinkEngine.set_blinking(1, 0, False)
+    led_display(reg1Normal, 1)
+
+def sub1_vehicle_left_at_us3(now):
+
+    """
+    Guard releasing subsystem 1 when the vehicle left through US3 and none is at US1.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    bool: True if subsystem 1 can be released.
+    """
+
+    return (overheightVechicleAtUS3 or stateMachines['sub3'].state != 'idle') and overheightVechicleExitedUS3 and not overheightVechicleAtUS1
+
+def sub1_released(now):
+
+    """
+    Releases subsystem 1 after the vehicle left through US3.
+    The 4.I3 reset flags are cleared, as there is nothing left for `check_reset_4I3()` to reset,
+    and register 1 and PA1 are reset with `starting_sub1()`.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global readyToReset4I3, override4I3Active
+    readyToReset4I3 = False
+    override4I3Active = False
+    starting_sub1()
+
+def sub2_can_start(now):
+
+    """
+    Guard starting subsystem 2 on a PB1 press once the pedestrian lockout has passed and PB1 was released.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    bool: True if the pedestrian crossing can start.
+    """
+
+    return now - timePrevious2 > pedestrianLockout and lastState2 == 0
+
+def sub2_start(now):
+
+    """
+    Logs the start of the pedestrian crossing requested with PB1.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    log_event(INFO, 'subsystem_start', subsystem='sub2', cause='PB1')
+
+def sub2_enter_amber(now):
+
+    """
+    Entry action of sub2 'amber': TL4 turns amber, TL3 green and PL1 red.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    update_register2(setBits=yellowTL4Bit | greenTL3Bit | redPL1Bit, clearBits=greenTL4Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub2_enter_walk(now):
+
+    """
+    Entry action of sub2 'walk': TL4 turns red and PL1 green.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    update_register2(setBits=redTL4Bit | greenPL1Bit, clearBits=yellowTL4Bit | redPL1Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub2_enter_flashing(now):
+
+    """
+    Entry action of sub2 'flashing': PL1 turns red and flashes.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    update_register2(setBits=redPL1Bit, clearBits=greenPL1Bit)
+    blinkEngine.set_blinking(2, redPL1, True)
+    led_display(stateShiftRegister2, 2)
+
+def sub2_done(now):
+
+    """
+    Ends subsystem 2: PL1 stops flashing and TL4 turns green.
+    The pedestrian lockout starts, and the crossing stays disarmed while PB1 is still held.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global lastState2, timePrevious2
+    blinkEngine.set_blinking(2, redPL1, False)
+    update_register2(setBits=redPL1Bit | greenTL4Bit, clearBits=redTL4Bit)
+    led_display(stateShiftRegister2, 2)
+    lastState2 = button_level()
+    timePrevious2 = now
+    log_event(INFO, 'subsystem_done', subsystem='sub2')
+
+def sub3_enter_entry(now):
+
+    """
+    Entry action of sub3 'entry': shows `reg3Entry` and starts subsystem 3 integrate 2.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global us3CameAndLeft
+    us3CameAndLeft = False
+    pendingEvents.add('start_3i2')
+    led_display(reg3Entry, 3)
+
+def sub3_enter_merge(now):
+
+    """
+    Entry action of sub3 'merge': shows `reg3Merge` and checks whether the vehicle has already left US3.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    led_display(reg3Merge, 3)
+    sub3_check_left(now)
+
+def sub3_check_left(now):
+
+    """
+    Marks the vehicle at US3 as gone (`us3CameAndLeft`) once US3 no longer detects it.
+    Raises "input", so subsystem 1 sees the change in the same step.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global us3CameAndLeft
+    if not us_detected(3) and not us3CameAndLeft:
+        us3CameAndLeft = True
+        pendingEvents.add('input')
+
+def sub3_flash(now):
+
+    """
+    Action of sub3 'clearing' on every "input" event: flashes QH of register 3 while the vehicle is at US3.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    blinkEngine.set_blinking(3, 0, True) # QH flashes green
+    led_display(reg3Flashing, 3)
+
+def sub3_done(now):
+
+    """
+    Ends subsystem 3 once US3 is clear: stops the flashing, restores `reg3Normal` and sets `us3CameAndLeft`.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global us3CameAndLeft
+    blinkEngine.set_blinking(3, 0, False)
+    led_display(reg3Normal, 3)
+    log_event(INFO, 'subsystem_done', subsystem='sub3')
+    us3CameAndLeft = True
+
+def sub3i2_enter_amber(now):
+
+    """
+    Entry action of sub3i2 'amber': TL4 turns amber and PL1 red.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    update_register2(setBits=redPL1Bit | yellowTL4Bit, clearBits=greenTL4Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub3i2_enter_red(now):
+
+    """
+    Entry action of sub3i2 'red': TL4 turns red.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    update_register2(setBits=redTL4Bit, clearBits=yellowTL4Bit | redPL1Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub3i2_button(now):
+
+    """
+    Handles a PB1 press during subsystem 3 integrate 2: PL1 turns green.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    log_event(INFO, 'crossing_request', subsystem='sub3i2')
+    update_register2(setBits=greenPL1Bit, clearBits=redPL1Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub3i2_done(now):
+
+    """
+    Ends subsystem 3 integrate 2: TL4 turns green and PL1 red.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    log_event(INFO, 'subsystem_done', subsystem='sub3i2')
+    update_register2(setBits=greenTL4Bit | redPL1Bit, clearBits=redTL4Bit | greenPL1Bit)
+    led_display(stateShiftRegister2, 2)
+
+def sub4_can_start(now):
+
+    """
+    Guard starting subsystem 4 while US2 detects an overheight vehicle.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    bool: True if subsystem 4 can start.
+    """
+
+    return overheightVechicleAtUS2 and us_detected(2)
+
+def sub4_alert(now):
+
+    """
+    Entry action of sub4 'alert', run again on every "input" event while in it.
+    TL3 and PL1 turn red, and TL4 red with WL2 flashing while US2 detects the vehicle.
+    A running pedestrian crossing is ended with the "sub4_alert" event and its lockout restarted.
+
+    Parameters:
+    now (float): The current timestamp.
+
+    Returns:
+    None
+    """
+
+    global timePrevious2
+    if not overheightVechicleAtUS2:
+        return
+    # subsystem 4 takes over TL4 and PL1 from a running pedestrian cycle
+    if stateMachines['sub2'].state != 'idle':
+        pendingEvents.add('sub4_alert')
+    timePrevious2 = now
+    blinkEngine.set_blinking(2, redPL1, False)
+    update_register2(setBits=redTL3Bit | redPL1Bit, clearBits=greenTL3Bit | greenPL1Bit)
+    if us_detected(2):
+        update_register2(setBits=redTL4Bit | redWL2Bit, clearBits=yellowTL4Bit | greenTL4Bit)
+        blinkEngine.set_blinking(2, redWL2, True)
+    led_display(stateShiftRegister2, 2)
+
+def build_state_machines():
+
+    """
+    Builds the transition tables of subsystems 1-4 and subsystem 3 integrate 2.
+
+    States and timed transitions follow the phase boundaries of the subsystem functions:
+    - sub1: idle -> stopping (US1 detects) -> warning (1 s) -> flashing (2 s) -> alarm (32 s) -> idle
+    - sub2: idle -> waiting (PB1) -> amber (2 s) -> walk (4 s) -> flashing (7 s) -> idle (9 s)
+    - sub3: idle -> entry (US3 detects) -> merge (2 s) -> clearing (7 s) -> idle (US3 clear)
+    - sub3i2: idle -> amber (started by sub3) -> red (2 s) -> idle (7 s)
+    - sub4: idle -> alert (US2 detects) -> idle (4.I3 reset)
+
+    Parameters:
+    None
+
+    Returns:
+    dict: Maps the machine name to its `StateMachine`, in the order the machines are stepped.
+    """
+
+    sub1Running = ('stopping', 'warning', 'flashing', 'alarm')
+    sub2Running = ('waiting', 'amber', 'walk', 'flashing')
+    sub3Running = ('entry', 'merge', 'clearing')
+
+    sub1 = StateMachine('sub1', 'idle', [
+        Transition('idle', 'stopping', 'input', guard=lambda now: overheightVechicleAtUS1, action=sub1_start),
+        Transition(sub1Running, 'idle', 'reset_4i3'),
+        Transition(sub1Running, 'idle', 'input', guard=lambda now: predictionCancelled, action=lambda now: starting_sub1()),
+        Transition(sub1Running, 'idle', 'input', guard=sub1_vehicle_left_at_us3, action=sub1_released),
+        Transition('stopping', 'warning', after=phaseBoundariesSub1[0]),
+        Transition('warning', 'flashing', after=phaseBoundariesSub1[1] - phaseBoundariesSub1[0]),
+        Transition('flashing', 'alarm', after=phaseBoundariesSub1[2] - phaseBoundariesSub1[1]),
+        Transition('alarm', 'idle', 'input', guard=lambda now: us3CameAndLeft and us_detected(1), action=sub1_done),
+        Transition('alarm', None, 'input', action=sub1_alarm),
+    ], onEnter={
+        'stopping': sub1_enter_stopping,
+        'warning': sub1_enter_warning,
+        'flashing': sub1_enter_flashing,
+        'alarm': sub1_alarm,
+    })
+
+    sub4 = StateMachine('sub4', 'idle', [
+        Transition('idle', 'alert', 'input', guard=sub4_can_start),
+        Transition('alert', 'idle', 'reset_4i3'),
+        Transition('alert', None, 'input', action=sub4_alert),
+    ], onEnter={
+        'alert': sub4_alert,
+    })
+
+    sub3 = StateMachine('sub3', 'idle', [
+        Transition('idle', 'entry', 'input', guard=lambda now: overheightVechicleAtUS3),
+        Transition(sub3Running, 'idle', 'reset_4i3'),
+        Transition('entry', 'merge', after=phaseBoundariesSub3[0]),
+        Transition('merge', 'clearing', after=phaseBoundariesSub3[1] - phaseBoundariesSub3[0]),
+        Transition('merge', None, 'input', action=sub3_check_left),
+        Transition('clearing', 'idle', 'input', guard=lambda now: not us_detected(3), action=sub3_done),
+        Transition('clearing', None, 'input', action=sub3_flash),
+    ], onEnter={
+        'entry': sub3_enter_entry,
+        'merge': sub3_enter_merge,
+    })
+
+    sub2 = StateMachine('sub2', 'idle', [
+        Transition('idle', 'waiting', 'button', guard=sub2_can_start, action=sub2_start),
+        Transition(sub2Running, 'idle', 'sub4_alert'),
+        Transition('waiting', 'amber', after=phaseBoundariesSub2[0]),
+        Transition('amber', 'walk', after=phaseBoundariesSub2[1] - phaseBoundariesSub2[0]),
+        Transition('walk', 'flashing', after=phaseBoundariesSub2[2] - phaseBoundariesSub2[1]),
+        Transition('flashing', 'idle', after=phaseBoundariesSub2[3] - phaseBoundariesSub2[2], action=sub2_done),
+    ], onEnter={
+        'amber': sub2_enter_amber,
+        'walk': sub2_enter_walk,
+        'flashing': sub2_enter_flashing,
+    })
+
+    sub3i2 = StateMachine('sub3i2', 'idle', [
+        Transition('idle', 'amber', 'start_3i2'),
+        Transition(('amber', 'red'), None, 'button', action=sub3i2_button),
+        Transition('amber', 'red', after=phaseBoundaries3I2[0]),
+        Transition('red', 'idle', after=phaseBoundaries3I2[1] - phaseBoundaries3I2[0], action=sub3i2_done),
+    ], onEnter={
+        'amber': sub3i2_enter_amber,
+        'red': sub3i2_enter_red,
+    })
+
+    return {'sub1': sub1, 'sub4': sub4, 'sub3': sub3, 'sub2': sub2, 'sub3i2': sub3i2}
+
+# stateMachines are built by build_derived_state()
+maxStepPasses = 4 # bound on chained transitions handled in one step
+
+def state_machine_step(now=None):
+
+    """
+    Handles the current inputs and due timers with the state machines.
+
+    This function samples the sensors once, updates the detection state and checks the
+    4.I3 reset. It then steps every machine with the PB1 press, the reset, and the "input"
+    event if `refresh_state()` saw a distance, detection or exit change or PB1 was pressed.
+    Due timers fire without any event. Stepping continues with the events raised by actions,
+    and with "input" after a pass in which a machine changed state, until no machine changes
+    state. When every subsystem is back to idle the junction returns to its normal pattern
+    with `starting()`. The legacy running flags are kept in sync with the machines.
+
+    Parameters:
+    now (float): The current timestamp, None to use the current time.
+
+    Returns:
+    None
+    """
+
+    global runningSub1, runningSub2, runningSub3, runningSub4, running3I2
+
+    if now is None:
+        now = clock.time()
+
+    sensorSnapshot.refresh()
+    latch_crossing_requests()
+    inputsChanged = refresh_state()
+
+    wasAllIdle = all(stateMachines[name].state == 'idle' for name in ('sub1', 'sub2', 'sub3', 'sub4'))
+    events = set()
+    if inputsChanged:
+        events.add('input')
+    if check_reset_4I3():
+        events.add('reset_4i3')
+    if read_push_button():
+        events.update(('button', 'input'))
+
+    for stepPass in range(maxStepPasses):
+        changed = False
+        for machine in stateMachines.values():
+            source = machine.state
+            if machine.step(events, now):
+                changed = True
+                log_event(INFO, 'transition', machine=machine.name, source=source, target=machine.state)
+        if not changed and len(pendingEvents) == 0:
+            break
+        # a state change is an input of the other machines' guards, e.g. sub1_vehicle_left_at_us3()
+        events = set(pendingEvents)
+        if changed:
+            events.add('input')
+        pendingEvents.clear()
+
+    runningSub1 = stateMachines['sub1'].state != 'idle'
+    runningSub2 = stateMachines['sub2'].state != 'idle'
+    runningSub3 = stateMachines['sub3'].state != 'idle'
+    runningSub4 = stateMachines['sub4'].state != 'idle'
+    running3I2 = stateMachines['sub3i2'].state != 'idle'
+
+    if not (runningSub1 or runningSub2 or runningSub3 or runningSub4) and not wasAllIdle:
+        log_event(INFO, 'normal_pattern')
+        starting()
+
+    blinkEngine.update(now)
+
+def state_machine_status(now=None):
+
+    """
+    Reports the current state of every machine and the time to its next timed transition.
+
+    Parameters:
+    now (float): The current timestamp, None to use the current time.
+
+    Returns:
+    dict: Maps the machine name to its `StateMachine.status()`.
+    """
+
+    if now is None:
+        now = clock.time()
+    return {name: machine.status(now) for name, machine in stateMachines.items()}
+
+def reset_state_machines(now=None):
+
+    """
+    Puts every machine back in its idle state, e.g. when the junction is started.
+
+    Parameters:
+    now (float): The current timestamp, None to use the current time.
+
+    Returns:
+    None
+    """
+
+    if now is None:
+        now = clock.time()
+    for machine in stateMachines.values():
+        machine.reset(now)
+    pendingEvents.clear()
+
+def reset_junction(now=None):
+
+    """
+    Puts every flag, timer and buffer of the control loop back in its power-on state,
+    e.g. before a benchmark scenario or a trace replay is run.
+
+    Parameters:
+    now (float): The current timestamp, None to use the current time.
+
+    Returns:
+    None
+    """
+
+    global runningSub1, runningSub2, runningSub3, runningSub4, running3I2
+    global firstTimeSub1, firstTimeSub2, us3CameAndLeft, override4I3Active, readyToReset4I3
+    global overheightVechicleAtUS1, overheightVechicleAtUS2, overheightVechicleAtUS3
+    global overheightVechicleExitedUS1, overheightVechicleExitedUS2, overheightVechicleExitedUS3
+    global timePrevious2, lastState2, iteration, stateShiftRegister2, predictedEntryDeadline
+
+    if now is None:
+        now = clock.time()
+    runningSub1 = runningSub2 = runningSub3 = runningSub4 = running3I2 = False
+    firstTimeSub1 = firstTimeSub2 = us3CameAndLeft = override4I3Active = readyToReset4I3 = False
+    overheightVechicleAtUS1 = overheightVechicleAtUS2 = overheightVechicleAtUS3 = False
+    overheightVechicleExitedUS1 = overheightVechicleExitedUS2 = overheightVechicleExitedUS3 = False
+    timePrevious2 = 0
+    lastState2 = 0
+    iteration = 0
+    stateShiftRegister2 = 0
+    for sensorNum in distanceFilters:
+        distanceFilters[sensorNum].reset()
+        vehicleDetectors[sensorNum].reset()
+        sonarEnteredLatch[sensorNum] = False
+    sensorSnapshot.invalidate()
+    samplingPolicy.reset()
+    if vehicleTracker is not None:
+        vehicleTracker.reset()
+    predictedEntryDeadline = None
+    blinkEngine.clear()
+    blinkEngine.epoch = now
+    blinkEngine.lastPhase = None
+    reset_state_machines(now)
+
+def build_derived_state():
+
+    """
+    Builds every table and object derived from the settings of this module.
+
+    These are the pin tables, the register bit masks, the sensor filters and detectors, the
+    sampling policy, the sensor snapshot, the blink engine and the state machines. They are
+    built once at import. multi_junction.py builds them again for its copy of this module
+    after applying a junction's settings and clock, so every setting takes effect.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    global trigPins, echoPins, sensorNums, shiftRegisterPins
+    global redTL3Bit, greenTL3Bit, redWL2Bit, greenPL1Bit, redPL1Bit, greenTL4Bit, yellowTL4Bit, redTL4Bit
+    global distanceFilters, vehicleDetectors, samplingPolicy, sensorSnapshot, blinkEngine, stateMachines
+
+    trigPins = {1: us1Trig, 2: us2Trig, 3: us3Trig}
+    echoPins = {1: us1Echo, 2: us2Echo, 3: us3Echo}
+    sensorNums = {us1Trig: 1, us2Trig: 2, us3Trig: 3}
+    shiftRegisterPins = {
+        1: (serialPin1, srclkPin1, rclkPin1),
+        2: (serialPin2, srclkPin2, rclkPin2),
+        3: (serialPin3, srclkPin3, rclkPin3),
+    }
+
+    redTL3Bit = 0x80 >> redTL3
+    greenTL3Bit = 0x80 >> greenTL3
+    redWL2Bit = 0x80 >> redWL2
+    greenPL1Bit = 0x80 >> greenPL1
+    redPL1Bit = 0x80 >> redPL1
+    greenTL4Bit = 0x80 >> greenTL4
+    yellowTL4Bit = 0x80 >> yellowTL4
+    redTL4Bit = 0x80 >> redTL4
+
+    distanceFilters = {sensorNum: DistanceFilter(filterAlpha, outlierGate, confirmTime) for sensorNum in (1, 2, 3)}
+    vehicleDetectors = {sensorNum: VehicleDetector(detectionThreshold, exitThreshold, enterDwell, exitDwell)
+                        for sensorNum in (1, 2, 3)}
+    samplingPolicy = SamplingPolicy(idleSampleInterval, standbySampleInterval, fastSampleInterval, approachMargin)
+    sensorSnapshot = SensorSnapshot()
+    blinkEngine = BlinkEngine(blinkPeriod)
+    stateMachines = build_state_machines()
+
+build_derived_state()
 
 if __name__ == '__main__':
-    main(startTime)
+    with TrafficController() as controller:
+        controller.run()
@@ -0,0 +1,64 @@
+/*
+ * ShiftOut SysEx handler for FirmataExpress
+ * ------------------------------------------
+ * Lets finalise_integrated_code.py update the 74HC595 shift registers with a single
+ * SysEx message instead of bit-banging every bit over the serial link.
+ *
+ * Message (SHIFT_OUT = 0x0A), repeated once per register in the same message:
+ *   dataPin, clockPin, latchPin, value bits 0-6, value bit 7
+ *
+ * All registers in the message are shifted out first (MSB first, so the first bit
+ * ends up on QH) and then all latch pins are pulsed, so the outputs change together.
+ *
+ * The shift register pins are set up with one more message (OUTPUT_PINS = 0x0B),
+ * holding one pin number per byte. Every pin in it becomes a digital output, driven low.
+ *
+ * To use it, include this file in FirmataExpress.ino and add to sysexCallback():
+ *
+ *   case SHIFT_OUT:
+ *     handleShiftOutSysex(argc, argv);
+ *     break;
+ *   case OUTPUT_PINS:
+ *     handleOutputPinsSysex(argc, argv);
+ *     break;
+ *
+ * then set useFirmwareShiftOut = True in finalise_integrated_code.py.
+ */
+
+#ifndef SHIFT_OUT_SYSEX_H
+#define SHIFT_OUT_SYSEX_H
+
+#define SHIFT_OUT 0x0A
+#define SHIFT_OUT_BYTES_PER_REGISTER 5
+#define OUTPUT_PINS 0x0B
+
+void handleShiftOutSysex(byte argc, byte *argv)
+{
+  byte index;
+
+  for (index = 0; index + SHIFT_OUT_BYTES_PER_REGISTER <= argc; index += SHIFT_OUT_BYTES_PER_REGISTER) {
+    byte dataPin = argv[index];
+    byte clockPin = argv[index + 1];
+    byte value = argv[index + 3] | (argv[index + 4] << 7);
+    shiftOut(dataPin, clockPin, MSBFIRST, value);
+  }
+
+  for (index = 0; index + SHIFT_OUT_BYTES_PER_REGISTER <= argc; index += SHIFT_OUT_BYTES_PER_REGISTER) {
+    byte latchPin = argv[index + 2];
+    digitalWrite(latchPin, HIGH);
+    digitalWrite(latchPin, LOW);
+  }
+}
+
+void handleOutputPinsSysex(byte argc, byte *argv)
+{
+  byte index;
+
+  for (index = 0; index < argc; index++) {
+    // goes through Firmata so the pin is reported with its new mode
+    setPinModeCallback(argv[index], OUTPUT);
+    digitalWrite(argv[index], LOW);
+  }
+}
+
+#endif
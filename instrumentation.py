@@ -0,0 +1,316 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Control loop instrumentation
+-------------------------------------------------------------
+Description:
+
+Measures where the time of the control loop of finalise_integrated_code.py goes:
+
+- timing histograms per stage: sensor reads, state refresh, the 4.I3 check, every subsystem
+  (or state machine), every shift register write and the whole tick,
+- the number of Firmata messages sent per tick,
+- how late timed transitions and scheduler deadlines fired.
+
+Nothing is measured until `enable()` is called. Enabling wraps the measured functions and
+the board, disabling restores the originals, so a disabled run pays no overhead.
+The metrics are available in-process with `metrics.snapshot()` and are dumped as JSON
+to a local file every `dumpInterval` seconds.
+'''
+
+import json
+import math
+import time
+
+import finalise_integrated_code as fic
+
+# board calls that send a Firmata message
+firmataCalls = (
+    'digital_write', 'play_tone', 'play_tone_off', '_send_sysex',
+    'set_pin_mode_digital_input', 'set_pin_mode_digital_output',
+    'set_pin_mode_pwm_output', 'set_pin_mode_sonar',
+)
+
+class Histogram:
+
+    """
+    Power-of-two bucketed histogram, cheap enough to record every tick.
+
+    Values are counted in buckets [2^k, 2^(k+1)) of `unit`, so percentiles are exact
+    to within a factor of two while count, mean, minimum and maximum are exact.
+
+    Parameters:
+    unit (float): Size of the smallest bucket, e.g. 1e-6 to bucket seconds by microsecond.
+    """
+
+    def __init__(self, unit=1e-6):
+        self.unit = unit
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, value):
+        """Adds one value."""
+        scaled = value / self.unit
+        bucket = -1 if scaled < 1 else int(math.log2(scaled))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, fraction):
+        """Returns the upper edge of the bucket holding the given fraction of all values."""
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(self.maximum, self.unit * 2 ** (bucket + 1))
+        return self.maximum
+
+    def summary(self):
+        """Returns count, total, mean, minimum, p50, p95, p99 and maximum."""
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.minimum,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.maximum,
+        }
+
+class Metrics:
+
+    """
+    Collects the stage timings, Firmata message counts and lateness of the control loop.
+
+    Parameters:
+    dumpPath (str): File the metrics are written to as JSON, None to never write them.
+    dumpInterval (float): Seconds between two dumps.
+    """
+
+    def __init__(self, dumpPath='instrumentation.json', dumpInterval=10.0):
+        self.dumpPath = dumpPath
+        self.dumpInterval = dumpInterval
+        self.startedAt = time.time()
+        self.lastDump = self.startedAt
+        self.stages = {}
+        self.lateness = {}
+        self.messagesPerTick = Histogram(unit=1)
+        self.ticks = 0
+        self.messages = 0
+
+    def record_stage(self, name, seconds):
+        """Adds the duration of one call of a stage."""
+        if name not in self.stages:
+            self.stages[name] = Histogram()
+        self.stages[name].record(seconds)
+
+    def record_lateness(self, name, seconds):
+        """Adds how late a transition or deadline fired, early wake-ups count as 0."""
+        if name not in self.lateness:
+            self.lateness[name] = Histogram()
+        self.lateness[name].record(max(0, seconds))
+
+    def record_tick(self, messages):
+        """Adds the number of Firmata messages sent during one tick and dumps the metrics when due."""
+        self.ticks += 1
+        self.messagesPerTick.record(messages)
+        now = time.time()
+        if self.dumpPath is not None and now - self.lastDump >= self.dumpInterval:
+            self.lastDump = now
+            self.dump()
+
+    def snapshot(self):
+        """Returns all metrics as a dictionary."""
+        return {
+            'timestamp': time.time(),
+            'uptime': time.time() - self.startedAt,
+            'ticks': self.ticks,
+            'messages': self.messages,
+            'messagesPerTick': self.messagesPerTick.summary(),
+            'stages': {name: histogram.summary() for name, histogram in self.stages.items()},
+            'lateness': {name: histogram.summary() for name, histogram in self.lateness.items()},
+            'ledWritesIssued': fic.ledWritesIssued,
+            'ledWritesSuppressed': fic.ledWritesSuppressed,
+        }
+
+    def dump(self, path=None):
+        """Writes `snapshot()` to `path`, or to `dumpPath` if no path is given."""
+        with open(path or self.dumpPath, 'w') as dumpFile:
+            json.dump(self.snapshot(), dumpFile, indent=2)
+
+class CountingBoard:
+
+    """
+    Wraps a board and counts every call that sends a Firmata message.
+    All other attributes are passed through to the wrapped board.
+
+    Parameters:
+    board (object): The board to wrap.
+    metrics (Metrics): Receives the message count.
+    """
+
+    def __init__(self, board, metrics):
+        self.board = board
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.board, name)
+        if name not in firmataCalls:
+            return attribute
+        metrics = self.metrics
+        def counted(*args, **kwargs):
+            metrics.messages += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+# functions replaced while instrumentation is enabled, with their originals
+originals = {}
+
+def timed(name, function):
+
+    """
+    Wraps a function so the duration of every call is recorded as stage `name`.
+
+    Parameters:
+    name (str): The stage name.
+    function (callable): The function to wrap.
+
+    Returns:
+    callable: The wrapped function.
+    """
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            fic.metrics.record_stage(name, time.perf_counter() - start)
+    return wrapper
+
+def timed_tick(function):
+
+    """
+    Wraps a tick function so its duration and the Firmata messages it sent are recorded.
+
+    Parameters:
+    function (callable): `control_tick` or `state_machine_step`.
+
+    Returns:
+    callable: The wrapped function.
+    """
+
+    def wrapper(*args, **kwargs):
+        metrics = fic.metrics
+        messagesBefore = metrics.messages
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.record_stage('tick', time.perf_counter() - start)
+            metrics.record_tick(metrics.messages - messagesBefore)
+    return wrapper
+
+def timed_shift_out(function):
+
+    """
+    Wraps `shift_out` so every register write is recorded as its own stage.
+
+    Parameters:
+    function (callable): `shift_out`.
+
+    Returns:
+    callable: The wrapped function.
+    """
+
+    def wrapper(pattern, regNum, latch=True):
+        start = time.perf_counter()
+        try:
+            return function(pattern, regNum, latch)
+        finally:
+            fic.metrics.record_stage(f'register_write_{regNum}', time.perf_counter() - start)
+    return wrapper
+
+def replace(name, wrapper):
+    """Replaces function `name` of the control loop by wrapper(function), remembering the original."""
+    originals[name] = getattr(fic, name)
+    setattr(fic, name, wrapper(originals[name]))
+
+def enable(dumpPath='instrumentation.json', dumpInterval=10.0):
+
+    """
+    Starts measuring the control loop running on the connected board.
+
+    Parameters:
+    dumpPath (str): File the metrics are written to as JSON, None to never write them.
+    dumpInterval (float): Seconds between two dumps.
+
+    Returns:
+    Metrics: The metrics being collected, also available as `finalise_integrated_code.metrics`.
+    """
+
+    if fic.metrics is not None:
+        return fic.metrics
+
+    metrics = Metrics(dumpPath, dumpInterval)
+    fic.metrics = metrics
+
+    replace('control_tick', timed_tick)
+    replace('state_machine_step', timed_tick)
+    replace('get_distance', lambda function: timed('sensor_read', function))
+    replace('refresh_state', lambda function: timed('refresh_state', function))
+    replace('check_reset_4I3', lambda function: timed('check_reset_4I3', function))
+    replace('subsystem1', lambda function: timed('subsystem1', function))
+    replace('subsystem2', lambda function: timed('subsystem2', function))
+    replace('subsystem3', lambda function: timed('subsystem3', function))
+    replace('subsystem4', lambda function: timed('subsystem4', function))
+    replace('sub3i2', lambda function: timed('sub3i2', function))
+    replace('shift_out', timed_shift_out)
+    replace('firmware_shift_out', lambda function: timed('register_write_firmware', function))
+
+    for name, machine in fic.stateMachines.items():
+        originals[f'{name}.step'] = machine.step
+        machine.step = timed(name, machine.step)
+        machine.observer = lambda machine, transition, lateness: metrics.record_lateness(machine.name, lateness)
+
+    fic.board = CountingBoard(fic.board, metrics)
+    return metrics
+
+def disable():
+
+    """
+    Stops measuring and restores the original functions and board.
+
+    Parameters:
+    None
+
+    Returns:
+    Metrics: The metrics collected while enabled, or None if instrumentation was not enabled.
+    """
+
+    metrics = fic.metrics
+    if metrics is None:
+        return None
+
+    for name, original in originals.items():
+        if name.endswith('.step'):
+            machine = fic.stateMachines[name[:-len('.step')]]
+            del machine.step
+            machine.observer = None
+        else:
+            setattr(fic, name, original)
+    originals.clear()
+    if isinstance(fic.board, CountingBoard):
+        fic.board = fic.board.board
+    fic.metrics = None
+    return metrics
@@ -0,0 +1,321 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Junction supervisor
+-------------------------------------------------------------
+Description:
+
+Shards junction controllers across worker processes, so many junctions scale with the
+number of CPU cores instead of sharing the single core of one Python process.
+
+- Every worker process runs its share of the junctions with `multi_junction.run_junctions()`,
+  one Firmata link per junction.
+- Workers send a heartbeat with their metrics every `heartbeatInterval` seconds.
+- The supervisor restarts a worker that crashed or stopped sending heartbeats. The new
+  worker reconnects its boards and runs `starting()`, which puts every light back in its
+  safe initial pattern.
+- `JunctionSupervisor.metrics()` aggregates the metrics of all workers.
+
+Junctions are described by dictionaries: {'name': ..., 'port': serial port of the Arduino,
+'settings': module globals for this junction (see `multi_junction.Junction`)}. Simulated
+workers run `SimulatedBoard`s with generated traffic on a scenario clock, as fast as the
+core allows, which measures how the supervisor scales with cores.
+
+Run this file directly to measure the scaling over 1, 2 and 4 worker processes.
+'''
+
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import time
+
+heartbeatInterval = 1.0 # seconds between two heartbeats of a worker
+healthTimeout = 5.0 # seconds without a heartbeat after which a worker is restarted
+trafficPeriod = 60 # scenario seconds between two rounds of generated traffic on simulated junctions
+
+def open_board(spec):
+
+    """
+    Opens the Pymata4 connection of one physical junction.
+
+    Parameters:
+    spec (dict): The junction description, its 'port' selects the serial port (None to auto-detect).
+
+    Returns:
+    object: The Pymata4 board.
+    """
+
+    from pymata4 import pymata4
+    return pymata4.Pymata4(com_port=spec.get('port'), arduino_wait=spec.get('arduinoWait', 4))
+
+def worker_main(workerId, specs, simulated, commandQueue, statusQueue):
+
+    """
+    Runs the junctions of one shard until told to stop, sending heartbeats with metrics.
+
+    Parameters:
+    workerId (int): Index of the worker in the supervisor.
+    specs (list of dict): The junctions of this shard.
+    simulated (bool): Run simulated boards with generated traffic on a scenario clock.
+    commandQueue (multiprocessing.Queue): Receives "stop" (and "crash", to test restarts).
+    statusQueue (multiprocessing.Queue): Receives the heartbeats.
+
+    Returns:
+    None
+    """
+
+    import multi_junction
+    import simulated_board
+    from virtual_clock import SimulatedClock, realClock
+
+    if simulated:
+        clock = SimulatedClock()
+    else:
+        clock = realClock
+    sharedEvent = clock.event()
+
+    with contextlib.redirect_stdout(io.StringIO()) if simulated else contextlib.nullcontext():
+        junctions = []
+        boards = []
+        for spec in specs:
+            if simulated:
+                settings = dict(multi_junction.simulatedSettings, **spec.get('settings', {}))
+            else:
+                settings = spec.get('settings')
+            junction = multi_junction.Junction(spec['name'], settings, clock if simulated else None)
+            if simulated:
+                newBoard = simulated_board.SimulatedBoard(junction.system.shiftRegisterPins, clock)
+            else:
+                newBoard = open_board(spec)
+            junction.connect(newBoard, sharedEvent)
+            junctions.append(junction)
+            boards.append(newBoard)
+
+    startedAt = time.time()
+    cpuStart = time.process_time()
+    scenarioStart = clock.time()
+    nextTraffic = scenarioStart
+    ticks = 0
+
+    # the metrics of this worker, sent as heartbeat
+    def send_status():
+        statusQueue.put({
+            'workerId': workerId,
+            'pid': os.getpid(),
+            'timestamp': time.time(),
+            'uptime': time.time() - startedAt,
+            'cpuTime': time.process_time() - cpuStart,
+            'ticks': ticks,
+            'junctionSeconds': (clock.time() - scenarioStart) * len(junctions),
+            'junctions': {
+                junction.name: {
+                    'ticks': junction.ticks,
+                    'ledWritesIssued': junction.system.ledWritesIssued,
+                    'states': {name: machine.state for name, machine in junction.system.stateMachines.items()},
+                } for junction in junctions
+            },
+        })
+
+    try:
+        while True:
+            try:
+                command = commandQueue.get_nowait()
+            except queue.Empty:
+                command = None
+            if command == 'stop':
+                break
+            if command == 'crash':
+                raise RuntimeError(f"Worker {workerId} crashed on request")
+
+            heartbeatDue = time.time() + heartbeatInterval
+            while time.time() < heartbeatDue:
+                if simulated:
+                    if clock.time() >= nextTraffic:
+                        for index, (junction, newBoard) in enumerate(zip(junctions, boards)):
+                            multi_junction.schedule_traffic(clock, junction, newBoard, nextTraffic, index * trafficPeriod / len(boards) / 2)
+                        nextTraffic += trafficPeriod
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        ticks += multi_junction.run_junctions(junctions, 1.0, clock, sharedEvent)
+                else:
+                    ticks += multi_junction.run_junctions(junctions, heartbeatDue - time.time(), clock, sharedEvent)
+
+            send_status()
+        send_status()
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()) if simulated else contextlib.nullcontext():
+            for junction in junctions:
+                junction.close()
+
+class WorkerHandle:
+
+    """
+    The supervisor's view of one worker process.
+
+    Parameters:
+    workerId (int): Index of the worker.
+    specs (list of dict): The junctions of its shard.
+    """
+
+    def __init__(self, workerId, specs):
+        self.workerId = workerId
+        self.specs = specs
+        self.process = None
+        self.commandQueue = None
+        self.lastHeartbeat = None
+        self.status = None
+        self.restarts = 0
+        self.startedAt = None
+
+class JunctionSupervisor:
+
+    """
+    Starts, monitors and restarts the worker processes running the junctions.
+
+    Parameters:
+    specs (list of dict): Every junction to run.
+    workers (int): Number of worker processes, default one per CPU core.
+    simulated (bool): Run simulated boards instead of opening the serial ports.
+    """
+
+    def __init__(self, specs, workers=None, simulated=False):
+        workers = min(workers or os.cpu_count() or 1, len(specs))
+        self.simulated = simulated
+        self.context = multiprocessing.get_context('spawn')
+        self.statusQueue = self.context.Queue()
+        self.workers = [WorkerHandle(workerId, specs[workerId::workers]) for workerId in range(workers)]
+
+    def start_worker(self, worker):
+        """Starts (or restarts) the process of one worker."""
+        worker.commandQueue = self.context.Queue()
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.workerId, worker.specs, self.simulated, worker.commandQueue, self.statusQueue),
+            name=f"junction-worker-{worker.workerId}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.startedAt = time.time()
+        worker.lastHeartbeat = None
+
+    def start(self):
+        """Starts every worker."""
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    def collect(self):
+        """Takes the heartbeats sent since the last call."""
+        while True:
+            try:
+                status = self.statusQueue.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers[status['workerId']]
+            if worker.process is not None and status['pid'] == worker.process.pid:
+                worker.status = status
+                worker.lastHeartbeat = status['timestamp']
+
+    def check_health(self):
+
+        """
+        Restarts every worker that exited or has not sent a heartbeat within `healthTimeout` seconds.
+
+        Parameters:
+        None
+
+        Returns:
+        list of int: The ids of the restarted workers.
+        """
+
+        self.collect()
+        now = time.time()
+        restarted = []
+        for worker in self.workers:
+            lastSign = worker.lastHeartbeat or worker.startedAt
+            if worker.process.is_alive() and now - lastSign <= healthTimeout:
+                continue
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join(1)
+            worker.restarts += 1
+            self.start_worker(worker)
+            restarted.append(worker.workerId)
+        return restarted
+
+    def metrics(self):
+
+        """
+        Aggregates the last heartbeat of every worker.
+
+        Parameters:
+        None
+
+        Returns:
+        dict: Totals over all workers and the per-worker status.
+        """
+
+        statuses = [worker.status for worker in self.workers if worker.status is not None]
+        return {
+            'workers': len(self.workers),
+            'junctions': sum(len(worker.specs) for worker in self.workers),
+            'aliveWorkers': sum(1 for worker in self.workers if worker.process is not None and worker.process.is_alive()),
+            'restarts': sum(worker.restarts for worker in self.workers),
+            'ticks': sum(status['ticks'] for status in statuses),
+            'cpuTime': sum(status['cpuTime'] for status in statuses),
+            'junctionSeconds': sum(status['junctionSeconds'] for status in statuses),
+            'perWorker': {worker.workerId: worker.status for worker in self.workers},
+        }
+
+    def run(self, duration=None, checkInterval=0.5):
+        """Starts the workers and monitors them for `duration` seconds, or until interrupted. Returns the final metrics."""
+        self.start()
+        end = None if duration is None else time.time() + duration
+        try:
+            while end is None or time.time() < end:
+                time.sleep(checkInterval)
+                self.check_health()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return self.metrics()
+
+    def stop(self):
+        """Asks every worker to stop, which turns its lights off, and waits for them."""
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.commandQueue.put('stop')
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(heartbeatInterval + 2)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        self.collect()
+
+def measure_scaling(junctions=32, workerCounts=(1, 2, 4), duration=5.0):
+
+    """
+    Measures how the simulated junction throughput scales with the number of worker processes.
+
+    Parameters:
+    junctions (int): Number of simulated junctions.
+    workerCounts (tuple of int): Numbers of worker processes to measure.
+    duration (float): Wall-clock seconds of every measurement.
+
+    Returns:
+    list of dict: Per worker count, the junction-seconds simulated per wall-clock second.
+    """
+
+    specs = [{'name': index} for index in range(junctions)]
+    results = []
+    for workers in workerCounts:
+        supervisor = JunctionSupervisor(specs, workers, simulated=True)
+        metrics = supervisor.run(duration)
+        rate = metrics['junctionSeconds'] / duration
+        results.append({'workers': workers, 'junctionSecondsPerSecond': rate, 'restarts': metrics['restarts']})
+        print(f"{workers} workers: {rate:.0f} junction-seconds per second, {metrics['ticks']} ticks, {metrics['restarts']} restarts")
+    return results
+
+if __name__ == '__main__':
+    measure_scaling()
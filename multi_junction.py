@@ -0,0 +1,263 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Multi-junction controller
+-------------------------------------------------------------
+Description:
+
+Runs several tunnel approaches from one process. Every `Junction` is an independent copy of
+finalise_integrated_code.py, loaded under its own module name, so it has its own board
+connection, pins, flags, timers, state machines, sensor filters and PB1 queue, while the
+control logic stays exactly the code that runs a single junction.
+
+`run_junctions()` drives any number of junctions from one thread: each junction is stepped
+when its own next deadline is due or when one of its sensor or button callbacks wakes it,
+and the thread sleeps until the earliest deadline of all junctions in between.
+
+Run this file directly to measure how many junctions one core can sustain.
+'''
+
+import contextlib
+import importlib.util
+import io
+import threading
+import time
+
+import finalise_integrated_code as fic
+import simulated_board
+from event_log import OFF
+from simulated_board import SimulatedBoard
+from virtual_clock import SimulatedClock, realClock
+
+class JunctionWake:
+
+    """
+    Wake event of one junction: marks the junction as woken and wakes the shared scheduler.
+
+    Parameters:
+    junction (Junction): The junction woken by `set()`.
+    sharedEvent (object): The event the scheduler of `run_junctions()` waits on.
+    """
+
+    def __init__(self, junction, sharedEvent):
+        self.junction = junction
+        self.sharedEvent = sharedEvent
+
+    def set(self):
+        self.junction.woken = True
+        self.sharedEvent.set()
+
+    def clear(self):
+        self.junction.woken = False
+
+    def is_set(self):
+        return self.junction.woken
+
+    def wait(self, timeout=None):
+        return self.sharedEvent.wait(timeout)
+
+class Junction:
+
+    """
+    One intersection, run by its own copy of finalise_integrated_code.py.
+
+    Settings such as pin numbers, `useStateMachines` or `pedestrianLockout` are applied to the
+    junction's copy only. Its `build_derived_state()` then rebuilds everything the copy built
+    from the settings at import, on the junction's clock, so every setting takes effect.
+    Every junction logs its events to its own file, events_<name>.jsonl unless `eventLogPath` is set.
+
+    Parameters:
+    name (str): Name of the junction, also used for its module name.
+    settings (dict): Maps module global names to the values this junction uses.
+    clock (object): Clock the junction runs on, e.g. a `SimulatedClock`, None for real time.
+    """
+
+    def __init__(self, name, settings=None, clock=None):
+        self.name = name
+        self.woken = False
+        self.deadline = None
+        self.ticks = 0
+
+        spec = importlib.util.spec_from_file_location(f'junction_{name}', fic.__file__)
+        self.system = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.system)
+        self.system.eventLogPath = f'events_{name}.jsonl'
+
+        for settingName, value in (settings or {}).items():
+            if not hasattr(self.system, settingName):
+                raise AttributeError(f"Junction {name}: unknown setting {settingName}")
+            setattr(self.system, settingName, value)
+        if clock is not None:
+            self.system.use_clock(clock)
+        self.system.build_derived_state()
+
+    def connect(self, newBoard=None, sharedEvent=None):
+
+        """
+        Connects the junction's board and shows the initial pattern.
+
+        Parameters:
+        newBoard (object): Board of this junction. If None, a Pymata4 connection is opened.
+        sharedEvent (object): Event shared by all junctions of one scheduler, None to keep the junction's own.
+
+        Returns:
+        object: The connected board.
+        """
+
+        if sharedEvent is not None:
+            self.system.wakeEvent = JunctionWake(self, sharedEvent)
+        self.system.connect_board(newBoard)
+        self.system.reset_state_machines()
+        self.system.starting()
+        self.deadline = self.system.clock.time()
+        return self.system.board
+
+    def step(self):
+        """Runs one control tick and computes the junction's next deadline."""
+        self.woken = False
+        if self.system.useStateMachines:
+            self.system.state_machine_step()
+        else:
+            self.system.control_tick()
+        self.ticks += 1
+        self.deadline = self.system.next_deadline(self.system.clock.time())
+
+    def close(self):
+        """Turns every light and the buzzer off, releases the junction's board and writes its buffered events."""
+        if self.system.board is None:
+            return
+        self.system.ending()
+        self.system.board.shutdown()
+        self.system.board = None
+        self.system.close_event_log()
+
+# simulated junctions keep their events in memory
+simulatedSettings = {'eventLogPath': None, 'consoleLevel': OFF}
+
+def run_junctions(junctions, duration=None, clock=realClock, sharedEvent=None):
+
+    """
+    Runs connected junctions concurrently on the calling thread.
+
+    Every pass steps the junctions that were woken by a callback or whose deadline is due,
+    then sleeps until the earliest deadline of all junctions or until a callback wakes one.
+
+    Parameters:
+    junctions (list of Junction): Junctions connected with the same `sharedEvent`.
+    duration (float): Seconds to run, or None to run until interrupted.
+    clock (object): The clock the junctions run on.
+    sharedEvent (object): The event passed to `Junction.connect()`. If None, a new one is made
+                          (the clock itself for a `SimulatedClock`) and every junction is woken through it.
+
+    Returns:
+    int: The number of ticks run by all junctions together.
+    """
+
+    if sharedEvent is None:
+        sharedEvent = clock if isinstance(clock, SimulatedClock) else threading.Event()
+        for junction in junctions:
+            junction.system.wakeEvent = JunctionWake(junction, sharedEvent)
+
+    start = clock.time()
+    end = None if duration is None else start + duration
+    ticks = 0
+
+    while end is None or clock.time() < end:
+        now = clock.time()
+        for junction in junctions:
+            if junction.woken or now >= junction.deadline:
+                junction.step()
+                ticks += 1
+
+        nextDeadline = min(junction.deadline for junction in junctions)
+        if end is not None:
+            nextDeadline = min(nextDeadline, end)
+        sharedEvent.wait(max(0, nextDeadline - clock.time() + fic.deadlineSlack))
+        sharedEvent.clear()
+
+    return ticks
+
+def schedule_traffic(clock, junction, simBoard, start, offset):
+
+    """
+    Schedules a mix of traffic on one simulated junction: overheight vehicles at
+    US1 then US3, a vehicle at US2 and pedestrian presses, shifted by `offset` seconds.
+
+    Parameters:
+    clock (SimulatedClock): The clock running the scenario.
+    junction (Junction): The junction, whose own sensor pins are used.
+    simBoard (SimulatedBoard): The junction's board.
+    start (float): The scenario start time.
+    offset (float): Seconds this junction's traffic is shifted by.
+
+    Returns:
+    None
+    """
+
+    system = junction.system
+
+    def step(at, action):
+        clock.schedule(start + offset + at, lambda: action(simBoard))
+
+    step(1, lambda board: board.press_button())
+    step(1.1, lambda board: board.release_button())
+    step(5, lambda board: board.set_distance(system.us1Trig, 5))
+    step(8, lambda board: board.set_distance(system.us3Trig, 5))
+    step(9, lambda board: board.set_distance(system.us1Trig, simulated_board.clearDistance))
+    step(14, lambda board: board.set_distance(system.us3Trig, simulated_board.clearDistance))
+    step(20, lambda board: board.set_distance(system.us2Trig, 5))
+    step(26, lambda board: board.set_distance(system.us2Trig, simulated_board.clearDistance))
+    step(45, lambda board: board.press_button())
+    step(45.1, lambda board: board.release_button())
+
+def measure_capacity(counts=(1, 4, 16, 64), duration=60):
+
+    """
+    Measures how many junctions one core can sustain.
+
+    For every count, that many junctions with simulated boards and staggered traffic run
+    for `duration` scenario seconds on one thread. The CPU time they need gives the number
+    of junctions one core keeps up with in real time, serial latency of real boards aside.
+
+    Parameters:
+    counts (tuple of int): Numbers of junctions to measure.
+    duration (float): Scenario seconds every measurement runs.
+
+    Returns:
+    list of dict: Per count, the ticks, CPU time, CPU time per junction-second and junctions per core.
+    """
+
+    results = []
+    for count in counts:
+        clock = SimulatedClock()
+        junctions = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                for index in range(count):
+                    junction = Junction(index, simulatedSettings, clock)
+                    junctions.append(junction)
+                    simBoard = SimulatedBoard(junction.system.shiftRegisterPins, clock)
+                    junction.connect(simBoard, clock)
+                    schedule_traffic(clock, junction, simBoard, clock.now, index * duration / count)
+                cpuStart = time.process_time()
+                ticks = run_junctions(junctions, duration, clock, clock)
+                cpuTime = time.process_time() - cpuStart
+            finally:
+                for junction in junctions:
+                    junction.close()
+
+        result = {
+            'junctions': count,
+            'ticks': ticks,
+            'cpuTime': cpuTime,
+            'cpuPerJunctionSecond': cpuTime / (count * duration),
+            'junctionsPerCore': count * duration / cpuTime if cpuTime > 0 else None,
+        }
+        results.append(result)
+        print(f"{count:4} junctions: {ticks:6} ticks, cpu {cpuTime:.3f} s, "
+              f"{1e6 * result['cpuPerJunctionSecond']:.0f} us per junction-second, "
+              f"~{result['junctionsPerCore']:.0f} junctions per core")
+    return results
+
+if __name__ == '__main__':
+    measure_capacity()
@@ -0,0 +1,345 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Simulated board
+-------------------------------------------------------------
+Description:
+
+Stand-ins for the pymata4 board so finalise_integrated_code.py can run without an Arduino.
+The fake board records every Firmata message and models the three 74HC595 shift registers,
+both for bit-banged digital writes and for the optional firmware "shiftOut" SysEx command.
+The simulated board also models the ultrasonic sensors, push button PB1 and the PA1 tone,
+so the whole control loop can be run and measured deterministically.
+
+Run this file directly (or with pytest) to test that both shift-out paths latch identical
+outputs, run directly it also measures the control loop throughput on the simulated board.
+'''
+
+import contextlib
+import io
+import time
+
+import finalise_integrated_code as fic
+from board_interface import Board
+from virtual_clock import SimulatedClock, realClock
+
+# pin types reported by pymata4 in the first element of callback data
+INPUT = 0x00
+SONAR = 0x0c
+
+# distance reported by an ultrasonic sensor when nothing is in front of it
+clearDistance = 30
+
+class ShiftRegister595:
+
+    """
+    Models one 74HC595 shift register driven by its data, clock (SRCLK) and latch (RCLK) pins.
+
+    Bit 0 of `shifted` and `latched` is QA and bit 7 is QH. Every rising edge of the clock
+    shifts the data pin into QA, every rising edge of the latch copies the shift stage to the outputs.
+
+    Parameters:
+    dataPin (int): Pin connected to SER.
+    clockPin (int): Pin connected to SRCLK.
+    latchPin (int): Pin connected to RCLK.
+    """
+
+    def __init__(self, dataPin, clockPin, latchPin):
+        self.dataPin = dataPin
+        self.clockPin = clockPin
+        self.latchPin = latchPin
+        self.shifted = 0
+        self.latched = 0
+        self.latchCount = 0
+
+    def shift_in(self, bit):
+        """Shifts one bit into QA."""
+        self.shifted = ((self.shifted << 1) | (1 if bit else 0)) & 0xFF
+
+    def latch(self):
+        """Copies the shift stage to the outputs."""
+        self.latched = self.shifted
+        self.latchCount += 1
+
+class FakeBoard(Board):
+
+    """
+    Records the Firmata messages sent by finalise_integrated_code.py and models the shift registers.
+
+    Only the pymata4 calls used by the traffic system are provided. Sensors read as
+    "nothing detected" and the push button as released.
+
+    Parameters:
+    registerPins (dict): Maps the register number to its (data, clock, latch) pins.
+    clock (object): Timestamps the reports and readings, see virtual_clock.py. Default the wall clock.
+    """
+
+    def __init__(self, registerPins=None, clock=None):
+        if registerPins is None:
+            registerPins = fic.shiftRegisterPins
+        self.clock = clock or realClock
+        self.registers = {regNum: ShiftRegister595(*pins) for regNum, pins in registerPins.items()}
+        self.pinModes = {}
+        self.pinValues = {}
+        self.digitalWrites = 0
+        self.sysexMessages = 0
+        self.toneMessages = 0
+
+    def messages(self):
+        """Returns the number of messages that would have been sent over the serial link."""
+        return self.digitalWrites + self.sysexMessages + self.toneMessages
+
+    def latched_byte(self, regNum):
+        """Returns the outputs of register `regNum` as a byte, QH being the most significant bit."""
+        return self.registers[regNum].latched
+
+    def set_pin_mode_digital_input(self, pinNumber, callback=None):
+        self.pinModes[pinNumber] = 'digital_input'
+
+    def set_pin_mode_digital_output(self, pinNumber):
+        self.pinModes[pinNumber] = 'digital_output'
+
+    def set_pin_mode_pwm_output(self, pinNumber):
+        self.pinModes[pinNumber] = 'pwm_output'
+
+    def set_pin_mode_sonar(self, triggerPin, echoPin, callback=None, timeout=80000):
+        self.pinModes[triggerPin] = 'sonar'
+
+    def digital_write(self, pin, value):
+        self.digitalWrites += 1
+        previous = self.pinValues.get(pin, 0)
+        self.pinValues[pin] = value
+        if previous or not value:
+            return
+        for register in self.registers.values():
+            if pin == register.clockPin:
+                register.shift_in(self.pinValues.get(register.dataPin, 0))
+            elif pin == register.latchPin:
+                register.latch()
+
+    def digital_read(self, pin):
+        return [0, self.clock.time()]
+
+    def sonar_read(self, triggerPin):
+        return [0, self.clock.time()]
+
+    def play_tone(self, pinNumber, frequency, duration):
+        self.toneMessages += 1
+
+    def play_tone_off(self, pinNumber):
+        self.toneMessages += 1
+
+    def shutdown(self):
+        pass
+
+    def _send_sysex(self, sysexCommand, sysexData=None):
+        self.sysexMessages += 1
+        if sysexCommand == fic.OUTPUT_PINS_SYSEX:
+            for pin in sysexData:
+                self.pinModes[pin] = 'digital_output'
+                self.pinValues[pin] = 0
+            return
+        if sysexCommand != fic.SHIFT_OUT_SYSEX:
+            return
+        groups = [sysexData[index:index + 5] for index in range(0, len(sysexData), 5)]
+        shifted = []
+        for dataPin, clockPin, latchPin, low, high in groups:
+            value = low | (high << 7)
+            for register in self.registers.values():
+                if (register.dataPin, register.clockPin, register.latchPin) == (dataPin, clockPin, latchPin):
+                    for bitIndex in range(7, -1, -1):
+                        register.shift_in((value >> bitIndex) & 1)
+                    shifted.append(register)
+        for register in shifted:
+            register.latch()
+
+class SimulatedBoard(FakeBoard):
+
+    """
+    Simulates the whole junction: sonar distances, push button PB1, the PA1 tone and the shift registers.
+
+    Distances and button states are set by the caller. Registered pymata4 callbacks are called
+    immediately with the new value, so runs are deterministic and need no reporter thread.
+
+    Parameters:
+    registerPins (dict): Maps the register number to its (data, clock, latch) pins.
+    clock (object): Timestamps the reports and readings, see virtual_clock.py. Default the wall clock.
+    """
+
+    def __init__(self, registerPins=None, clock=None):
+        super().__init__(registerPins, clock)
+        self.distances = {}
+        self.sonarCallbacks = {}
+        self.inputValues = {}
+        self.inputCallbacks = {}
+        self.toneFrequency = {}
+        self.toneLog = []
+        self.sonarReads = 0
+        self.digitalReads = 0
+
+    def set_distance(self, triggerPin, distance):
+        """Places an object `distance` cm in front of the sensor and reports it."""
+        self.distances[triggerPin] = distance
+        self.report_sonar(triggerPin)
+
+    def report_sonar(self, triggerPin):
+        """Sends one sonar report of the sensor's current distance to its callback."""
+        callback = self.sonarCallbacks.get(triggerPin)
+        if callback is not None:
+            callback([SONAR, triggerPin, self.distances.get(triggerPin, clearDistance), self.clock.time()])
+
+    def report_sonars(self):
+        """Sends one sonar report for every configured sensor, like one sonar scan of the firmware."""
+        for triggerPin in self.sonarCallbacks:
+            self.report_sonar(triggerPin)
+
+    def set_input(self, pin, value):
+        """Sets a digital input pin and reports the change to its callback."""
+        if self.inputValues.get(pin, 0) == value:
+            return
+        self.inputValues[pin] = value
+        callback = self.inputCallbacks.get(pin)
+        if callback is not None:
+            callback([INPUT, pin, value, self.clock.time()])
+
+    def press_button(self, pin=fic.pb1):
+        self.set_input(pin, 1)
+
+    def release_button(self, pin=fic.pb1):
+        self.set_input(pin, 0)
+
+    def tone(self, pinNumber=fic.pb2):
+        """Returns the frequency currently played on `pinNumber`, 0 if silent."""
+        return self.toneFrequency.get(pinNumber, 0)
+
+    def set_pin_mode_digital_input(self, pinNumber, callback=None):
+        super().set_pin_mode_digital_input(pinNumber, callback)
+        if callback is not None:
+            self.inputCallbacks[pinNumber] = callback
+
+    def set_pin_mode_sonar(self, triggerPin, echoPin, callback=None, timeout=80000):
+        super().set_pin_mode_sonar(triggerPin, echoPin, callback, timeout)
+        if callback is not None:
+            self.sonarCallbacks[triggerPin] = callback
+
+    def digital_read(self, pin):
+        self.digitalReads += 1
+        return [self.inputValues.get(pin, 0), self.clock.time()]
+
+    def sonar_read(self, triggerPin):
+        self.sonarReads += 1
+        return [self.distances.get(triggerPin, clearDistance), self.clock.time()]
+
+    def play_tone(self, pinNumber, frequency, duration):
+        super().play_tone(pinNumber, frequency, duration)
+        self.toneFrequency[pinNumber] = frequency
+        self.toneLog.append((self.clock.time(), pinNumber, frequency))
+
+    def play_tone_off(self, pinNumber):
+        super().play_tone_off(pinNumber)
+        if self.toneFrequency.get(pinNumber, 0) != 0:
+            self.toneLog.append((self.clock.time(), pinNumber, 0))
+        self.toneFrequency[pinNumber] = 0
+
+def test_shift_out_paths_agree():
+
+    """
+    Tests that the bit-banged and the firmware shift-out paths of `led_display()` latch identical outputs.
+
+    Every byte is written to every register on two fake boards, one per path, and the latched
+    outputs are compared with each other and with the expected byte. Fails with an
+    AssertionError on the first run with a mismatch, so it works under pytest and when
+    this file is run directly.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+
+    previousBoard = fic.board
+    previousMode = fic.useFirmwareShiftOut
+    bitBangBoard = FakeBoard()
+    firmwareBoard = FakeBoard()
+    mismatches = 0
+
+    try:
+        for regNum in fic.shiftRegisterPins:
+            for value in range(256):
+                for fakeBoard, firmwareMode in ((bitBangBoard, False), (firmwareBoard, True)):
+                    fic.board = fakeBoard
+                    fic.useFirmwareShiftOut = firmwareMode
+                    fic.reset_led_shadow()
+                    fic.led_display(value, regNum)
+                if not (bitBangBoard.latched_byte(regNum) == firmwareBoard.latched_byte(regNum) == value):
+                    mismatches += 1
+                    print(f"Register {regNum}, byte {value}: bit-bang {bitBangBoard.latched_byte(regNum)}, firmware {firmwareBoard.latched_byte(regNum)}")
+    finally:
+        fic.board = previousBoard
+        fic.useFirmwareShiftOut = previousMode
+        fic.reset_led_shadow()
+
+    writes = 3 * 256
+    print(f"Bit-bang: {bitBangBoard.messages() / writes} messages per register write")
+    print(f"Firmware: {firmwareBoard.messages() / writes} messages per register write")
+    print(f"Mismatches: {mismatches}")
+    assert mismatches == 0, f"{mismatches} register writes latched differently on the two shift-out paths"
+
+def measure_control_loop(ticks=500, distances=None):
+
+    """
+    Measures the throughput and latency of the control loop on a simulated board.
+
+    Like the benchmark, every tick runs `state_machine_step()`, or `control_tick()` if
+    `useStateMachines` is not set. The board is injected with `connect_board()`, the junction
+    is reset, the sensors are set to `distances` and the control loop is run for `ticks` ticks
+    on a `SimulatedClock`, which jumps to the next deadline after every tick instead of
+    sleeping, so dwell times and phases elapse as on the junction. Only the ticks themselves are timed. Console output of the control loop
+    is captured so the terminal does not distort the timing.
+
+    Parameters:
+    ticks (int): Number of control ticks to run.
+    distances (dict): Maps the sensor number (1, 2, or 3) to its distance in cm, default all clear.
+
+    Returns:
+    dict: Ticks per second, mean and worst tick latency in ms and Firmata messages per tick.
+    """
+
+    clock = SimulatedClock()
+    previousClock = fic.use_clock(clock)
+    simBoard = SimulatedBoard(clock=clock)
+    latencies = []
+    try:
+        fic.connect_board(simBoard)
+        fic.reset_junction(clock.now)
+        step = fic.state_machine_step if fic.useStateMachines else fic.control_tick
+        for sensorNum, distance in (distances or {}).items():
+            simBoard.set_distance(fic.trigPins[sensorNum], distance)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            fic.starting()
+            messagesBefore = simBoard.messages()
+            for tick in range(ticks):
+                tickStart = time.perf_counter()
+                step()
+                latencies.append(time.perf_counter() - tickStart)
+                fic.wait_for_next_deadline()
+    finally:
+        fic.use_clock(previousClock)
+
+    results = {
+        'ticksPerSecond': len(latencies) / sum(latencies),
+        'meanLatencyMs': 1000 * sum(latencies) / len(latencies),
+        'maxLatencyMs': 1000 * max(latencies),
+        'messagesPerTick': (simBoard.messages() - messagesBefore) / len(latencies),
+    }
+    print(f"{ticks} ticks: {results['ticksPerSecond']:.0f} ticks/s, "
+          f"mean {results['meanLatencyMs']:.3f} ms, max {results['maxLatencyMs']:.3f} ms, "
+          f"{results['messagesPerTick']:.1f} messages/tick")
+    return results
+
+if __name__ == '__main__':
+    test_shift_out_paths_agree()
+    measure_control_loop()
+    measure_control_loop(distances={1: 5})
@@ -0,0 +1,155 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Table-driven state machine engine
+-------------------------------------------------------------
+Description:
+
+A small engine for the subsystem state machines of finalise_integrated_code.py.
+Every machine is described by a table of `Transition` rows. A row fires either on an
+event or after a fixed time in its source state, and only if its guard holds.
+Nothing is re-evaluated between events and timers, and every machine can report its
+current state and the time left until its next timed transition.
+'''
+
+class Transition:
+
+    """
+    One row of a state machine table.
+
+    Parameters:
+    source (str or tuple of str): State(s) the transition leaves.
+    target (str or None): State entered when the transition fires. None makes it an internal
+                          transition that only runs its action and keeps the state and its timer.
+    event (str): Event that triggers the transition, None for a timed transition.
+    after (float): Seconds spent in the source state after which a timed transition fires.
+    guard (callable): guard(now) must return True for the transition to fire, None to always fire.
+    action (callable): action(now) run when the transition fires, before the target is entered.
+    """
+
+    def __init__(self, source, target, event=None, after=None, guard=None, action=None):
+        self.sources = (source,) if isinstance(source, str) else tuple(source)
+        self.target = target
+        self.event = event
+        self.after = after
+        self.guard = guard
+        self.action = action
+
+class StateMachine:
+
+    """
+    Runs one table of transitions.
+
+    The first row of the table that matches the current state, whose event is among the
+    given events (or whose time has elapsed) and whose guard holds, fires. Entering a state
+    runs its entry action from `onEnter`.
+
+    Parameters:
+    name (str): Name of the machine, used in status reports.
+    initial (str): The state the machine starts and resets in.
+    transitions (list of Transition): The transition table, in priority order.
+    onEnter (dict): Maps a state to its entry action, called as action(now).
+    """
+
+    def __init__(self, name, initial, transitions, onEnter=None):
+        self.name = name
+        self.initial = initial
+        self.transitions = transitions
+        self.onEnter = onEnter or {}
+        self.state = initial
+        self.enteredAt = None
+        self.transitionsFired = 0
+        # called as observer(machine, transition, lateness) when a transition fires, None to disable
+        self.observer = None
+
+    def reset(self, now):
+        """Puts the machine back in its initial state without running any action."""
+        self.state = self.initial
+        self.enteredAt = now
+
+    def time_in_state(self, now):
+        """Returns the seconds spent in the current state."""
+        return 0 if self.enteredAt is None else now - self.enteredAt
+
+    def step(self, events, now):
+
+        """
+        Fires the first transition that matches the current state, events and timers.
+
+        Parameters:
+        events (set of str): The events to handle.
+        now (float): The current timestamp.
+
+        Returns:
+        bool: True if the machine changed state.
+        """
+
+        for transition in self.transitions:
+            if self.state not in transition.sources:
+                continue
+            if transition.after is not None:
+                if self.time_in_state(now) < transition.after:
+                    continue
+            elif transition.event not in events:
+                continue
+            if transition.guard is not None and not transition.guard(now):
+                continue
+
+            self.transitionsFired += 1
+            if self.observer is not None:
+                lateness = 0 if transition.after is None else now - (self.enteredAt + transition.after)
+                self.observer(self, transition, lateness)
+            if transition.action is not None:
+                transition.action(now)
+            if transition.target is None:
+                return False
+            # a timed transition enters its target when it was due, so late steps never make the phases drift
+            if transition.after is not None:
+                self.enteredAt = self.enteredAt + transition.after
+            else:
+                self.enteredAt = now
+            self.state = transition.target
+            if transition.target in self.onEnter:
+                self.onEnter[transition.target](now)
+            return True
+        return False
+
+    def next_timer(self, now):
+
+        """
+        Returns when the next timed transition out of the current state is due.
+
+        A timed transition that is already due but blocked by its guard is left out,
+        it can only fire again together with an event.
+
+        Parameters:
+        now (float): The current timestamp.
+
+        Returns:
+        float or None: The timestamp of the next timed transition, or None if there is none.
+        """
+
+        timers = []
+        for transition in self.transitions:
+            if self.state in transition.sources and transition.after is not None:
+                due = self.enteredAt + transition.after
+                if due > now or transition.guard is None:
+                    timers.append(due)
+        if len(timers) == 0:
+            return None
+        return min(timers)
+
+    def time_to_next_transition(self, now):
+        """Returns the seconds until the next timed transition, or None if only events can move the machine."""
+        nextTimer = self.next_timer(now)
+        if nextTimer is None:
+            return None
+        return max(0, nextTimer - now)
+
+    def status(self, now):
+        """Returns the machine's state, time in state and time to its next timed transition."""
+        return {
+            'state': self.state,
+            'timeInState': self.time_in_state(now),
+            'timeToNextTransition': self.time_to_next_transition(now),
+        }
@@ -0,0 +1,518 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Input trace recording and deterministic replay
+-------------------------------------------------------------
+Description:
+
+Records every input the control loop of finalise_integrated_code.py receives, so a field
+incident can be replayed exactly, and replays recorded traces faster than real time.
+
+While recording, every board connected by `connect_board()` is wrapped by a `RecordingBoard`
+that writes one fixed-size record per event to the trace file:
+
+- inputs: sonar and PB1 reports passed to the pymata4 callbacks, and the results of
+  `sonar_read()` / `digital_read()` while a sensor or the button is polled,
+- ticks: the time of every control tick,
+- outputs: every byte latched on a shift register (decoded from the bit-banged writes or the
+  firmware SysEx, so both paths record the same stream) and every PA1 tone change.
+
+A record is a timestamp, a kind, a pin and a value (`recordFormat`, 14 bytes). Records are
+appended through a buffer and read back memory-mapped, so hours of traffic are replayed
+without loading the trace into memory.
+
+`replay()` feeds the recorded inputs back through the control logic on a `SimulatedClock`,
+running every tick at its recorded time, and checks that the latched registers and tones are
+the same as recorded. With `followTicks=False` the ticks are scheduled by the control loop's
+own deadline scheduler instead, to test scheduler changes against recorded traffic.
+
+    python trace_replay.py record trace.bin
+    python trace_replay.py replay trace.bin
+'''
+
+import argparse
+from collections import deque
+import json
+import mmap
+import struct
+import sys
+import threading
+import time
+
+import finalise_integrated_code as fic
+from event_log import EventLog, OFF
+from simulated_board import FakeBoard, INPUT, SONAR
+from virtual_clock import SimulatedClock
+
+traceMagic = b'TLTRACE\x01'
+recordFormat = struct.Struct('<dBBf') # timestamp, kind, pin, value
+
+# record kinds
+SONAR_REPORT = 1
+DIGITAL_REPORT = 2
+SONAR_READ = 3
+DIGITAL_READ = 4
+TICK = 5
+REGISTER = 16 # pin is the register number, value the latched byte
+TONE = 17 # value is the frequency, 0 when the tone stops
+outputKinds = (REGISTER, TONE)
+
+# settings stored in the trace header, a replay reports those that differ from the current ones
+recordedSettings = (
+    'useStateMachines', 'useFirmwareShiftOut', 'detectionThreshold', 'exitThreshold', 'enterDwell',
+    'exitDwell', 'filterAlpha', 'outlierGate', 'confirmTime', 'buttonDebounce', 'pedestrianLockout',
+)
+
+class TraceRecorder:
+
+    """
+    Appends trace records to a file, or keeps them in memory.
+
+    Parameters:
+    path (str): The trace file, None to keep the records in memory.
+    header (dict): Stored at the start of the file, e.g. the settings of the recorded junction.
+    flushBytes (int): Buffered bytes after which the buffer is written to the file.
+    """
+
+    def __init__(self, path=None, header=None, flushBytes=65536):
+        self.path = path
+        self.header = header or {}
+        self.flushBytes = flushBytes
+        self.buffer = bytearray()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.traceFile = None
+        if path is not None:
+            headerBytes = json.dumps(self.header).encode()
+            self.traceFile = open(path, 'wb')
+            self.traceFile.write(traceMagic + struct.pack('<I', len(headerBytes)) + headerBytes)
+
+    def record(self, kind, pin, value, timestamp):
+        """Appends one record."""
+        with self.lock:
+            self.buffer += recordFormat.pack(timestamp, kind, pin, value)
+            self.count += 1
+            if self.traceFile is not None and len(self.buffer) >= self.flushBytes:
+                self.traceFile.write(self.buffer)
+                self.buffer.clear()
+
+    def wrap(self, board):
+        """Returns `board` wrapped so everything it reports and latches is recorded."""
+        return RecordingBoard(board, self)
+
+    def records(self):
+        """Yields the records kept in memory as (timestamp, kind, pin, value)."""
+        return recordFormat.iter_unpack(bytes(self.buffer))
+
+    def close(self):
+        """Writes the buffered records and closes the file."""
+        with self.lock:
+            if self.traceFile is not None:
+                self.traceFile.write(self.buffer)
+                self.buffer.clear()
+                self.traceFile.close()
+                self.traceFile = None
+
+class TraceReader:
+
+    """
+    Reads a trace file memory-mapped.
+
+    Parameters:
+    path (str): The trace file written by a `TraceRecorder`.
+    """
+
+    def __init__(self, path):
+        self.traceFile = open(path, 'rb')
+        self.map = mmap.mmap(self.traceFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(traceMagic)] != traceMagic:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        headerLength = struct.unpack_from('<I', self.map, len(traceMagic))[0]
+        headerEnd = len(traceMagic) + 4 + headerLength
+        self.header = json.loads(self.map[len(traceMagic) + 4:headerEnd])
+        # a record cut off by a crash while recording is ignored
+        self.count = (len(self.map) - headerEnd) // recordFormat.size
+        self.start = headerEnd
+
+    def records(self):
+        """Yields every record as (timestamp, kind, pin, value)."""
+        view = memoryview(self.map)[self.start:self.start + self.count * recordFormat.size]
+        try:
+            yield from recordFormat.iter_unpack(view)
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+        self.traceFile.close()
+
+class RecordingBoard:
+
+    """
+    Wraps a board and records the inputs it delivers and the outputs it latches.
+    All other attributes are passed through to the wrapped board.
+
+    Parameters:
+    board (object): The board to wrap.
+    recorder (TraceRecorder): Receives the records.
+    registerPins (dict): Maps the register number to its (data, clock, latch) pins.
+    """
+
+    def __init__(self, board, recorder, registerPins=None):
+        self.board = board
+        self.recorder = recorder
+        # decodes the shift register writes into latched bytes, whichever path sends them
+        self.decoder = FakeBoard(registerPins or fic.shiftRegisterPins)
+        self.latchPins = {register.latchPin: regNum for regNum, register in self.decoder.registers.items()}
+
+    def __getattr__(self, name):
+        return getattr(self.board, name)
+
+    def set_pin_mode_sonar(self, triggerPin, echoPin, callback=None, timeout=80000):
+        if callback is not None:
+            def recorded(data, callback=callback):
+                self.recorder.record(SONAR_REPORT, data[1], data[2], data[3])
+                callback(data)
+            return self.board.set_pin_mode_sonar(triggerPin, echoPin, recorded, timeout)
+        return self.board.set_pin_mode_sonar(triggerPin, echoPin, callback, timeout)
+
+    def set_pin_mode_digital_input(self, pinNumber, callback=None):
+        if callback is not None:
+            def recorded(data, callback=callback):
+                self.recorder.record(DIGITAL_REPORT, data[1], data[2], data[3])
+                callback(data)
+            return self.board.set_pin_mode_digital_input(pinNumber, recorded)
+        return self.board.set_pin_mode_digital_input(pinNumber, callback)
+
+    def sonar_read(self, triggerPin):
+        reading = self.board.sonar_read(triggerPin)
+        self.recorder.record(SONAR_READ, triggerPin, reading[0] or 0, fic.clock.time())
+        return reading
+
+    def digital_read(self, pin):
+        reading = self.board.digital_read(pin)
+        self.recorder.record(DIGITAL_READ, pin, reading[0], fic.clock.time())
+        return reading
+
+    def digital_write(self, pin, value):
+        self.board.digital_write(pin, value)
+        self.decoder.digital_write(pin, value)
+        if value and pin in self.latchPins:
+            regNum = self.latchPins[pin]
+            self.recorder.record(REGISTER, regNum, self.decoder.latched_byte(regNum), fic.clock.time())
+
+    def _send_sysex(self, sysexCommand, sysexData=None):
+        self.board._send_sysex(sysexCommand, sysexData)
+        latchCounts = {regNum: register.latchCount for regNum, register in self.decoder.registers.items()}
+        self.decoder._send_sysex(sysexCommand, sysexData)
+        for regNum, register in self.decoder.registers.items():
+            if register.latchCount != latchCounts[regNum]:
+                self.recorder.record(REGISTER, regNum, register.latched, fic.clock.time())
+
+    def play_tone(self, pinNumber, frequency, duration):
+        self.board.play_tone(pinNumber, frequency, duration)
+        self.recorder.record(TONE, pinNumber, frequency, fic.clock.time())
+
+    def play_tone_off(self, pinNumber):
+        self.board.play_tone_off(pinNumber)
+        self.recorder.record(TONE, pinNumber, 0, fic.clock.time())
+
+class ReplayBoard(FakeBoard):
+
+    """
+    Board fed from a trace: recorded reports are delivered to the registered callbacks and
+    polled reads return the recorded readings in order.
+
+    Parameters:
+    registerPins (dict): Maps the register number to its (data, clock, latch) pins.
+    clock (object): Timestamps the readings, see virtual_clock.py.
+    """
+
+    def __init__(self, registerPins=None, clock=None):
+        super().__init__(registerPins, clock)
+        self.sonarCallbacks = {}
+        self.inputCallbacks = {}
+        self.readings = {} # (kind, pin): recorded readings not yet returned
+        self.current = {} # (kind, pin): the last reading
+
+    def set_pin_mode_digital_input(self, pinNumber, callback=None):
+        super().set_pin_mode_digital_input(pinNumber, callback)
+        if callback is not None:
+            self.inputCallbacks[pinNumber] = callback
+
+    def set_pin_mode_sonar(self, triggerPin, echoPin, callback=None, timeout=80000):
+        super().set_pin_mode_sonar(triggerPin, echoPin, callback, timeout)
+        if callback is not None:
+            self.sonarCallbacks[triggerPin] = callback
+
+    def report(self, kind, pin, value, timestamp):
+        """Delivers a recorded sonar or PB1 report to its callback."""
+        if kind == SONAR_REPORT:
+            callback = self.sonarCallbacks.get(pin)
+            data = [SONAR, pin, value, timestamp]
+        else:
+            callback = self.inputCallbacks.get(pin)
+            data = [INPUT, pin, int(value), timestamp]
+        if callback is not None:
+            callback(data)
+
+    def queue_reading(self, kind, pin, value):
+        """Queues a recorded reading for the next read of `pin`."""
+        self.readings.setdefault((kind, pin), deque()).append(value)
+
+    def set_reading(self, kind, pin, value):
+        """Sets what reads of `pin` return until the next reading."""
+        self.current[(kind, pin)] = value
+
+    def read(self, kind, pin):
+        queued = self.readings.get((kind, pin))
+        if queued:
+            self.current[(kind, pin)] = queued.popleft()
+        return self.current.get((kind, pin), 0)
+
+    def sonar_read(self, triggerPin):
+        return [self.read(SONAR_READ, triggerPin), self.clock.time()]
+
+    def digital_read(self, pin):
+        return [int(self.read(DIGITAL_READ, pin)), self.clock.time()]
+
+# functions replaced while recording, with their originals
+originals = {}
+
+def recorded_tick(function, takesNow):
+    """Wraps a tick function so the time of every tick is recorded, `takesNow` if it accepts the tick time."""
+    def wrapper(now=None):
+        if now is None:
+            now = fic.clock.time()
+        fic.traceRecorder.record(TICK, 0, 0, now)
+        return function(now) if takesNow else function()
+    return wrapper
+
+def start_recording(path='trace.bin'):
+
+    """
+    Starts recording. Every board connected by `connect_board()` from now on is recorded,
+    so recording is started before the board is connected.
+
+    Parameters:
+    path (str): The trace file, None to keep the trace in memory.
+
+    Returns:
+    TraceRecorder: The recorder, also available as `finalise_integrated_code.traceRecorder`.
+    """
+
+    if fic.traceRecorder is not None:
+        return fic.traceRecorder
+
+    header = {
+        'startedAt': fic.clock.time(),
+        'settings': {name: getattr(fic, name) for name in recordedSettings},
+    }
+    fic.traceRecorder = TraceRecorder(path, header)
+    for name in ('control_tick', 'state_machine_step'):
+        originals[name] = getattr(fic, name)
+        setattr(fic, name, recorded_tick(originals[name], name == 'state_machine_step'))
+    return fic.traceRecorder
+
+def stop_recording():
+
+    """
+    Stops recording, restores the tick functions and closes the trace file.
+
+    Parameters:
+    None
+
+    Returns:
+    TraceRecorder: The recorder, or None if nothing was being recorded.
+    """
+
+    recorder = fic.traceRecorder
+    if recorder is None:
+        return None
+    for name, original in originals.items():
+        setattr(fic, name, original)
+    originals.clear()
+    if isinstance(fic.board, RecordingBoard):
+        fic.board = fic.board.board
+    fic.traceRecorder = None
+    recorder.close()
+    return recorder
+
+def compare_outputs(expected, actual, tolerance=0.05):
+
+    """
+    Compares two output streams of (timestamp, kind, pin, value) records.
+
+    Parameters:
+    expected (list of tuple): The recorded outputs.
+    actual (list of tuple): The outputs of the replay.
+    tolerance (float): Seconds an output may be earlier or later than recorded.
+
+    Returns:
+    dict: Whether the streams are equivalent (same kinds, pins and values in the same order,
+          each within `tolerance` of its recorded time), the first difference and the largest
+          timing difference of the matching outputs.
+    """
+
+    maxSkew = 0.0
+    firstMismatch = None
+    for index in range(max(len(expected), len(actual))):
+        if (index >= len(expected) or index >= len(actual) or expected[index][1:] != actual[index][1:]
+                or abs(expected[index][0] - actual[index][0]) > tolerance):
+            firstMismatch = {
+                'index': index,
+                'expected': expected[index] if index < len(expected) else None,
+                'actual': actual[index] if index < len(actual) else None,
+            }
+            break
+        maxSkew = max(maxSkew, abs(expected[index][0] - actual[index][0]))
+    return {
+        'equivalent': firstMismatch is None,
+        'expectedOutputs': len(expected),
+        'actualOutputs': len(actual),
+        'firstMismatch': firstMismatch,
+        'maxSkew': maxSkew,
+    }
+
+def replay(path, followTicks=True, outputPath=None, tolerance=0.05):
+
+    """
+    Replays a trace through the control logic on a scenario clock and checks its outputs.
+
+    Parameters:
+    path (str): The trace file.
+    followTicks (bool): Run every tick at its recorded time, False to let the deadline scheduler run them.
+    outputPath (str): File the trace of the replay is written to, None to keep it in memory.
+    tolerance (float): Seconds an output may be earlier or later than recorded.
+
+    Returns:
+    dict: The comparison of the outputs (see `compare_outputs()`), the number of records,
+          ticks and inputs replayed, the recorded duration, CPU time and speed-up over real time,
+          and the recorded settings that differ from the current ones.
+    """
+
+    reader = TraceReader(path)
+    clock = SimulatedClock(reader.header.get('startedAt', 1000.0))
+    previousClock = fic.use_clock(clock)
+    previousEventLog = fic.eventLog
+    fic.eventLog = EventLog(None, consoleLevel=OFF)
+
+    settings = reader.header.get('settings', {})
+    useStateMachines = settings.get('useStateMachines', fic.useStateMachines)
+    expected = []
+    ticks = 0
+    inputs = 0
+    lastTimestamp = clock.now
+
+    try:
+        recorder = start_recording(outputPath)
+        replayBoard = ReplayBoard(clock=clock)
+        fic.connect_board(replayBoard)
+        fic.reset_junction(clock.now)
+        fic.starting()
+        tick = fic.state_machine_step if useStateMachines else fic.control_tick
+
+        cpuStart = time.process_time()
+        if followTicks:
+            pendingTick = None
+            for timestamp, kind, pin, value in reader.records():
+                lastTimestamp = timestamp
+                if kind in outputKinds:
+                    expected.append((timestamp, kind, pin, value))
+                    continue
+                if kind in (SONAR_READ, DIGITAL_READ):
+                    # read during the tick recorded just before
+                    replayBoard.queue_reading(kind, pin, value)
+                    continue
+                if pendingTick is not None:
+                    clock.now = max(clock.now, pendingTick)
+                    tick(clock.now)
+                    ticks += 1
+                    pendingTick = None
+                clock.now = max(clock.now, timestamp)
+                if kind == TICK:
+                    pendingTick = timestamp
+                else:
+                    replayBoard.report(kind, pin, value, clock.now)
+                    inputs += 1
+            if pendingTick is not None:
+                clock.now = max(clock.now, pendingTick)
+                tick(clock.now)
+                ticks += 1
+        else:
+            for timestamp, kind, pin, value in reader.records():
+                lastTimestamp = timestamp
+                if kind in outputKinds:
+                    expected.append((timestamp, kind, pin, value))
+                elif kind in (SONAR_REPORT, DIGITAL_REPORT):
+                    clock.schedule(timestamp, lambda kind=kind, pin=pin, value=value: replayBoard.report(kind, pin, value, clock.now))
+                    inputs += 1
+                elif kind in (SONAR_READ, DIGITAL_READ) and timestamp <= clock.now:
+                    # read by the first tick, which runs before any scheduled step
+                    replayBoard.set_reading(kind, pin, value)
+                elif kind in (SONAR_READ, DIGITAL_READ):
+                    clock.schedule(timestamp, lambda kind=kind, pin=pin, value=value: replayBoard.set_reading(kind, pin, value))
+            while clock.now <= lastTimestamp:
+                tick(clock.now)
+                ticks += 1
+                fic.wait_for_next_deadline()
+        cpuTime = time.process_time() - cpuStart
+    finally:
+        stop_recording()
+        fic.eventLog.close()
+        fic.use_clock(previousClock)
+        fic.eventLog = previousEventLog
+        reader.close()
+
+    if outputPath is None:
+        actual = [record for record in recorder.records() if record[1] in outputKinds]
+    else:
+        replayReader = TraceReader(outputPath)
+        actual = [record for record in replayReader.records() if record[1] in outputKinds]
+        replayReader.close()
+
+    duration = lastTimestamp - reader.header.get('startedAt', lastTimestamp)
+    result = compare_outputs(expected, actual, tolerance)
+    result.update({
+        'records': reader.count,
+        'ticks': ticks,
+        'inputs': inputs,
+        'duration': duration,
+        'cpuTime': cpuTime,
+        'speedUp': duration / cpuTime if cpuTime > 0 else None,
+        'settingsChanged': {name: (value, getattr(fic, name)) for name, value in settings.items()
+                            if hasattr(fic, name) and getattr(fic, name) != value},
+    })
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=('record', 'replay'), help='record the junction, or replay a trace')
+    parser.add_argument('trace', help='the trace file')
+    parser.add_argument('--scheduler', action='store_true', help='replay with the deadline scheduler instead of the recorded tick times')
+    parser.add_argument('--output', help='file the trace of the replay is written to')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='seconds an output may be earlier or later than recorded')
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        start_recording(args.trace)
+        try:
+            with fic.TrafficController() as controller:
+                controller.run()
+        finally:
+            stop_recording()
+    else:
+        result = replay(args.trace, not args.scheduler, args.output, args.tolerance)
+        print(f"{result['records']} records, {result['ticks']} ticks, {result['inputs']} inputs, "
+              f"{result['duration']:.1f} s replayed in {result['cpuTime']:.2f} s cpu")
+        print(f"outputs: {result['expectedOutputs']} recorded, {result['actualOutputs']} replayed, "
+              f"max skew {1000 * result['maxSkew']:.1f} ms")
+        for name, (recorded, current) in result['settingsChanged'].items():
+            print(f"setting {name}: recorded {recorded}, now {current}")
+        if result['equivalent']:
+            print("EQUIVALENT")
+        else:
+            print(f"DIVERGED at output {result['firstMismatch']['index']}: "
+                  f"expected {result['firstMismatch']['expected']}, got {result['firstMismatch']['actual']}")
+        sys.exit(0 if result['equivalent'] else 1)
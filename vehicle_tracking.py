@@ -0,0 +1,342 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Vehicle tracking
+-------------------------------------------------------------
+Description:
+
+Follows every vehicle through the tunnel from the stream of raw ultrasonic samples, instead of
+measuring its height once when subsystem 1 starts.
+
+- Every sample of US1, US2 and US3 is kept in a fixed-size NumPy window per sensor.
+- A vehicle passing under a sensor opens a track at its first sensor, and every later sensor it
+  passes is added to the oldest track that has not reached that sensor yet, as vehicles keep
+  their order in the tunnel. A track is closed once the vehicle has left US3, or when nothing
+  happened on it for `trackTimeout` seconds.
+- A closed track holds the height profile under every sensor, the dwell time under every
+  sensor, the closing rate at US1 and the speed between the sensors, all computed over the
+  sample windows with array operations.
+- `predict_arrival()` fits a line to the latest US1 samples and predicts when the distance
+  reaches the detection threshold, so the control loop can turn TL1/TL2 red for a fast vehicle
+  before its detector has completed its dwell time.
+
+Distances are in cm of the prototype, heights and speeds are converted to the real road with
+the sensor mount height and the scale ratio.
+'''
+
+from collections import deque
+
+import numpy as np
+
+class SampleWindow:
+
+    """
+    The latest samples of one sensor, in a ring buffer of NumPy arrays.
+
+    Invalid samples (no echo, or a non-positive distance) are stored as NaN.
+
+    Parameters:
+    size (int): Number of samples kept.
+    """
+
+    def __init__(self, size=256):
+        self.times = np.zeros(size)
+        self.distances = np.full(size, np.nan)
+        self.next = 0
+        self.count = 0
+
+    def add(self, distance, timestamp):
+        """Stores one sample, replacing the oldest once the window is full."""
+        self.times[self.next] = timestamp
+        self.distances[self.next] = np.nan if distance is None or distance <= 0 else distance
+        self.next = (self.next + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def latest(self):
+        """Returns the distance of the newest sample, NaN if it is invalid or there is none."""
+        if self.count == 0:
+            return np.nan
+        return self.distances[self.next - 1]
+
+    def between(self, start, end=np.inf):
+
+        """
+        Returns the samples taken from `start` to `end`, oldest first.
+
+        Parameters:
+        start (float): The earliest timestamp returned.
+        end (float): The latest timestamp returned.
+
+        Returns:
+        tuple: (timestamps, distances) as NumPy arrays, invalid distances being NaN.
+        """
+
+        order = np.roll(np.arange(len(self.times)), -self.next)[len(self.times) - self.count:]
+        times = self.times[order]
+        distances = self.distances[order]
+        keep = (times >= start) & (times <= end)
+        return times[keep], distances[keep]
+
+class VehicleTrack:
+
+    """
+    One vehicle on its way from sensor to sensor.
+
+    Parameters:
+    trackId (int): Number of the track, counting from 1.
+    openedAt (float): Timestamp of the first sample of the vehicle.
+    """
+
+    def __init__(self, trackId, openedAt):
+        self.trackId = trackId
+        self.openedAt = openedAt
+        self.lastEventAt = openedAt
+        self.entries = {} # sensor number: timestamp the vehicle arrived under it
+        self.exits = {} # sensor number: timestamp the vehicle left it
+        self.heights = {} # sensor number: height profile in metres while under it
+        self.closingRate = None # cm/s the US1 distance fell at while the vehicle arrived
+
+    def is_under(self, sensorNum):
+        """Returns True while the vehicle is under `sensorNum`."""
+        return sensorNum in self.entries and sensorNum not in self.exits
+
+    def dwell(self, sensorNum):
+        """Returns the seconds the vehicle stayed under `sensorNum`, None if it has not left it."""
+        if sensorNum not in self.exits:
+            return None
+        return self.exits[sensorNum] - self.entries[sensorNum]
+
+    def speed(self, positions, scaleRatio):
+        """Returns the real speed in m/s between the first and the last sensor the vehicle reached, None before the second."""
+        sensorNums = sorted(self.entries, key=lambda sensorNum: self.entries[sensorNum])
+        if len(sensorNums) < 2:
+            return None
+        first, last = sensorNums[0], sensorNums[-1]
+        elapsed = self.entries[last] - self.entries[first]
+        if elapsed <= 0:
+            return None
+        return abs(positions[last] - positions[first]) * scaleRatio / 100 / elapsed
+
+    def summary(self, positions, scaleRatio):
+
+        """
+        Returns the estimates of the track, e.g. for the event log.
+
+        Parameters:
+        positions (dict): Position of every sensor along the road, in cm of the prototype.
+        scaleRatio (float): Real size over prototype size.
+
+        Returns:
+        dict: The track number, sensors reached, dwell times, height profile statistics, closing rate and speed.
+        """
+
+        profile = np.concatenate([self.heights[sensorNum] for sensorNum in sorted(self.heights)] or [np.empty(0)])
+        speed = self.speed(positions, scaleRatio)
+        return {
+            'track': self.trackId,
+            'sensors': sorted(self.entries),
+            'dwell': {sensorNum: round(self.dwell(sensorNum), 3) for sensorNum in sorted(self.exits)},
+            'peakHeightMetre': round(float(profile.max()), 3) if len(profile) > 0 else None,
+            'meanHeightMetre': round(float(profile.mean()), 3) if len(profile) > 0 else None,
+            'heightSamples': int(len(profile)),
+            'closingRate': None if self.closingRate is None else round(self.closingRate, 1),
+            'speedMetresPerSecond': None if speed is None else round(speed, 3),
+        }
+
+class VehicleTracker:
+
+    """
+    Builds vehicle tracks across US1, US2 and US3 from the raw sensor samples.
+
+    A sensor sees a vehicle from a sample below `enterThreshold` until a sample above
+    `exitThreshold`. A sample without an echo tells nothing about the vehicle and is skipped.
+    Unlike `VehicleDetector` there is no dwell time, the tracker follows the samples as they
+    come so the estimates are as early as possible.
+
+    Parameters:
+    enterThreshold (float): Distance in cm below which a sensor sees a vehicle.
+    exitThreshold (float): Distance in cm above which the vehicle has left the sensor.
+    approachDistance (float): Distance in cm below which the US1 samples of an arriving vehicle are fitted.
+    mountHeight (float): Distance in cm between the sensors and the road.
+    scaleRatio (float): Real size over prototype size.
+    positions (dict): Position of every sensor along the road, in cm of the prototype.
+    window (float): Seconds of US1 samples a prediction is fitted to.
+    horizon (float): Seconds ahead an arrival is predicted.
+    minClosingRate (float): Lowest rate in cm/s the US1 distance must fall at for a prediction.
+    tolerance (float): Largest spread in cm of the samples around the fitted line, or between
+                       two samples below `enterThreshold`, for a prediction.
+    trackTimeout (float): Seconds without a new sensor event after which an open track is closed.
+    windowSize (int): Number of samples kept per sensor.
+    """
+
+    def __init__(self, enterThreshold=10, exitThreshold=12, approachDistance=20, mountHeight=30, scaleRatio=20,
+                 positions=None, window=0.3, horizon=0.2, minClosingRate=20, tolerance=8, trackTimeout=30,
+                 windowSize=256):
+        self.enterThreshold = enterThreshold
+        self.exitThreshold = exitThreshold
+        self.approachDistance = approachDistance
+        self.mountHeight = mountHeight
+        self.scaleRatio = scaleRatio
+        self.positions = positions or {1: 0, 2: 20, 3: 40}
+        self.window = window
+        self.horizon = horizon
+        self.minClosingRate = minClosingRate
+        self.tolerance = tolerance
+        self.trackTimeout = trackTimeout
+        self.windowSize = windowSize
+        self.reset()
+
+    def reset(self):
+        """Forgets every sample and track, e.g. when a new board is connected."""
+        self.windows = {sensorNum: SampleWindow(self.windowSize) for sensorNum in self.positions}
+        self.present = {sensorNum: False for sensorNum in self.positions}
+        self.openTracks = []
+        self.closedTracks = deque(maxlen=64)
+        self.tracksOpened = 0
+
+    def heights_of(self, distances):
+        """Converts distances in cm of the prototype to real heights in metres, NaN staying NaN."""
+        return (self.mountHeight - distances) * self.scaleRatio / 100
+
+    def add_sample(self, sensorNum, distance, timestamp):
+
+        """
+        Feeds one raw sample to the tracker.
+
+        Parameters:
+        sensorNum (int): The sensor (1, 2, or 3).
+        distance (float): The measured distance in cm, None or non-positive if the sensor gave no echo.
+        timestamp (float): When the sample was measured.
+
+        Returns:
+        None
+        """
+
+        self.windows[sensorNum].add(distance, timestamp)
+        valid = distance is not None and distance > 0
+        if not self.present[sensorNum] and valid and distance < self.enterThreshold:
+            self.present[sensorNum] = True
+            self.vehicle_arrived(sensorNum, timestamp)
+        elif self.present[sensorNum] and valid and distance > self.exitThreshold:
+            self.present[sensorNum] = False
+            self.vehicle_left(sensorNum, timestamp)
+
+    def vehicle_arrived(self, sensorNum, timestamp):
+        """Adds the arrival under `sensorNum` to the oldest track that has not reached it, or opens a new track."""
+        track = None
+        if sensorNum != min(self.positions):
+            track = next((track for track in self.openTracks if sensorNum not in track.entries), None)
+        if track is None:
+            self.tracksOpened += 1
+            track = VehicleTrack(self.tracksOpened, timestamp)
+            self.openTracks.append(track)
+        track.entries[sensorNum] = timestamp
+        track.lastEventAt = timestamp
+        if sensorNum == 1:
+            track.closingRate = self.closing_rate(timestamp)
+
+    def vehicle_left(self, sensorNum, timestamp):
+        """Records the height profile and exit of the oldest track under `sensorNum`, closing it after its last sensor."""
+        track = next((track for track in self.openTracks if track.is_under(sensorNum)), None)
+        if track is None:
+            return
+        track.exits[sensorNum] = timestamp
+        track.lastEventAt = timestamp
+        times, distances = self.windows[sensorNum].between(track.entries[sensorNum], timestamp)
+        track.heights[sensorNum] = self.heights_of(distances[distances <= self.exitThreshold])
+        if sensorNum == max(self.positions):
+            self.close(track)
+
+    def close(self, track):
+        """Moves a track from the open to the closed tracks."""
+        self.openTracks.remove(track)
+        self.closedTracks.append(track)
+
+    def take_closed(self, now):
+
+        """
+        Closes the tracks that timed out and returns every track closed since the last call.
+
+        Parameters:
+        now (float): The current timestamp.
+
+        Returns:
+        list of VehicleTrack: The closed tracks, oldest first.
+        """
+
+        for track in list(self.openTracks):
+            underSensor = any(track.is_under(sensorNum) for sensorNum in track.entries)
+            if not underSensor and now - track.lastEventAt > self.trackTimeout:
+                self.close(track)
+        closed = list(self.closedTracks)
+        self.closedTracks.clear()
+        return closed
+
+    def current_height(self, sensorNum, now):
+        """Returns the median real height in metres of the vehicle under `sensorNum` over the last `window` seconds, None if there is none."""
+        if not self.present[sensorNum]:
+            return None
+        times, distances = self.windows[sensorNum].between(now - self.window)
+        heights = self.heights_of(distances[distances <= self.exitThreshold])
+        if len(heights) == 0:
+            return None
+        return float(np.median(heights))
+
+    def approach_samples(self, now):
+        """Returns the US1 samples of the last `window` seconds since the distance last fell below `approachDistance`."""
+        times, distances = self.windows[1].between(now - self.window, now)
+        # NaN compares False, so an invalid sample ends the approach like a clear road does
+        outside = np.flatnonzero(~(distances < self.approachDistance))
+        start = outside[-1] + 1 if len(outside) > 0 else 0
+        return times[start:], distances[start:]
+
+    def closing_rate(self, now):
+        """Returns the rate in cm/s the US1 distance fell at while approaching, None with fewer than 2 samples."""
+        times, distances = self.approach_samples(now)
+        if len(distances) < 2 or np.ptp(times) <= 0:
+            return None
+        slope = np.polyfit(times - times[-1], distances, 1)[0]
+        return float(-slope)
+
+    def predict_arrival(self, now):
+
+        """
+        Predicts whether an overheight vehicle reaches US1 within `horizon` seconds.
+
+        Two predictions are made from the US1 samples of the last `window` seconds taken since
+        the distance fell below `approachDistance`:
+        - the last two samples are both below `enterThreshold` and agree within `tolerance`,
+          so the vehicle is already there and no dwell time is needed to trust it,
+        - at least three samples lie on a line within `tolerance`, the distance falls faster
+          than `minClosingRate`, and the line reaches `enterThreshold` within `horizon` seconds.
+
+        Parameters:
+        now (float): The current timestamp.
+
+        Returns:
+        float or None: Seconds until the vehicle is expected below `enterThreshold` (0 if it
+        already is), or None if no arrival is predicted.
+        """
+
+        # most samples are of an empty road, they need no fit
+        if not self.windows[1].latest() < self.approachDistance:
+            return None
+        times, distances = self.approach_samples(now)
+        if len(distances) < 2:
+            return None
+
+        latest = distances[-2:]
+        if np.all(latest < self.enterThreshold) and np.ptp(latest) <= self.tolerance:
+            return 0.0
+
+        if len(distances) < 3 or np.ptp(times) <= 0:
+            return None
+        offsets = times - now
+        slope, intercept = np.polyfit(offsets, distances, 1)
+        spread = np.abs(distances - (slope * offsets + intercept)).max()
+        if -slope < self.minClosingRate or spread > self.tolerance:
+            return None
+        arrival = (self.enterThreshold - intercept) / slope
+        if arrival > self.horizon:
+            return None
+        return float(max(0.0, arrival))
@@ -0,0 +1,102 @@
+'''
+ENG1013: Engineering Smart System
+Traffic Control System Project 2025
+Clocks
+-------------------------------------------------------------
+Description:
+
+Every timestamp, sleep and wait of the traffic system goes through a clock, so the timing
+of the subsystems can be injected. A clock provides:
+
+- time(): the current timestamp in seconds,
+- sleep(seconds): waits that long,
+- event(): a new wake event with set(), clear(), is_set() and wait(timeout), used by the
+  sensor and button callbacks to wake the control loop.
+
+`RealClock` runs on the wall clock. `SimulatedClock` only advances when the system sleeps or
+waits, and then jumps straight to the next deadline or scripted step, so a 32 second warning
+phase or the 30 second pedestrian lockout passes in microseconds and every run makes the same
+decisions. `finalise_integrated_code.use_clock()` switches the whole system to a clock.
+'''
+
+import threading
+import time
+
+class RealClock:
+
+    """
+    The wall clock.
+    """
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def event(self):
+        return threading.Event()
+
+# shared by everything that runs in real time
+realClock = RealClock()
+
+class SimulatedClock:
+
+    """
+    A clock that only advances when the system sleeps or waits, used for scenarios, replays and tests.
+
+    Scripted steps are run when their time is reached, and a step that wakes the system
+    (a sensor or button callback setting the wake event) ends the wait early, exactly like
+    on the real board. The clock is its own wake event, so the control loop and every
+    callback share it.
+
+    Parameters:
+    start (float): The timestamp the clock starts at.
+    """
+
+    def __init__(self, start=1000.0):
+        self.now = start
+        self.steps = []
+        self.woken = False
+
+    def time(self):
+        return self.now
+
+    def schedule(self, at, action):
+        """Runs action() once the clock reaches `at`."""
+        self.steps.append((at, action))
+        self.steps.sort(key=lambda step: step[0])
+
+    def advance(self, until, stopWhenWoken):
+        """Runs the scripted steps due before `until` and moves the clock there, or to the step that woke the loop."""
+        while len(self.steps) > 0 and self.steps[0][0] <= until:
+            at, action = self.steps.pop(0)
+            self.now = max(self.now, at)
+            action()
+            if stopWhenWoken and self.woken:
+                return
+        self.now = max(self.now, until)
+
+    def sleep(self, seconds):
+        self.advance(self.now + seconds, False)
+
+    def event(self):
+        return self
+
+    # wake event interface
+    def set(self):
+        self.woken = True
+
+    def clear(self):
+        self.woken = False
+
+    def is_set(self):
+        return self.woken
+
+    def wait(self, timeout=None):
+        if not self.woken:
+            if timeout is None:
+                # nothing but a scripted step can wake the system
+                timeout = self.steps[0][0] - self.now if len(self.steps) > 0 else 0
+            self.advance(self.now + timeout, True)
+        return self.woken